@@ -0,0 +1,337 @@
+'''
+asyncio front-end for the main.py operations
+
+Every coroutine here has the signature of the main.py function of the
+same name and returns the same values, so an async web stack can await
+them instead of blocking its event loop:
+
+- calls on the same collection (or operation log) are serialized with
+  one asyncio.Lock per object; calls that need several objects take
+  their locks in a fixed order, so they cannot deadlock
+- in-memory collections are changed on the event loop itself (each call
+  is short); collections with blocking = True (the SQLite backend, and
+  wrappers around it) and calls given an oplog, which may fsync, run on
+  a worker thread instead
+- load_users / load_status_updates parse the CSV file on a worker
+  thread and hand batches of LOAD_BATCH_ROWS rows to the event loop
+  through a queue of LOAD_QUEUE_BATCHES batches. When the collection
+  falls behind, the queue fills up and the reader waits (backpressure),
+  and other coroutines get the collection between batches
+- save_users / save_status_updates copy the records under the lock and
+  write the copy atomically on main.SAVE_EXECUTOR. In-memory records
+  are copied SAVE_COPY_ROWS at a time on the event loop, which runs
+  other coroutines between the slices; blocking backends are copied on
+  a worker thread
+'''
+import asyncio
+import contextlib
+import csv
+import itertools
+import threading
+import time
+import weakref
+import main
+
+LOAD_BATCH_ROWS = 1000
+LOAD_QUEUE_BATCHES = 4
+SAVE_COPY_ROWS = 10_000
+
+# collection / oplog -> the asyncio.Lock that serializes calls on it
+LOCKS = weakref.WeakKeyDictionary()
+
+
+@contextlib.asynccontextmanager
+async def locked(*targets):
+    '''
+    Holds the locks of every target that is not None,
+    acquired in id() order
+    '''
+    async with contextlib.AsyncExitStack() as stack:
+        for target in sorted({id(target): target for target in targets
+                              if target is not None}.values(), key=id):
+            await stack.enter_async_context(
+                LOCKS.setdefault(target, asyncio.Lock()))
+        yield
+
+
+async def run(blocking, function, *args):
+    '''
+    Calls function(*args) on a worker thread if blocking,
+    otherwise right here on the event loop
+    '''
+    if blocking:
+        return await asyncio.to_thread(function, *args)
+    return function(*args)
+
+
+def is_blocking(*targets):
+    '''
+    True if calls on any of targets may block: a backend
+    marked blocking, or an operation log (which fsyncs)
+    '''
+    return any(isinstance(target, main.operation_log.OperationLog) or
+               getattr(target, 'blocking', False)
+               for target in targets if target is not None)
+
+
+async def call(function, *args, targets):
+    '''
+    Runs function(*args) holding the locks of targets
+    '''
+    async with locked(*targets):
+        return await run(is_blocking(*targets), function, *args)
+
+
+# mirrors main.add_user, parameters included
+async def add_user(  # pylint: disable=R0913,R0917
+        user_id, email, user_name, user_last_name, user_collection,
+        oplog=None):
+    '''
+    Async main.add_user
+    '''
+    return await call(main.add_user, user_id, email, user_name,
+                      user_last_name, user_collection, oplog,
+                      targets=(user_collection, oplog))
+
+
+# mirrors main.update_user, parameters included
+async def update_user(  # pylint: disable=R0913,R0917
+        user_id, email, user_name, user_last_name, user_collection,
+        oplog=None):
+    '''
+    Async main.update_user
+    '''
+    return await call(main.update_user, user_id, email, user_name,
+                      user_last_name, user_collection, oplog,
+                      targets=(user_collection, oplog))
+
+
+async def delete_user(user_id, user_collection, oplog=None):
+    '''
+    Async main.delete_user
+    '''
+    return await call(main.delete_user, user_id, user_collection, oplog,
+                      targets=(user_collection, oplog))
+
+
+async def delete_user_cascade(user_id, user_collection, status_collection,
+                              oplog=None):
+    '''
+    Async main.delete_user_cascade
+    '''
+    return await call(main.delete_user_cascade, user_id, user_collection,
+                      status_collection, oplog,
+                      targets=(user_collection, status_collection, oplog))
+
+
+async def search_user(user_id, user_collection):
+    '''
+    Async main.search_user
+    '''
+    return await call(main.search_user, user_id, user_collection,
+                      targets=(user_collection,))
+
+
+async def search_users_many(user_ids, user_collection):
+    '''
+    Async main.search_users_many
+    '''
+    return await call(main.search_users_many, list(user_ids),
+                      user_collection, targets=(user_collection,))
+
+
+async def search_user_by_email(email, user_collection):
+    '''
+    Async main.search_user_by_email
+    '''
+    return await call(main.search_user_by_email, email, user_collection,
+                      targets=(user_collection,))
+
+
+async def search_users_by_prefix(prefix, user_collection, limit=10):
+    '''
+    Async main.search_users_by_prefix
+    '''
+    return await call(main.search_users_by_prefix, prefix, user_collection,
+                      limit, targets=(user_collection,))
+
+
+async def add_status(user_id, status_id, status_text, status_collection,
+                     oplog=None):
+    '''
+    Async main.add_status
+    '''
+    return await call(main.add_status, user_id, status_id, status_text,
+                      status_collection, oplog,
+                      targets=(status_collection, oplog))
+
+
+async def update_status(status_id, user_id, status_text, status_collection,
+                        oplog=None):
+    '''
+    Async main.update_status
+    '''
+    return await call(main.update_status, status_id, user_id, status_text,
+                      status_collection, oplog,
+                      targets=(status_collection, oplog))
+
+
+async def delete_status(status_id, status_collection, oplog=None):
+    '''
+    Async main.delete_status
+    '''
+    return await call(main.delete_status, status_id, status_collection,
+                      oplog, targets=(status_collection, oplog))
+
+
+async def search_status(status_id, status_collection):
+    '''
+    Async main.search_status
+    '''
+    return await call(main.search_status, status_id, status_collection,
+                      targets=(status_collection,))
+
+
+async def search_statuses_many(status_ids, status_collection):
+    '''
+    Async main.search_statuses_many
+    '''
+    return await call(main.search_statuses_many, list(status_ids),
+                      status_collection, targets=(status_collection,))
+
+
+async def search_statuses_by_user(user_id, status_collection):
+    '''
+    Async main.search_statuses_by_user
+    '''
+    return await call(main.search_statuses_by_user, user_id,
+                      status_collection, targets=(status_collection,))
+
+
+async def search_statuses_by_text(query, status_collection, match_all=True,
+                                  ranked=False):
+    '''
+    Async main.search_statuses_by_text
+    '''
+    return await call(main.search_statuses_by_text, query, status_collection,
+                      match_all, ranked, targets=(status_collection,))
+
+
+async def load_csv(filename, collection, header, report=None):
+    '''
+    Async main.load_csv: a worker thread parses the file into
+    batches, which are merged into collection on the event loop
+    as the bounded queue lets them through
+    '''
+    track_bytes = report is not None
+    if report is None:
+        report = main.LoadReport()
+    loop = asyncio.get_running_loop()
+    batches = asyncio.Queue(LOAD_QUEUE_BATCHES)
+    # set when the merge ends early, so the reader stops parsing
+    stop = threading.Event()
+
+    def put(batch):
+        # waits while the queue is full
+        asyncio.run_coroutine_threadsafe(batches.put(batch), loop).result()
+
+    def read():
+        try:
+            with open(filename, 'r', newline='') as csvfile:
+                lines = main.count_bytes(csvfile, report) if track_bytes \
+                    else csvfile
+                filereader = csv.reader(lines, delimiter=',', quotechar='|')
+                if not main.check_header(next(filereader, None), header):
+                    return False
+                while batch := list(itertools.islice(filereader,
+                                                     LOAD_BATCH_ROWS)):
+                    if stop.is_set():
+                        return False
+                    put(batch)
+                return True
+        finally:
+            put(None)
+
+    started = time.perf_counter()
+    reader = asyncio.ensure_future(asyncio.to_thread(read))
+    blocking = is_blocking(collection)
+    try:
+        while (batch := await batches.get()) is not None:
+            async with locked(collection):
+                await run(blocking, main.merge_chunk, batch, collection,
+                          header, report)
+    finally:
+        # never leave the reader waiting on a full queue, and stop
+        # it at its next batch if the merge ended early
+        stop.set()
+        while not reader.done():
+            while not batches.empty():
+                batches.get_nowait()
+            await asyncio.wait([reader], timeout=0.01)
+    header_ok = await reader
+    report.elapsed = time.perf_counter() - started
+
+    return header_ok and report.rejected == 0
+
+
+async def load_users(filename, user_collection, report=None):
+    '''
+    Async main.load_users
+    '''
+    return await load_csv(filename, user_collection, main.USER_HEADER,
+                          report)
+
+
+async def load_status_updates(filename, status_collection, report=None):
+    '''
+    Async main.load_status_updates
+    '''
+    return await load_csv(filename, status_collection, main.STATUS_HEADER,
+                          report)
+
+
+async def copy_rows(rows):
+    '''
+    Returns a list of rows, copied SAVE_COPY_ROWS at a time,
+    letting other coroutines run between the slices
+    '''
+    copied = []
+    rows = iter(rows)
+    while batch := list(itertools.islice(rows, SAVE_COPY_ROWS)):
+        copied += batch
+        await asyncio.sleep(0)
+    return copied
+
+
+async def save_csv(filename, collection, header, rows, chunk_rows):
+    '''
+    Copies rows (of collection) under its lock, then saves
+    the copy atomically on main.SAVE_EXECUTOR
+    '''
+    async with locked(collection):
+        if is_blocking(collection):
+            rows = await asyncio.to_thread(list, rows)
+        else:
+            rows = await copy_rows(rows)
+    return await asyncio.wrap_future(main.SAVE_EXECUTOR.submit(
+        main.save_rows, filename, header, rows, chunk_rows, True))
+
+
+async def save_users(filename, user_collection,
+                     chunk_rows=main.SAVE_CHUNK_ROWS):
+    '''
+    Async main.save_users: the users are copied under the
+    lock, then saved atomically on main.SAVE_EXECUTOR
+    '''
+    return await save_csv(filename, user_collection, main.USER_HEADER,
+                          main.user_rows(user_collection), chunk_rows)
+
+
+async def save_status_updates(filename, status_collection,
+                              chunk_rows=main.SAVE_CHUNK_ROWS):
+    '''
+    Async main.save_status_updates: the statuses are copied
+    under the lock, then saved atomically on main.SAVE_EXECUTOR
+    '''
+    return await save_csv(filename, status_collection, main.STATUS_HEADER,
+                          main.status_rows(status_collection), chunk_rows)
@@ -0,0 +1,640 @@
+'''
+Benchmarks for the social network backend
+
+Usage:
+    python benchmarks.py [benchmark ...]
+
+With no arguments every benchmark is run. Sizes are kept small
+enough to finish in a few minutes; pass bigger sizes to the
+functions directly for production-sized runs.
+'''
+import asyncio
+import os
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from unittest.mock import patch
+import async_api
+import bloom
+import columnar_status
+import concurrent_collections
+import main
+import sharded
+
+
+def make_user_collection(size):
+    '''returns a UserCollection holding size generated users'''
+    collection = main.init_user_collection()
+    collection.merge_rows((f'user{number}', f'user{number}@example.com',
+                           f'Name{number}', f'Last{number}')
+                          for number in range(size))
+    return collection
+
+
+def make_status_collection(size, users_count=1000):
+    '''returns a UserStatusCollection holding size generated statuses'''
+    collection = main.init_status_collection()
+    collection.merge_rows((f'status{number}', f'user{number % users_count}',
+                           f'Status update number {number}')
+                          for number in range(size))
+    return collection
+
+
+def measure(function, *args):
+    '''
+    runs function(*args) and returns (seconds, peak bytes allocated)
+    the peak comes from a second, traced run so it does not skew timing
+    '''
+    started = time.perf_counter()
+    function(*args)
+    elapsed = time.perf_counter() - started
+
+    tracemalloc.start()
+    function(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return elapsed, peak
+
+
+def bench_save(sizes=(10_000, 100_000, 1_000_000)):
+    '''throughput and peak memory of save_users / save_status_updates'''
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'bench.csv')
+        for size in sizes:
+            user_collection = make_user_collection(size)
+            elapsed, peak = measure(main.save_users, filename,
+                                    user_collection)
+            megabytes = os.path.getsize(filename) / 2 ** 20
+            print(f'save_users          {size:>10,} rows '
+                  f'{size / elapsed:>12,.0f} rows/s '
+                  f'{megabytes / elapsed:>8.1f} MB/s '
+                  f'peak {peak / 2 ** 10:>8.0f} KiB')
+
+            status_collection = make_status_collection(size)
+            elapsed, peak = measure(main.save_status_updates, filename,
+                                    status_collection)
+            megabytes = os.path.getsize(filename) / 2 ** 20
+            print(f'save_status_updates {size:>10,} rows '
+                  f'{size / elapsed:>12,.0f} rows/s '
+                  f'{megabytes / elapsed:>8.1f} MB/s '
+                  f'peak {peak / 2 ** 10:>8.0f} KiB')
+
+
+def bench_signup(sizes=(1_000, 10_000, 100_000, 1_000_000), signups=10_000):
+    '''
+    mean main.add_user latency against collections of growing size
+    (pass sizes=(..., 10_000_000) for the full 1k-10M sweep)
+    '''
+    for size in sizes:
+        collection = make_user_collection(size)
+        started = time.perf_counter()
+        for number in range(size, size + signups):
+            main.add_user(f'user{number}', f'user{number}@example.com',
+                          'New', 'User', collection)
+        elapsed = time.perf_counter() - started
+        print(f'add_user       into {size:>12,} users '
+              f'{elapsed / signups * 1e6:>8.2f} us/signup')
+
+        started = time.perf_counter()
+        main.bulk_add_users(((f'bulk{number}', f'bulk{number}@example.com',
+                              'New', 'User') for number in range(signups)),
+                            collection)
+        elapsed = time.perf_counter() - started
+        print(f'bulk_add_users into {size:>12,} users '
+              f'{elapsed / signups * 1e6:>8.2f} us/signup')
+
+
+class DictUsers():  # pylint: disable=R0903
+    '''the pre-slots Users layout, kept for comparison'''
+
+    def __init__(self, user_id, email, user_name, user_last_name):
+        self.user_id = user_id
+        self.email = email
+        self.user_name = user_name
+        self.user_last_name = user_last_name
+
+
+class DictUserStatus():  # pylint: disable=R0903
+    '''the pre-slots UserStatus layout, kept for comparison'''
+
+    def __init__(self, status_id, user_id, status_text):
+        self.status_id = status_id
+        self.user_id = user_id
+        self.status_text = status_text
+
+
+def bytes_per_record(record_class, fields, size):
+    '''
+    bytes allocated per record_class instance, excluding the field
+    strings themselves (every record shares the same ones)
+    '''
+    tracemalloc.start()
+    records = [record_class(*fields) for _ in range(size)]
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del records
+    return allocated / size
+
+
+def bench_record_memory(size=1_000_000):
+    '''bytes per Users / UserStatus record with and without __slots__'''
+    user_fields = ('evmiles97', 'eve.miles@uw.edu', 'Eve', 'Miles')
+    status_fields = ('evmiles97_00001', 'evmiles97', 'Code is compiling')
+    for name, before, after, fields in (
+            ('Users', DictUsers, main.users.Users, user_fields),
+            ('UserStatus', DictUserStatus, main.user_status.UserStatus,
+             status_fields)):
+        dict_bytes = bytes_per_record(before, fields, size)
+        slot_bytes = bytes_per_record(after, fields, size)
+        print(f'{name:<10} at {size:,}: {dict_bytes:6.1f} bytes/record '
+              f'with __dict__, {slot_bytes:6.1f} with __slots__')
+
+
+def bench_columnar(size=1_000_000, users_count=10_000):
+    '''
+    bytes per status for the dict and columnar status backends,
+    including the strings parsed for each row
+    '''
+    for name, factory in (('dict', main.init_status_collection),
+                          ('columnar',
+                           columnar_status.ColumnarStatusCollection)):
+        tracemalloc.start()
+        collection = factory()
+        collection.merge_rows((f'status{number}',
+                               f'user{number % users_count}',
+                               f'Status update number {number}')
+                              for number in range(size))
+        allocated, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f'{name:<8} backend at {size:,} statuses: '
+              f'{allocated / size:6.1f} bytes/status')
+        del collection
+
+
+def load_fixture(users_count, statuses):
+    '''
+    loads users_count users and statuses statuses, every id parsed
+    into a fresh string as csv.reader would, and returns the bytes
+    allocated by both collections
+    '''
+    tracemalloc.start()
+    user_collection = main.init_user_collection()
+    user_collection.merge_rows((f'user{number}', f'user{number}@example.com',
+                                'Name', 'Last')
+                               for number in range(users_count))
+    status_collection = main.init_status_collection()
+    status_collection.merge_rows((f'status{number}',
+                                  f'user{number % users_count}', 'Text')
+                                 for number in range(statuses))
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return allocated
+
+
+def bench_interning(users_count=100_000, statuses=1_000_000):
+    '''
+    memory saved by interning user_ids across both collections
+    (pass statuses=10_000_000 for the full-size fixture)
+    '''
+    interned = load_fixture(users_count, statuses)
+    with patch('users.intern_id', lambda value: value), \
+            patch('user_status.intern_id', lambda value: value):
+        copied = load_fixture(users_count, statuses)
+    print(f'{users_count:,} users / {statuses:,} statuses: '
+          f'{copied / 2 ** 20:,.1f} MiB without interning, '
+          f'{interned / 2 ** 20:,.1f} MiB with interning '
+          f'({(copied - interned) / 2 ** 20:,.1f} MiB saved)')
+
+
+def bench_snapshot(statuses=1_000_000, users_count=100_000):
+    '''
+    cold-start load time from CSV files versus a binary snapshot
+    (pass statuses=10_000_000 for the full-size run)
+    '''
+    user_collection = make_user_collection(users_count)
+    status_collection = make_status_collection(statuses, users_count)
+    with tempfile.TemporaryDirectory() as directory:
+        accounts = os.path.join(directory, 'accounts.csv')
+        updates = os.path.join(directory, 'status_updates.csv')
+        snapshot = os.path.join(directory, 'snapshot.bin')
+        main.save_users(accounts, user_collection)
+        main.save_status_updates(updates, status_collection)
+        main.save_snapshot(snapshot, user_collection, status_collection)
+        del user_collection, status_collection
+
+        started = time.perf_counter()
+        main.load_users(accounts, main.init_user_collection())
+        main.load_status_updates(updates, main.init_status_collection())
+        csv_elapsed = time.perf_counter() - started
+
+        started = time.perf_counter()
+        main.load_snapshot(snapshot, main.init_user_collection(),
+                           main.init_status_collection())
+        snapshot_elapsed = time.perf_counter() - started
+
+    print(f'{users_count:,} users / {statuses:,} statuses: '
+          f'CSV {csv_elapsed:.2f}s, snapshot {snapshot_elapsed:.2f}s')
+
+
+def write_status_file(filename, size_bytes):
+    '''writes a generated status_updates CSV file of about size_bytes'''
+    with open(filename, 'w') as file:
+        file.write('STATUS_ID,USER_ID,STATUS_TEXT')
+        number = 0
+        while file.tell() < size_bytes:
+            file.write(''.join(f'\nstatus{number + offset},'
+                               f'user{(number + offset) % 100_000},'
+                               f'Generated status update {number + offset}'
+                               for offset in range(10_000)))
+            number += 10_000
+
+
+def bench_parallel_load(size_bytes=200 * 2 ** 20, workers=(1, 2, 4, 8)):
+    '''
+    load_status_updates time at 1, 2, 4 and 8 workers
+    (pass size_bytes=5 * 2 ** 30 for the 5 GB run)
+    '''
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'status_updates.csv')
+        write_status_file(filename, size_bytes)
+        for count in workers:
+            report = main.LoadReport()
+            main.load_status_updates(filename, main.init_status_collection(),
+                                     report, workers=count)
+            print(f'{count} worker(s): {report.rows_read:,} rows in '
+                  f'{report.elapsed:.2f}s '
+                  f'({report.bytes_read / 2 ** 20 / report.elapsed:.1f} MB/s)')
+
+
+def bench_bloom(size=100_000, error_rates=(0.1, 0.01, 0.001)):
+    '''
+    measured false-positive rate of the Bloom filter against the
+    configured one, and miss latency with and without the filter
+    in front of a SQLite users backend
+    '''
+    for error_rate in error_rates:
+        bloom_filter = bloom.CountingBloomFilter(size, error_rate)
+        for number in range(size):
+            bloom_filter.add(f'user{number}')
+        false_positives = sum(f'other{number}' in bloom_filter
+                              for number in range(size))
+        print(f'error_rate {error_rate:<6} measured '
+              f'{false_positives / size:.4f} '
+              f'({bloom_filter.size / size:.1f} bytes/id, '
+              f'{bloom_filter.hashes} hashes)')
+
+    with tempfile.TemporaryDirectory() as directory:
+        backend = main.init_user_collection(
+            'sqlite', os.path.join(directory, 'bench.sqlite'))
+        backend.merge_rows((f'user{number}', f'user{number}@e', 'n', 'l')
+                           for number in range(size))
+        for name, collection in (('sqlite', backend),
+                                 ('bloom+sqlite',
+                                  bloom.BloomUserCollection(backend))):
+            started = time.perf_counter()
+            for number in range(size):
+                main.search_user(f'other{number}', collection)
+            elapsed = time.perf_counter() - started
+            print(f'{name:<12} miss: {elapsed / size * 1e6:6.2f} us/lookup')
+
+
+def time_pages(user_pages, status_pages, user_collection,
+               status_collection):
+    '''
+    seconds per feed page looking the ids up one at a time, then
+    with search_*_many
+    '''
+    started = time.perf_counter()
+    for user_ids, status_ids in zip(user_pages, status_pages):
+        for user_id in user_ids:
+            main.search_user(user_id, user_collection)
+        for status_id in status_ids:
+            main.search_status(status_id, status_collection)
+    looped = (time.perf_counter() - started) / len(user_pages)
+
+    started = time.perf_counter()
+    for user_ids, status_ids in zip(user_pages, status_pages):
+        main.search_users_many(user_ids, user_collection)
+        main.search_statuses_many(status_ids, status_collection)
+    batched = (time.perf_counter() - started) / len(user_pages)
+    return looped, batched
+
+
+def bench_batch_lookup(size=100_000, pages=200, users_per_page=200,
+                       statuses_per_page=1000):
+    '''
+    one feed page (users_per_page users and statuses_per_page statuses)
+    looked up one id at a time and with search_*_many, for the memory
+    and SQLite backends
+    '''
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'bench.sqlite')
+        backends = (('memory', main.init_user_collection(),
+                     main.init_status_collection()),
+                    ('sqlite', main.init_user_collection('sqlite', filename),
+                     main.init_status_collection('sqlite', filename)))
+        for name, user_collection, status_collection in backends:
+            user_collection.merge_rows(
+                (f'user{number}', f'user{number}@e', 'n', 'l')
+                for number in range(size))
+            status_collection.merge_rows(
+                (f'status{number}', f'user{number % size}', 'text')
+                for number in range(size))
+            user_pages = [[f'user{(page * 7919 + number) % size}'
+                           for number in range(users_per_page)]
+                          for page in range(pages)]
+            status_pages = [[f'status{(page * 7919 + number) % size}'
+                             for number in range(statuses_per_page)]
+                            for page in range(pages)]
+            looped, batched = time_pages(user_pages, status_pages,
+                                         user_collection, status_collection)
+            print(f'{name:<7} page: loop {looped * 1e3:7.2f} ms, '
+                  f'batch {batched * 1e3:7.2f} ms '
+                  f'({looped / batched:.1f}x)')
+
+
+def bench_async_clients(clients=5_000, requests=10, size_bytes=50 * 2**20):
+    '''
+    thousands of concurrent clients, each making requests add_status /
+    search_status calls through async_api while a size_bytes file is
+    bulk loaded:
+    request latency with the load run blocking on the event loop
+    (main.load_status_updates) and through async_api
+    '''
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'bench.csv')
+        write_status_file(filename, size_bytes)
+
+        async def client(number, status_collection, latencies):
+            for request in range(requests):
+                started = time.perf_counter()
+                # the request arrives from the network
+                await asyncio.sleep(0)
+                await async_api.add_status(
+                    'client', f'client{number}_{request}', 'hello',
+                    status_collection)
+                await async_api.search_status(f'client{number}_0',
+                                              status_collection)
+                latencies.append(time.perf_counter() - started)
+
+        async def blocking_load(status_collection):
+            await asyncio.sleep(0)
+            return main.load_status_updates(filename, status_collection)
+
+        async def run(name, load):
+            status_collection = main.init_status_collection()
+            latencies = []
+            started = time.perf_counter()
+            await asyncio.gather(load(status_collection), *(
+                client(number, status_collection, latencies)
+                for number in range(clients)))
+            elapsed = time.perf_counter() - started
+            latencies.sort()
+            print(f'{name:<8} {clients} clients: {elapsed:6.2f} s, '
+                  f'p50 {latencies[len(latencies) // 2] * 1e3:8.2f} ms, '
+                  f'max {latencies[-1] * 1e3:8.2f} ms')
+
+        asyncio.run(run('blocking', blocking_load))
+        asyncio.run(run('async', lambda status_collection:
+                        async_api.load_status_updates(filename,
+                                                      status_collection)))
+
+
+class GlobalLockUsers(main.users.UserCollection):
+    '''UserCollection behind one lock, the baseline for lock striping'''
+
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.Lock()
+
+    def add_user(self, *args):
+        with self.lock:
+            return super().add_user(*args)
+
+    def modify_user(self, *args):
+        with self.lock:
+            return super().modify_user(*args)
+
+    def delete_user(self, user_id):
+        with self.lock:
+            return super().delete_user(user_id)
+
+    def get_user(self, user_id):
+        with self.lock:
+            return super().get_user(user_id)
+
+
+def bench_concurrent(threads=(1, 2, 4, 8), operations=100_000,
+                     users_count=10_000):
+    '''
+    mixed search / add / update / delete throughput from several threads
+    on a single-lock collection and on the striped, lock-free-read one
+    (80% searches). Under the GIL striping mostly removes lock waits
+    rather than adding parallelism
+    '''
+    for name, factory in (('global', GlobalLockUsers),
+                          ('striped',
+                           concurrent_collections.ConcurrentUserCollection)):
+        for count in threads:
+            collection = factory()
+            collection.merge_rows((f'user{number}', f'user{number}@e', 'n',
+                                   'l') for number in range(users_count))
+
+            def worker(offset, collection=collection, count=count):
+                for number in range(offset, operations, count):
+                    user_id = f'user{number * 7919 % users_count}'
+                    kind = number % 10
+                    if kind < 8:
+                        main.search_user(user_id, collection)
+                    elif kind == 8:
+                        main.update_user(user_id, f'{user_id}@e', 'n', 'l',
+                                         collection)
+                    elif not main.delete_user(user_id, collection):
+                        main.add_user(user_id, f'{user_id}@e', 'n', 'l',
+                                      collection)
+
+            workers = [threading.Thread(target=worker, args=(offset,))
+                       for offset in range(count)]
+            started = time.perf_counter()
+            for thread in workers:
+                thread.start()
+            for thread in workers:
+                thread.join()
+            elapsed = time.perf_counter() - started
+            print(f'{name:<8} {count} threads: '
+                  f'{operations / elapsed:>10,.0f} ops/s')
+
+
+def bench_sharded(shard_counts=(1, 2, 4, 8), size=200_000, batch=1000,
+                  single=5_000):
+    '''
+    aggregate throughput of a sharded users collection: merge_rows,
+    search_users_many in batches (every shard works at once) and
+    single add_user / search_user round trips
+    '''
+    rows = [(f'user{number}', f'user{number}@e', 'n', 'l')
+            for number in range(size)]
+    lookups = [f'user{number * 7919 % size}' for number in range(size)]
+    for shards in shard_counts:
+        with sharded.ShardPool(shards) as pool:
+            started = time.perf_counter()
+            pool.users.merge_rows(rows)
+            merged = size / (time.perf_counter() - started)
+
+            started = time.perf_counter()
+            for start in range(0, size, batch):
+                main.search_users_many(lookups[start:start + batch],
+                                       pool.users)
+            batched = size / (time.perf_counter() - started)
+
+            started = time.perf_counter()
+            for number in range(single):
+                main.add_user(f'new{number}', f'new{number}@e', 'n', 'l',
+                              pool.users)
+                main.search_user(lookups[number], pool.users)
+            round_trips = 2 * single / (time.perf_counter() - started)
+            print(f'{shards} shards: merge {merged:>9,.0f} rows/s, '
+                  f'batch search {batched:>9,.0f} ids/s, '
+                  f'single calls {round_trips:>7,.0f} ops/s')
+
+
+def bench_text_search(size=1_000_000, queries=('weather', 'hike sunny',
+                                               'rain snow',
+                                               'status update*')):
+    '''
+    main.search_statuses_by_text with the full-text index and with a
+    linear scan (pass size=10_000_000 for the full-size comparison)
+    '''
+    words = ('sunny', 'rain', 'hike', 'weather', 'coffee', 'snow',
+             'compiling', 'code', 'beach', 'seattle')
+    rows = [(f'status{number:08}', f'user{number % 10_000}',
+             f'Status update {number}: {words[number % 10]} and '
+             f'{words[number * 7 % 9]}')
+            for number in range(size)]
+    scanned = main.init_status_collection()
+    scanned.merge_rows(rows)
+    indexed = main.init_status_collection(text_search=True)
+    started = time.perf_counter()
+    indexed.merge_rows(rows)
+    print(f'index build: {time.perf_counter() - started:.2f} s '
+          f'for {size:,} statuses')
+
+    for query in queries:
+        for match_all in (True, False):
+            timings = []
+            for collection in (scanned, indexed):
+                started = time.perf_counter()
+                found = main.search_statuses_by_text(query, collection,
+                                                     match_all)
+                timings.append(time.perf_counter() - started)
+            mode = 'AND' if match_all else 'OR'
+            print(f'{query!r:<16} {mode:<3} {len(found):>9,} hits: '
+                  f'scan {timings[0] * 1e3:9.1f} ms, '
+                  f'index {timings[1] * 1e3:8.1f} ms')
+
+
+SYLLABLES = ('an', 'be', 'cor', 'da', 'el', 'fi', 'go', 'ha', 'is', 'jo',
+             'ka', 'li', 'mo', 'na', 'ol', 'pe', 'ri', 'sa', 'to', 'vi')
+
+
+def syllable_name(number):
+    '''
+    a made-up name of 2 to 4 SYLLABLES, spelled from number
+    '''
+    return ''.join(SYLLABLES[number // 20 ** digit % 20]
+                   for digit in range(number % 3 + 2)).title()
+
+
+def median_p99(timings):
+    '''
+    the median and 99th percentile of timings, in milliseconds
+    '''
+    timings = sorted(timings)
+    return (timings[len(timings) // 2] * 1e3,
+            timings[len(timings) * 99 // 100] * 1e3)
+
+
+def time_prefix_searches(collection, count, length, limit, add=None):
+    '''
+    seconds taken by each of count prefix searches of prefixes
+    length long, calling add(number) before each one if given
+    '''
+    timings = []
+    for number in range(count):
+        if add is not None:
+            add(number)
+        prefix = syllable_name(number * 31)[:length]
+        started = time.perf_counter()
+        main.search_users_by_prefix(prefix, collection, limit)
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+def bench_prefix_search(size=1_000_000, prefixes=2_000, limit=10):
+    '''
+    main.search_users_by_prefix latency (median and p99 per prefix
+    length) with the prefix index, SQLite's name indexes and a scan,
+    and while users are being added (pass size=5_000_000 for the
+    full-size run)
+    '''
+    rows = [(f'user{number}', f'user{number}@e',
+             syllable_name(number * 7919),
+             syllable_name(number * 104_729 + 1)) for number in range(size)]
+    indexed = main.init_user_collection(prefix_search=True)
+    started = time.perf_counter()
+    indexed.merge_rows(rows)
+    print(f'index build: {time.perf_counter() - started:.2f} s '
+          f'for {size:,} users')
+    with tempfile.TemporaryDirectory() as directory:
+        database = main.init_user_collection(
+            'sqlite', os.path.join(directory, 'users.db'))
+        database.merge_rows(rows)
+        scanned = main.init_user_collection()
+        scanned.merge_rows(rows)
+        del rows
+
+        for length in (1, 2, 3, 5):
+            for label, collection, count in (
+                    ('index', indexed, prefixes),
+                    ('sqlite', database, prefixes),
+                    ('scan', scanned, 3)):
+                median, p99 = median_p99(time_prefix_searches(
+                    collection, count, length, limit))
+                print(f'prefix length {length} {label:<6}: median '
+                      f'{median:8.3f} ms, p99 {p99:8.3f} ms')
+        database.connection.close()
+
+    # signups between searches: additions wait in the pending list
+    median, p99 = median_p99(time_prefix_searches(
+        indexed, prefixes, 2, limit,
+        add=lambda number: indexed.add_user(
+            f'new{number}', f'new{number}@e', syllable_name(number),
+            syllable_name(number + 1))))
+    print(f'index while adding  : median {median:8.3f} ms, '
+          f'p99 {p99:8.3f} ms')
+
+
+BENCHMARKS = {
+    'save': bench_save,
+    'signup': bench_signup,
+    'records': bench_record_memory,
+    'columnar': bench_columnar,
+    'interning': bench_interning,
+    'snapshot': bench_snapshot,
+    'parallel': bench_parallel_load,
+    'bloom': bench_bloom,
+    'batch': bench_batch_lookup,
+    'async': bench_async_clients,
+    'concurrent': bench_concurrent,
+    'sharded': bench_sharded,
+    'text': bench_text_search,
+    'prefix': bench_prefix_search,
+}
+
+
+if __name__ == '__main__':
+    for benchmark in sys.argv[1:] or BENCHMARKS:
+        BENCHMARKS[benchmark]()
@@ -0,0 +1,262 @@
+'''
+Negative-lookup Bloom filters in front of a collection backend
+
+BloomUserCollection and BloomStatusCollection keep a counting Bloom
+filter of the ids in a backend. A lookup for an id the filter has
+never seen is answered as a miss without touching the backend; every
+other lookup goes through. Counting buckets let deletes remove ids
+from the filter. Anything that could leave an id in the backend but
+not in the filter is avoided: ids are always added on insert, even
+by merge_rows for rows the backend then skips, which can only raise
+the false-positive rate. rebuild() re-reads the backend to fix that,
+and runs on its own once the filter holds more ids than it was sized
+for. Any other attribute is passed to the backend.
+'''
+import hashlib
+import math
+from users import MISSING_USER
+from user_status import MISSING_STATUS
+
+# filters are never sized for fewer ids than this
+MINIMUM_CAPACITY = 1024
+
+
+class CountingBloomFilter():
+    '''
+    Bloom filter with 8-bit counting buckets, sized for capacity
+    ids at a false-positive rate of error_rate. A bucket that
+    reaches 255 stays there, so it can never cause a false negative
+    '''
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = math.ceil(-capacity * math.log(error_rate)
+                              / math.log(2) ** 2)
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.buckets = bytearray(self.size)
+        self.count = 0
+
+    def _buckets(self, key):
+        '''the bucket numbers of key (double hashing on one blake2b)'''
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return [(first + number * second) % self.size
+                for number in range(self.hashes)]
+
+    def add(self, key):
+        '''
+        Adds key to the filter
+        '''
+        buckets = self.buckets
+        for bucket in self._buckets(key):
+            if buckets[bucket] < 255:
+                buckets[bucket] += 1
+        self.count += 1
+
+    def remove(self, key):
+        '''
+        Removes a key that was added before
+        '''
+        buckets = self.buckets
+        for bucket in self._buckets(key):
+            if 0 < buckets[bucket] < 255:
+                buckets[bucket] -= 1
+        self.count -= 1
+
+    def __contains__(self, key):
+        buckets = self.buckets
+        return all(buckets[bucket] for bucket in self._buckets(key))
+
+
+class BloomGuard():
+    '''
+    Shared part of the Bloom-filtered collections: the filter,
+    its rebuilds and the lookup counters. false_positives counts
+    lookups the filter let through that the backend then missed
+    '''
+
+    def __init__(self, backend, capacity=None, error_rate=0.01):
+        self.backend = backend
+        self.error_rate = error_rate
+        self.filter = None
+        self.negatives = 0
+        self.false_positives = 0
+        self.rebuild(capacity)
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def rebuild(self, capacity=None):
+        '''
+        Rebuilds the filter from the ids in the backend, sized
+        for capacity ids (by default twice as many as there are)
+        '''
+        keys = list(self.backend.database)
+        capacity = max(capacity or 2 * len(keys), MINIMUM_CAPACITY)
+        self.filter = CountingBloomFilter(capacity, self.error_rate)
+        for key in keys:
+            self.filter.add(key)
+
+    def false_positive_rate(self):
+        '''
+        Share of lookups for missing ids that the filter
+        did not stop
+        '''
+        misses = self.negatives + self.false_positives
+        return self.false_positives / misses if misses else 0.0
+
+    def _grow(self):
+        '''rebuilds the filter once it holds more ids than planned'''
+        if self.filter.count > self.filter.capacity:
+            self.rebuild()
+
+    def _lookup(self, key, fetch):
+        '''returns fetch(key), or None when the filter rules key out'''
+        if key not in self.filter:
+            self.negatives += 1
+            return None
+        record = fetch(key)
+        if record is None:
+            self.false_positives += 1
+        return record
+
+    def _lookup_many(self, keys, fetch_many):
+        '''
+        returns the records of keys in the same order, asking
+        fetch_many only for the keys the filter lets through
+        '''
+        keys = list(keys)
+        passed = [key for key in keys if key in self.filter]
+        self.negatives += len(keys) - len(passed)
+        fetched = dict(zip(passed, fetch_many(passed))) if passed else {}
+        self.false_positives += sum(record is None
+                                    for record in fetched.values())
+        return [fetched.get(key) for key in keys]
+
+    def _merged(self, rows):
+        '''
+        yields rows unchanged, adding their ids to the filter
+        before the backend sees them (a rebuild has to wait until
+        the whole merge is in the backend)
+        '''
+        for row in rows:
+            self.filter.add(row[0])
+            yield row
+
+
+class BloomUserCollection(BloomGuard):
+    '''
+    Bloom filter in front of a UserCollection backend
+    '''
+
+    def get_user(self, user_id):
+        '''
+        Returns the user, or None if it does not exist
+        '''
+        return self._lookup(user_id, self.backend.get_user)
+
+    def search_user(self, user_id):
+        '''
+        Returns the user, or MISSING_USER if it does not exist
+        '''
+        user = self.get_user(user_id)
+        return MISSING_USER if user is None else user
+
+    def search_users_many(self, user_ids):
+        '''
+        Returns the users of user_ids in the same order (None for
+        misses), asking the backend only for possible hits
+        '''
+        return self._lookup_many(user_ids, self.backend.search_users_many)
+
+    def add_user(self, user_id, email, user_name, user_last_name):
+        '''
+        Adds a user through the backend
+        '''
+        result = self.backend.add_user(user_id, email, user_name,
+                                       user_last_name)
+        if result:
+            self.filter.add(user_id)
+            self._grow()
+        return result
+
+    def merge_rows(self, rows):
+        '''
+        Adds many users through the backend
+        '''
+        result = self.backend.merge_rows(self._merged(rows))
+        self._grow()
+        return result
+
+    def delete_user(self, user_id):
+        '''
+        Deletes a user through the backend
+        '''
+        result = self.backend.delete_user(user_id)
+        if result:
+            self.filter.remove(user_id)
+        return result
+
+
+class BloomStatusCollection(BloomGuard):
+    '''
+    Bloom filter in front of a UserStatusCollection backend
+    '''
+
+    def get_status(self, status_id):
+        '''
+        Returns the status, or None if it does not exist
+        '''
+        return self._lookup(status_id, self.backend.get_status)
+
+    def search_status(self, status_id):
+        '''
+        Returns the status, or MISSING_STATUS if it does not exist
+        '''
+        status = self.get_status(status_id)
+        return MISSING_STATUS if status is None else status
+
+    def search_statuses_many(self, status_ids):
+        '''
+        Returns the statuses of status_ids in the same order (None
+        for misses), asking the backend only for possible hits
+        '''
+        return self._lookup_many(status_ids,
+                                 self.backend.search_statuses_many)
+
+    def add_status(self, status_id, user_id, status_text):
+        '''
+        Adds a status through the backend
+        '''
+        result = self.backend.add_status(status_id, user_id, status_text)
+        if result:
+            self.filter.add(status_id)
+            self._grow()
+        return result
+
+    def merge_rows(self, rows):
+        '''
+        Adds many statuses through the backend
+        '''
+        result = self.backend.merge_rows(self._merged(rows))
+        self._grow()
+        return result
+
+    def delete_status(self, status_id):
+        '''
+        Deletes a status through the backend
+        '''
+        result = self.backend.delete_status(status_id)
+        if result:
+            self.filter.remove(status_id)
+        return result
+
+    def delete_statuses_by_user(self, user_id):
+        '''
+        Deletes every status of user_id through the backend
+        '''
+        for status in self.backend.search_statuses_by_user(user_id):
+            self.filter.remove(status.status_id)
+        return self.backend.delete_statuses_by_user(user_id)
@@ -0,0 +1,236 @@
+'''
+Bounded LRU read-through cache in front of a collection backend
+
+CachedUserCollection and CachedStatusCollection wrap any collection
+(dict, columnar, SQLite, ...) and answer repeated lookups of the same
+ids from memory. Only records that exist are cached; every add,
+modify or delete of an id drops it from the cache before the backend
+is changed, so a lookup never returns a stale record. Any other
+attribute (database, merge_rows, ...) is passed to the backend.
+'''
+from collections import OrderedDict
+import sys
+from users import MISSING_USER
+from user_status import MISSING_STATUS
+
+
+def record_size(record):
+    '''
+    Approximate bytes held by a Users / UserStatus record
+    '''
+    return sys.getsizeof(record) + sum(
+        sys.getsizeof(getattr(record, name)) for name in record.__slots__)
+
+
+# the two limits, the entries with their sizes and total, and the counters
+class LRUCache():  # pylint: disable=R0902
+    '''
+    Least-recently-used cache limited to max_entries records
+    and/or max_bytes (estimated with record_size). Counts
+    hits, misses and evictions
+    '''
+
+    def __init__(self, max_entries=10_000, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.sizes = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        '''
+        Returns the cached record for key, or None
+        '''
+        record = self.entries.get(key)
+        if record is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return record
+
+    def put(self, key, record):
+        '''
+        Caches record under key, evicting the least
+        recently used records to stay within the limits
+        '''
+        self.invalidate(key)
+        size = record_size(record) if self.max_bytes is not None else 0
+        self.entries[key] = record
+        self.sizes[key] = size
+        self.bytes += size
+        while self.entries and (
+                (self.max_entries is not None and
+                 len(self.entries) > self.max_entries) or
+                (self.max_bytes is not None and self.bytes > self.max_bytes)):
+            oldest, _ = self.entries.popitem(last=False)
+            self.bytes -= self.sizes.pop(oldest)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        '''
+        Drops key from the cache, if it is there
+        '''
+        if self.entries.pop(key, None) is not None:
+            self.bytes -= self.sizes.pop(key)
+
+    def stats(self):
+        '''
+        Returns the counters as a dict
+        '''
+        return {'entries': len(self.entries), 'bytes': self.bytes,
+                'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions}
+
+
+def read_through_many(lru, ids, fetch_many):
+    '''
+    Returns the records of ids in the same order: cached ones
+    from lru, the rest from one fetch_many call on the backend
+    (records it finds are cached)
+    '''
+    ids = list(ids)
+    records = [lru.get(id_) for id_ in ids]
+    missing = list(dict.fromkeys(id_ for id_, record in zip(ids, records)
+                                 if record is None))
+    if missing:
+        fetched = dict(zip(missing, fetch_many(missing)))
+        for id_, record in fetched.items():
+            if record is not None:
+                lru.put(id_, record)
+        records = [fetched[id_] if record is None else record
+                   for id_, record in zip(ids, records)]
+    return records
+
+
+class CachedUserCollection():
+    '''
+    Read-through cache in front of a UserCollection backend
+    '''
+
+    def __init__(self, backend, max_entries=10_000, max_bytes=None):
+        self.backend = backend
+        self.cache = LRUCache(max_entries, max_bytes)
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def get_user(self, user_id):
+        '''
+        Returns the user, or None if it does not exist
+        '''
+        user = self.cache.get(user_id)
+        if user is None:
+            user = self.backend.get_user(user_id)
+            if user is not None:
+                self.cache.put(user_id, user)
+        return user
+
+    def search_user(self, user_id):
+        '''
+        Returns the user, or MISSING_USER if it does not exist
+        '''
+        user = self.get_user(user_id)
+        return MISSING_USER if user is None else user
+
+    def search_users_many(self, user_ids):
+        '''
+        Returns the users of user_ids in the same order (None for
+        misses), asking the backend once for the uncached ones
+        '''
+        return read_through_many(self.cache, user_ids,
+                                 self.backend.search_users_many)
+
+    def add_user(self, user_id, email, user_name, user_last_name):
+        '''
+        Adds a user through the backend
+        '''
+        self.cache.invalidate(user_id)
+        return self.backend.add_user(user_id, email, user_name,
+                                     user_last_name)
+
+    def modify_user(self, user_id, email, user_name, user_last_name):
+        '''
+        Modifies a user through the backend
+        '''
+        self.cache.invalidate(user_id)
+        return self.backend.modify_user(user_id, email, user_name,
+                                        user_last_name)
+
+    def delete_user(self, user_id):
+        '''
+        Deletes a user through the backend
+        '''
+        self.cache.invalidate(user_id)
+        return self.backend.delete_user(user_id)
+
+
+class CachedStatusCollection():
+    '''
+    Read-through cache in front of a UserStatusCollection backend
+    '''
+
+    def __init__(self, backend, max_entries=10_000, max_bytes=None):
+        self.backend = backend
+        self.cache = LRUCache(max_entries, max_bytes)
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def get_status(self, status_id):
+        '''
+        Returns the status, or None if it does not exist
+        '''
+        status = self.cache.get(status_id)
+        if status is None:
+            status = self.backend.get_status(status_id)
+            if status is not None:
+                self.cache.put(status_id, status)
+        return status
+
+    def search_status(self, status_id):
+        '''
+        Returns the status, or MISSING_STATUS if it does not exist
+        '''
+        status = self.get_status(status_id)
+        return MISSING_STATUS if status is None else status
+
+    def search_statuses_many(self, status_ids):
+        '''
+        Returns the statuses of status_ids in the same order (None
+        for misses), asking the backend once for the uncached ones
+        '''
+        return read_through_many(self.cache, status_ids,
+                                 self.backend.search_statuses_many)
+
+    def add_status(self, status_id, user_id, status_text):
+        '''
+        Adds a status through the backend
+        '''
+        self.cache.invalidate(status_id)
+        return self.backend.add_status(status_id, user_id, status_text)
+
+    def modify_status(self, status_id, user_id, status_text):
+        '''
+        Changes a status through the backend
+        '''
+        self.cache.invalidate(status_id)
+        return self.backend.modify_status(status_id, user_id, status_text)
+
+    def delete_status(self, status_id):
+        '''
+        Deletes a status through the backend
+        '''
+        self.cache.invalidate(status_id)
+        return self.backend.delete_status(status_id)
+
+    def delete_statuses_by_user(self, user_id):
+        '''
+        Deletes every status of user_id through the backend
+        '''
+        for status in self.backend.search_statuses_by_user(user_id):
+            self.cache.invalidate(status.status_id)
+        return self.backend.delete_statuses_by_user(user_id)
@@ -0,0 +1,292 @@
+'''
+A column-oriented UserStatusCollection for very large status sets
+
+Instead of one UserStatus object per status, the statuses are kept in
+parallel columns indexed by row number:
+
+- status_ids: a list of the status_id strings (None marks a
+  deleted row, a tombstone)
+- users: an array('I') of integer codes into a table of user_ids
+- offsets / lengths: arrays locating each status_text inside one
+  contiguous UTF-8 bytearray (the arena)
+
+A dict maps each status_id to its row. UserStatus objects are only
+built when a status is looked up, and are copies: change a status
+with modify_status, not by setting attributes on the copy. Deleted
+rows and replaced texts are reclaimed by compact(), which runs on its
+own once they make up more than half of the storage.
+'''
+from array import array
+from collections.abc import Mapping
+from interning import intern_id
+from merging import add_each
+import text_index
+from user_status import MISSING_STATUS, UserStatus
+
+# compact() runs when more than this share of rows/arena bytes is garbage
+COMPACT_RATIO = 0.5
+# ... and there are at least this many garbage rows or bytes
+COMPACT_MINIMUM = 1024
+
+
+class StatusColumnsView(Mapping):
+    '''
+    Read-only status_id -> UserStatus mapping over the columns, so
+    code written against UserStatusCollection.database keeps working
+    '''
+
+    def __init__(self, collection):
+        self._collection = collection
+
+    def __getitem__(self, status_id):
+        status = self._collection.get_status(status_id)
+        if status is None:
+            raise KeyError(status_id)
+        return status
+
+    def __iter__(self):
+        # rows are visited in insertion order; tombstones are skipped
+        return (status_id for status_id in self._collection.status_ids
+                if status_id is not None)
+
+    def __len__(self):
+        return len(self._collection.rows)
+
+
+# one attribute per column, plus the lookup tables and garbage counts
+class ColumnarStatusCollection():  # pylint: disable=R0902
+    '''
+    Column-oriented replacement for user_status.UserStatusCollection
+    with the same methods and return values
+    '''
+
+    def __init__(self):
+        self.rows = {}
+        self.status_ids = []
+        self.users = array('I')
+        self.offsets = array('Q')
+        self.lengths = array('I')
+        self.arena = bytearray()
+        self.user_ids = []
+        self.user_codes = {}
+        self.user_rows = {}
+        self.dead_rows = 0
+        self.dead_bytes = 0
+
+    @property
+    def database(self):
+        '''a read-only status_id -> UserStatus view of the collection'''
+        return StatusColumnsView(self)
+
+    def _user_code(self, user_id):
+        '''returns the integer code for user_id, adding it if needed'''
+        code = self.user_codes.get(user_id)
+        if code is None:
+            code = len(self.user_ids)
+            user_id = intern_id(user_id)
+            self.user_ids.append(user_id)
+            self.user_codes[user_id] = code
+        return code
+
+    def _store_text(self, status_text):
+        '''appends status_text to the arena, returns (offset, length)'''
+        encoded = status_text.encode('utf-8')
+        offset = len(self.arena)
+        self.arena += encoded
+        return offset, len(encoded)
+
+    def _text(self, row):
+        '''decodes the status_text of row from the arena'''
+        offset = self.offsets[row]
+        return self.arena[offset:offset + self.lengths[row]].decode('utf-8')
+
+    def _view(self, row):
+        '''builds a UserStatus copy of row'''
+        return UserStatus(self.status_ids[row],
+                          self.user_ids[self.users[row]], self._text(row))
+
+    def add_status(self, status_id, user_id, status_text):
+        '''
+        Adds a status, returns False if status_id already exists
+        '''
+        if status_id in self.rows:
+            return False
+        code = self._user_code(user_id)
+        offset, length = self._store_text(status_text)
+
+        row = len(self.status_ids)
+        self.status_ids.append(status_id)
+        self.users.append(code)
+        self.offsets.append(offset)
+        self.lengths.append(length)
+        self.rows[status_id] = row
+        self.user_rows.setdefault(code, {})[status_id] = None
+        return True
+
+    def merge_rows(self, rows):
+        '''
+        Adds many (status_id, user_id, status_text) rows at once,
+        skipping status_ids that already exist.
+        Returns a tuple (inserted, skipped)
+        '''
+        return add_each(self.add_status, rows)
+
+    def modify_status(self, status_id, user_id, status_text):
+        '''
+        Changes a status, returns False if status_id does not exist.
+        The new text is appended to the arena; the old bytes are
+        reclaimed on the next compaction
+        '''
+        row = self.rows.get(status_id)
+        if row is None:
+            return False
+        code = self._user_code(user_id)
+        old_code = self.users[row]
+        if code != old_code:
+            self._unlink_user_row(old_code, status_id)
+            self.user_rows.setdefault(code, {})[status_id] = None
+            self.users[row] = code
+
+        self.dead_bytes += self.lengths[row]
+        self.offsets[row], self.lengths[row] = self._store_text(status_text)
+        self._maybe_compact()
+        return True
+
+    def _unlink_user_row(self, code, status_id):
+        '''removes status_id from the user_rows entry of code'''
+        status_ids = self.user_rows[code]
+        del status_ids[status_id]
+        if not status_ids:
+            del self.user_rows[code]
+
+    def _bury(self, status_id):
+        '''turns the row of status_id into a tombstone'''
+        row = self.rows.pop(status_id)
+        self.status_ids[row] = None
+        self.dead_rows += 1
+        self.dead_bytes += self.lengths[row]
+
+    def delete_status(self, status_id):
+        '''
+        Deletes a status, returns False if status_id does not exist
+        '''
+        row = self.rows.get(status_id)
+        if row is None:
+            return False
+        self._unlink_user_row(self.users[row], status_id)
+        self._bury(status_id)
+        self._maybe_compact()
+        return True
+
+    def delete_statuses_by_user(self, user_id):
+        '''
+        Deletes every status of user_id in O(k),
+        returns how many were deleted
+        '''
+        code = self.user_codes.get(user_id)
+        status_ids = self.user_rows.pop(code, {})
+        for status_id in status_ids:
+            self._bury(status_id)
+        self._maybe_compact()
+        return len(status_ids)
+
+    def search_status(self, status_id):
+        '''
+        Returns a UserStatus copy of the status,
+        or MISSING_STATUS if it does not exist
+        '''
+        row = self.rows.get(status_id)
+        if row is None:
+            return MISSING_STATUS
+        return self._view(row)
+
+    def get_status(self, status_id):
+        '''
+        Returns a UserStatus copy of the status,
+        or None if it does not exist
+        '''
+        row = self.rows.get(status_id)
+        if row is None:
+            return None
+        return self._view(row)
+
+    def search_statuses_many(self, status_ids):
+        '''
+        Returns UserStatus copies of the statuses of status_ids in
+        the same order, with None for each one that does not exist
+        '''
+        get = self.rows.get
+        view = self._view
+        return [None if row is None else view(row)
+                for row in map(get, status_ids)]
+
+    def search_statuses_by_text(self, query, match_all=True, ranked=False):
+        '''
+        Returns UserStatus copies of the statuses whose text matches
+        query (see text_index.scan; every row is read)
+        '''
+        status_ids = text_index.scan(
+            ((status_id, self._text(row))
+             for status_id, row in self.rows.items()),
+            query, match_all, ranked)
+        return [self._view(self.rows[status_id]) for status_id in status_ids]
+
+    def search_statuses_by_user(self, user_id):
+        '''
+        Returns UserStatus copies of the statuses of user_id,
+        oldest first, in O(k)
+        '''
+        status_ids = self.user_rows.get(self.user_codes.get(user_id), ())
+        return [self._view(self.rows[status_id]) for status_id in status_ids]
+
+    def _maybe_compact(self):
+        '''compacts once garbage passes COMPACT_RATIO of the storage'''
+        too_many_rows = (self.dead_rows >= COMPACT_MINIMUM and self.dead_rows
+                         > COMPACT_RATIO * len(self.status_ids))
+        too_many_bytes = (self.dead_bytes >= COMPACT_MINIMUM and
+                          self.dead_bytes > COMPACT_RATIO * len(self.arena))
+        if too_many_rows or too_many_bytes:
+            self.compact()
+
+    def compact(self):
+        '''
+        Rewrites the columns without tombstones, replaced texts or
+        unused user_ids. Row numbers change; status_ids do not
+        '''
+        status_ids = []
+        users = array('I')
+        offsets = array('Q')
+        lengths = array('I')
+        arena = bytearray()
+        user_ids = []
+        user_codes = {}
+
+        for row, status_id in enumerate(self.status_ids):
+            if status_id is None:
+                continue
+            user_id = self.user_ids[self.users[row]]
+            code = user_codes.get(user_id)
+            if code is None:
+                code = len(user_ids)
+                user_ids.append(user_id)
+                user_codes[user_id] = code
+            offset = self.offsets[row]
+            self.rows[status_id] = len(status_ids)
+            status_ids.append(status_id)
+            users.append(code)
+            offsets.append(len(arena))
+            lengths.append(self.lengths[row])
+            arena += self.arena[offset:offset + self.lengths[row]]
+
+        # codes changed, so re-key user_rows keeping each user's order
+        self.user_rows = {user_codes[self.user_ids[code]]: status_rows
+                          for code, status_rows in self.user_rows.items()}
+        self.status_ids = status_ids
+        self.users = users
+        self.offsets = offsets
+        self.lengths = lengths
+        self.arena = arena
+        self.user_ids = user_ids
+        self.user_codes = user_codes
+        self.dead_rows = 0
+        self.dead_bytes = 0
@@ -0,0 +1,239 @@
+'''
+Thread-safe UserCollection / UserStatusCollection for threaded servers
+
+The plain collections check and then act (is the id there? then insert
+it), which races when two threads change the same id. The collections
+here guard every change with lock striping: STRIPES locks, and each id
+(user_id or status_id) maps to one of them by its hash. A change holds
+the stripes of every id it touches, acquired in stripe order so two
+changes can never wait on each other. Changes to ids in different
+stripes run side by side.
+
+Reads take no lock. Every change is a single dict store of a new record
+(copy-on-write; records are never changed in place), so a search sees
+either the old or the new record, never half of an update. Because of
+that, records returned by a search do not follow later changes: search
+again to see them.
+'''
+import threading
+from interning import intern_id
+import prefix_index
+import text_index
+from users import UserCollection, Users, email_key
+from user_status import UserStatus, UserStatusCollection
+
+STRIPES = 64
+
+
+class StripedLocks():  # pylint: disable=R0903
+    '''
+    STRIPES locks shared by the keys that hash onto them
+    '''
+
+    def __init__(self, stripes=STRIPES):
+        self.locks = [threading.Lock() for _ in range(stripes)]
+
+    def __call__(self, *keys):
+        '''
+        Returns a context manager holding the stripes of keys
+        (each once, in order)
+        '''
+        count = len(self.locks)
+        if len(keys) == 1:
+            # the common case: one plain Lock, no extra wrapping
+            return self.locks[hash(keys[0]) % count]
+        stripes = sorted({hash(key) % count for key in keys})
+        if len(stripes) == 1:
+            return self.locks[stripes[0]]
+        return HeldStripes([self.locks[stripe] for stripe in stripes])
+
+
+class HeldStripes():
+    '''
+    Context manager holding several stripe locks, taken in
+    the given order and released in reverse
+    '''
+
+    def __init__(self, locks):
+        self.locks = locks
+
+    def __enter__(self):
+        for lock in self.locks:
+            lock.acquire()
+
+    def __exit__(self, *exc_info):
+        for lock in reversed(self.locks):
+            lock.release()
+
+
+class LockedRecord():
+    '''
+    Context manager holding the stripes of key, of owner(record)
+    for its current record and of extra keys, retrying if the
+    record is replaced while it waits. Enters as the record
+    (None if key is not in table)
+    '''
+
+    def __init__(self, locked, table, key, owner, *extra):
+        self.locked = locked
+        self.table = table
+        self.key = key
+        self.owner = owner
+        self.extra = extra
+        self.held = None
+
+    def __enter__(self):
+        while True:
+            record = self.table.get(self.key)
+            owner = () if record is None else (self.owner(record),)
+            held = self.locked(self.key, *owner, *self.extra)
+            held.__enter__()
+            if self.table.get(self.key) is record:
+                self.held = held
+                return record
+            held.__exit__(None, None, None)
+
+    def __exit__(self, *exc_info):
+        self.held.__exit__(*exc_info)
+
+
+class ConcurrentUserCollection(UserCollection):
+    '''
+    UserCollection that can be shared between threads.
+    A change to a user also holds the stripes of the
+    email_keys it touches, which guard email_index
+    '''
+
+    def __init__(self, stripes=STRIPES, prefix_search=False):
+        super().__init__(prefix_search)
+        self._locked = StripedLocks(stripes)
+        if self.prefix_index is not None:
+            # names are shared between users in every stripe
+            self.prefix_index.lock = threading.Lock()
+
+    def _locked_user(self, user_id, *email_keys):
+        '''holds user_id with its current email_key and email_keys'''
+        return LockedRecord(self._locked, self._database, user_id,
+                            lambda user: email_key(user.email), *email_keys)
+
+    def add_user(self, user_id, email, user_name, user_last_name):
+        '''
+        Adds a new user to the collection
+        '''
+        with self._locked(user_id, email_key(email)):
+            return super().add_user(user_id, email, user_name,
+                                    user_last_name)
+
+    def modify_user(self, user_id, email, user_name, user_last_name):
+        '''
+        Modifies an existing user (the record is replaced)
+        '''
+        with self._locked_user(user_id, email_key(email)) as user:
+            if user is None or self.email_taken(email, user_id):
+                return False
+            self._reindex_email(user.user_id, user.email, email)
+            self._reindex_names(user, user_name, user_last_name)
+            self._database[user.user_id] = Users(user.user_id, email,
+                                                 user_name, user_last_name)
+            return True
+
+    def delete_user(self, user_id):
+        '''
+        Deletes an existing user
+        '''
+        with self._locked_user(user_id):
+            return super().delete_user(user_id)
+
+    def search_users_by_prefix(self, prefix, limit=10):
+        '''
+        Returns up to limit users with a name starting with
+        prefix (users deleted since the index was searched
+        are left out). Without prefix_search every user
+        is compared
+        '''
+        if self.prefix_index is None:
+            # a copy of the users, which other threads may change
+            return prefix_index.scan(list(self._database.values()), prefix,
+                                     limit)
+        get = self._database.get
+        return [user for user in map(get, self.prefix_index.search(prefix,
+                                                                   limit))
+                if user is not None]
+
+
+class ConcurrentStatusCollection(UserStatusCollection):
+    '''
+    UserStatusCollection that can be shared between threads.
+    A change to a status also holds the stripe of its user_id(s),
+    which guards that user's entry in user_index
+    '''
+
+    def __init__(self, stripes=STRIPES, text_search=False):
+        self._locked = StripedLocks(stripes)
+        super().__init__(text_search)
+        if self.text_index is not None:
+            # terms are shared between statuses in every stripe
+            self.text_index.lock = threading.Lock()
+
+    def _locked_status(self, status_id, *user_ids):
+        '''holds status_id with its current user_id and user_ids'''
+        return LockedRecord(self._locked, self._database, status_id,
+                            lambda status: status.user_id, *user_ids)
+
+    def add_status(self, status_id, user_id, status_text):
+        '''This adds a status to the database.'''
+        with self._locked(status_id, user_id):
+            return super().add_status(status_id, user_id, status_text)
+
+    def modify_status(self, status_id, user_id, status_text):
+        '''This changes a status (the record is replaced).'''
+        user_id = intern_id(user_id)
+        with self._locked_status(status_id, user_id) as status:
+            if status is None:
+                return False
+            self._reindex(status, user_id, status_text)
+            self._database[status_id] = UserStatus(status_id, user_id,
+                                                   status_text)
+            return True
+
+    def delete_status(self, status_id):
+        '''This deletes a status.'''
+        with self._locked_status(status_id) as status:
+            if status is None:
+                return False
+            return super().delete_status(status_id)
+
+    def delete_statuses_by_user(self, user_id):
+        '''This deletes every status of user_id, holding the stripes of
+        the user and of each status. Returns how many were deleted.'''
+        while True:
+            status_ids = list(self.user_index.get(user_id, ()))
+            with self._locked(user_id, *status_ids):
+                # nothing can join or leave the user's statuses now
+                if list(self.user_index.get(user_id, ())) == status_ids:
+                    return super().delete_statuses_by_user(user_id)
+
+    def search_statuses_by_user(self, user_id):
+        '''This returns the statuses of user_id, oldest first, without
+        taking a lock (statuses deleted or moved meanwhile are left
+        out).'''
+        status_ids = list(self.user_index.get(user_id, ()))
+        get = self._database.get
+        return [status for status in map(get, status_ids)
+                if status is not None and status.user_id == user_id]
+
+    def search_statuses_by_text(self, query, match_all=True, ranked=False):
+        '''This returns the statuses whose text matches query (statuses
+        deleted since the index was searched are left out). Without
+        text_search every status is scanned.'''
+        if self.text_index is None:
+            # a copy of the items, which other threads may change
+            status_ids = text_index.scan(
+                ((status_id, status.status_text)
+                 for status_id, status in list(self._database.items())),
+                query, match_all, ranked)
+        else:
+            status_ids = self.text_index.search(query, match_all, ranked)
+        get = self._database.get
+        return [status for status in map(get, status_ids)
+                if status is not None]
@@ -0,0 +1,19 @@
+'''
+Shared id interning for the social network collections
+
+user_ids appear as keys in UserCollection and again on every
+UserStatus of that user, and each CSV row parses them into a new
+string. Passing ids through intern_id makes every collection hold
+the one copy kept in the interpreter's intern table.
+'''
+import sys
+
+
+def intern_id(value):
+    '''
+    Returns the shared copy of a string id
+    (values that are not strings are returned unchanged)
+    '''
+    if isinstance(value, str):
+        return sys.intern(value)
+    return value
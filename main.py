@@ -1,30 +1,314 @@
 ''' This module contains the main public functions for the program'''
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import collections
+import contextlib
 import csv
+import io
+import itertools
+import mmap
+import os
+import re
+import threading
+import time
+import columnar_status
+import concurrent_collections
+import oplog as operation_log
+import snapshot
+import sqlite_backend
 import users
 import user_status
 
+USER_HEADER = ('USER_ID', 'EMAIL', 'NAME', 'LASTNAME')
+STATUS_HEADER = ('STATUS_ID', 'USER_ID', 'STATUS_TEXT')
+SAVE_CHUNK_ROWS = 1000
+# parallel loads hand each worker process about this many bytes at a time
+PARALLEL_CHUNK_BYTES = 32 * 2 ** 20
+# csv.reader's quoting rules (quotechar |) as regular expressions, for
+# text outside quotes: a | opens a quoted field only at the start of a
+# field (after a delimiter or newline), || inside one is a literal |,
+# and any other | is an ordinary character. Unclosed quotes run to the
+# end of the data
+CSV_QUOTED = rb'\|(?:[^|]++|\|\|)*+'
+CSV_LITERAL_PIPE = rb'(?<![,\n\r])\|'
+# text whose quoted fields all close
+CSV_CLOSED = re.compile(rb'(?:[^|]++|' + CSV_LITERAL_PIPE + rb'|' +
+                        CSV_QUOTED + rb'\|)*+')
+# the rest of a row, through its newline
+CSV_ROW_REST = re.compile(rb'(?:[^|\n\r]++|' + CSV_LITERAL_PIPE + rb'|' +
+                          CSV_QUOTED + rb'(?:\||\Z))*+(?:\r\n|\n|\r)?')
+
+# background saves run one at a time, in submission order
+SAVE_EXECUTOR = ThreadPoolExecutor(max_workers=1)
+
+
+class LoadReport():  # pylint: disable=R0903
+    '''
+    Statistics for a single load_users or
+    load_status_updates call
+    '''
+
+    def __init__(self):
+        self.rows_read = 0
+        self.inserted = 0
+        self.skipped = 0
+        self.rejected = 0
+        self.bytes_read = 0
+        self.elapsed = 0.0
+
 
-def init_user_collection():
+def init_user_collection(backend='memory', filename=None,
+                         prefix_search=False):
     '''
     Creates and returns a new instance
     of UserCollection
+
+    Requirements:
+    - backend 'memory' (the default) keeps the
+    users in a dict; 'concurrent' in a dict that
+    can be shared between threads (see
+    concurrent_collections); 'sqlite' stores them
+    in the SQLite database filename (in memory if
+    None).
+    - With prefix_search, the 'memory' and
+    'concurrent' backends keep a name index for
+    search_users_by_prefix (see prefix_index;
+    'sqlite' always has one, in the database).
+    - Raises ValueError for any other backend.
     '''
-    collection = users.UserCollection()
+    if backend == 'memory':
+        collection = users.UserCollection(prefix_search)
+    elif backend == 'concurrent':
+        collection = concurrent_collections.ConcurrentUserCollection(
+            prefix_search=prefix_search)
+    elif backend == 'sqlite':
+        connection = sqlite_backend.connect(filename or ':memory:')
+        collection = sqlite_backend.SQLiteUserCollection(connection)
+    else:
+        raise ValueError(f'unknown backend {backend!r}')
 
     return collection
 
 
-def init_status_collection():
+def init_status_collection(backend='memory', filename=None,
+                           text_search=False):
     '''
     Creates and returns a new instance
     of UserStatusCollection
+
+    Requirements:
+    - backend 'memory' (the default) keeps the
+    statuses in a dict, 'concurrent' in a dict
+    that can be shared between threads (see
+    concurrent_collections), 'columnar' in arrays
+    (see columnar_status), and 'sqlite' in the
+    SQLite database filename (in memory if None).
+    - With text_search, the 'memory' and 'concurrent'
+    backends keep a full-text index for
+    search_statuses_by_text (the others scan).
+    - Raises ValueError for any other backend.
     '''
-    stati = user_status.UserStatusCollection()
+    if backend == 'memory':
+        stati = user_status.UserStatusCollection(text_search)
+    elif backend == 'concurrent':
+        stati = concurrent_collections.ConcurrentStatusCollection(
+            text_search=text_search)
+    elif backend == 'columnar':
+        stati = columnar_status.ColumnarStatusCollection()
+    elif backend == 'sqlite':
+        connection = sqlite_backend.connect(filename or ':memory:')
+        stati = sqlite_backend.SQLiteStatusCollection(connection)
+    else:
+        raise ValueError(f'unknown backend {backend!r}')
 
     return stati
 
 
-def load_users(filename, user_collection):
+def check_header(row, header):
+    '''
+    Checks the first row of a CSV file against
+    the expected header (case and surrounding
+    spaces are ignored)
+
+    Requirements:
+    - Returns False if row is None (empty file)
+    or does not match header.
+    - Otherwise, it returns True.
+    '''
+    if row is None:
+        return False
+
+    return tuple(field.strip().upper() for field in row) == header
+
+
+def count_bytes(lines, report):
+    '''
+    Yields the lines of a text file unchanged,
+    adding their UTF-8 size to report.bytes_read
+    '''
+    for line in lines:
+        report.bytes_read += len(line.encode('utf-8'))
+        yield line
+
+
+def well_formed_rows(rows, width, report):
+    '''
+    Yields the CSV rows that have exactly width
+    fields. Every row is counted in report.rows_read,
+    and the others in report.rejected
+    '''
+    for row in rows:
+        report.rows_read += 1
+        if len(row) == width:
+            yield row
+        else:
+            report.rejected += 1
+
+
+def load_csv(filename, collection, header, report=None):
+    '''
+    Streams the rows of a CSV file into
+    collection.merge_rows
+
+    Requirements:
+    - Returns False if the header does not match
+    or any row has the wrong number of fields
+    (the other rows are still loaded).
+    - Otherwise, it returns True.
+    - If report (a LoadReport) is given, it is
+    filled in with the statistics of the load.
+    '''
+    track_bytes = report is not None
+    if report is None:
+        report = LoadReport()
+
+    started = time.perf_counter()
+    with open(filename, 'r', newline='') as csvfile:
+        lines = count_bytes(csvfile, report) if track_bytes else csvfile
+        filereader = csv.reader(lines, delimiter=',', quotechar='|')
+        header_ok = check_header(next(filereader, None), header)
+        if header_ok:
+            # rows go straight into the collection, one at a time
+            rows = well_formed_rows(filereader, len(header), report)
+            report.inserted, report.skipped = collection.merge_rows(rows)
+    report.elapsed = time.perf_counter() - started
+
+    return header_ok and report.rejected == 0
+
+
+def csv_chunk_bounds(filename, chunks):
+    '''
+    Splits the rows after the header line of a CSV
+    file into about chunks byte ranges, each starting
+    right after a newline that ends a row. Returns the
+    list of boundaries [first row, ..., file size]
+
+    A field quoted with | may hold newlines, so the
+    text from the previous boundary to each split point
+    is read with csv.reader's quoting rules (CSV_CLOSED).
+    Where that stops (the split point, or the start of
+    a quoted field running past it) is outside quotes,
+    and the row there is finished with CSV_ROW_REST
+    '''
+    size = os.path.getsize(filename)
+    with open(filename, 'rb') as file:
+        file.readline()
+        bounds = [file.tell()]
+        if size > bounds[0]:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) \
+                    as data:
+                for number in range(1, chunks):
+                    position = bounds[0] + (size - bounds[0]) * number // \
+                        chunks
+                    # a | just before the split could be half of a ||
+                    while position < size and data[position - 1] == 124:
+                        position += 1
+                    if position <= bounds[-1]:
+                        # the last row ran past this position
+                        continue
+                    start = CSV_CLOSED.match(data, bounds[-1],
+                                             position).end()
+                    end = CSV_ROW_REST.match(data, start).end()
+                    if bounds[-1] < end < size:
+                        bounds.append(end)
+    bounds.append(size)
+
+    return bounds
+
+
+def parse_csv_chunk(filename, start, end):
+    '''
+    Parses the CSV rows between byte offsets start
+    and end of filename (runs in a worker process)
+    '''
+    with open(filename, 'rb') as file:
+        file.seek(start)
+        text = file.read(end - start).decode('utf-8')
+
+    return list(csv.reader(io.StringIO(text, newline=''), delimiter=',',
+                           quotechar='|'))
+
+
+def merge_chunk(rows, collection, header, report):
+    '''
+    Merges the parsed rows of one chunk into
+    collection, adding the counts to report
+    '''
+    inserted, skipped = collection.merge_rows(
+        well_formed_rows(rows, len(header), report))
+    report.inserted += inserted
+    report.skipped += skipped
+
+
+def parse_parallel(filename, bounds, workers):
+    '''
+    Parses the chunks of filename between bounds on workers
+    processes, yielding the rows of each chunk in file order
+    '''
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # keep two chunks per worker in flight to bound memory
+        pending = collections.deque()
+        for start, end in zip(bounds, bounds[1:]):
+            pending.append(executor.submit(parse_csv_chunk, filename,
+                                           start, end))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def load_csv_parallel(filename, collection, header, workers, report=None):
+    '''
+    Like load_csv, but the rows are parsed by worker
+    processes, PARALLEL_CHUNK_BYTES at a time. Chunks
+    are merged into collection in file order, so the
+    first occurrence of an id still wins
+
+    Requirements:
+    - Fields quoted with | may contain newlines
+    (see csv_chunk_bounds).
+    - Same return values as load_csv.
+    '''
+    if report is None:
+        report = LoadReport()
+
+    started = time.perf_counter()
+    with open(filename, 'r', newline='') as csvfile:
+        first_line = csvfile.readline()
+    header_ok = check_header(next(csv.reader([first_line], delimiter=',',
+                                             quotechar='|'), None), header)
+    if header_ok:
+        size = os.path.getsize(filename)
+        bounds = csv_chunk_bounds(filename,
+                                  max(workers, size // PARALLEL_CHUNK_BYTES))
+        report.bytes_read = size
+        for rows in parse_parallel(filename, bounds, workers):
+            merge_chunk(rows, collection, header, report)
+    report.elapsed = time.perf_counter() - started
+
+    return header_ok and report.rejected == 0
+
+
+def load_users(filename, user_collection, report=None):
     '''
     Opens a CSV file with user data and
     adds it to an existing instance of
@@ -34,40 +318,142 @@ def load_users(filename, user_collection):
     - If a user_id already exists, it
     will ignore it and continue to the
     next.
+    - Likewise, a row whose email (in any
+    case) another user already has is
+    skipped.
+    - Rows are read and added one at a time,
+    so memory use does not grow with the file.
     - Returns False if there are any errors
-    (such as empty fields in the source CSV file)
+    (such as empty fields in the source CSV file
+    or a missing header)
     - Otherwise, it returns True.
+    - If report (a LoadReport) is given, it is
+    filled in with the statistics of the load.
     '''
-    # read file
-    accounts = []
-    with open(filename, 'r', newline='') as csvfile:
-        filereader = csv.reader(csvfile, delimiter=',', quotechar='|')
-        for row in filereader:
-            accounts.append(row)
-    accounts = accounts[1:]
+    return load_csv(filename, user_collection, USER_HEADER, report)
+
+
+def flush_chunk(csvfile, buffer, separator):
+    '''
+    Writes the rows held in buffer to csvfile and
+    empties it. The newline after the last row is held
+    back and returned as the separator for the next chunk,
+    so the file does not end with a newline
+    '''
+    text = buffer.getvalue()
+    if not text:
+        return separator
+
+    csvfile.write(separator + text[:-1])
+    buffer.seek(0)
+    buffer.truncate()
 
+    return '\n'
+
+
+def write_csv(csvfile, header, rows, chunk_rows=SAVE_CHUNK_ROWS):
+    '''
+    Writes header and rows to an open text file
+    through csv.writer, chunk_rows rows at a time,
+    so only one chunk is ever held in memory
+    '''
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter=',', quotechar='|',
+                        lineterminator='\n')
+    separator = ''
+
+    writer.writerow(header)
+    for count, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if count % chunk_rows == 0:
+            separator = flush_chunk(csvfile, buffer, separator)
+    flush_chunk(csvfile, buffer, separator)
+
+
+def fsync_directory(directory):
+    '''
+    Flushes a directory entry to disk so a rename
+    inside it survives a crash (where the OS allows it)
+    '''
+    try:
+        descriptor = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(descriptor)
+    except OSError:
+        pass
+    finally:
+        os.close(descriptor)
+
+
+@contextlib.contextmanager
+def atomic_file(filename, mode='w'):
+    '''
+    Opens a temporary file in the same directory as
+    filename for writing. When the with block ends the
+    file is fsynced and renamed over filename, so filename
+    always holds either the old or the new complete file.
+    On an error the temporary file is removed
+    '''
+    temp_name = f'{filename}.{os.getpid()}.{threading.get_ident()}.tmp'
     try:
-        # pass data to user collection
-        ref_list = []  # ref_list will be a list of user_ids
-        for user_id, _ in user_collection.database.items():
-            ref_list.append(user_id)
-
-        # check for existing users
-        new_accounts = []
-        for row in accounts:
-            if row[0] not in ref_list:
-                new_accounts.append(row)
-
-        # pass new accounts to user collection
-        for account in new_accounts:
-            user_collection.add_user(*account)
-    except TypeError:
+        with open(temp_name, mode.replace('w', 'x')) as file:
+            yield file
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_name, filename)
+    except BaseException:
+        if os.path.exists(temp_name):
+            os.remove(temp_name)
+        raise
+    fsync_directory(os.path.dirname(os.path.abspath(filename)))
+
+
+def write_atomic(filename, header, rows, chunk_rows=SAVE_CHUNK_ROWS):
+    '''
+    Writes a CSV file through atomic_file
+    '''
+    with atomic_file(filename) as csvfile:
+        write_csv(csvfile, header, rows, chunk_rows)
+
+
+def save_rows(filename, header, rows, chunk_rows=SAVE_CHUNK_ROWS,
+              atomic=False):
+    '''
+    Saves header and rows into a CSV file
+
+    Requirements:
+    - If atomic is True, the file is replaced
+    in one step (see write_atomic).
+    - Returns False if there are any errors
+    (such an invalid filename).
+    - Otherwise, it returns True.
+    '''
+    try:
+        if atomic:
+            write_atomic(filename, header, rows, chunk_rows)
+        else:
+            with open(filename, 'w') as csvfile:
+                write_csv(csvfile, header, rows, chunk_rows)
+    except OSError:
         return False
 
     return True
 
 
-def save_users(filename, user_collection):
+def user_rows(user_collection):
+    '''
+    Yields one (user_id, email, user_name, user_last_name)
+    row for each user in user_collection
+    '''
+    for user_id, user_obj in user_collection.database.items():
+        yield (user_id, user_obj.email, user_obj.user_name,
+               user_obj.user_last_name)
+
+
+def save_users(filename, user_collection, chunk_rows=SAVE_CHUNK_ROWS,
+               atomic=False):
     '''
     Saves all users in user_collection into
     a CSV file
@@ -75,31 +461,38 @@ def save_users(filename, user_collection):
     Requirements:
     - If there is an existing file, it will
     overwrite it.
+    - Rows are written chunk_rows at a time, so
+    memory use does not grow with the collection.
+    - If atomic is True, a crash during the save
+    leaves the previous file untouched.
     - Returns False if there are any errors
     (such an invalid filename).
     - Otherwise, it returns True.
     '''
-    # create CSV strings
-    lines = ['USER_ID,EMAIL,NAME,LASTNAME']
-    for user_id, user_obj in user_collection.database.items():
-        email = user_obj.email
-        user_name = user_obj.user_name
-        user_last_name = user_obj.user_last_name
+    return save_rows(filename, USER_HEADER, user_rows(user_collection),
+                     chunk_rows, atomic)
 
-        line = f'{user_id},{email},{user_name},{user_last_name}'
-        lines.append(line)
-    text = '\n'.join(lines)
 
-    try:
-        with open(filename, 'w') as csvfile:
-            csvfile.write(text)
-    except OSError:
-        return False
+def save_users_in_background(filename, user_collection,
+                             chunk_rows=SAVE_CHUNK_ROWS):
+    '''
+    Takes a point-in-time copy of the users in
+    user_collection and saves it atomically on
+    a background thread, so writers are only held
+    up while the copy is made
 
-    return True
+    Requirements:
+    - Returns a Future whose result() is the
+    save_users result (True or False).
+    '''
+    rows = list(user_rows(user_collection))
+
+    return SAVE_EXECUTOR.submit(save_rows, filename, USER_HEADER, rows,
+                                chunk_rows, True)
 
 
-def load_status_updates(filename, status_collection):
+def load_status_updates(filename, status_collection, report=None,
+                        workers=1):
     '''
     Opens a CSV file with status data and
     adds it to an existing instance of
@@ -109,45 +502,35 @@ def load_status_updates(filename, status_collection):
     - If a status_id already exists, it
     will ignore it and continue to the
     next.
+    - Rows are read and added one at a time,
+    so memory use does not grow with the file.
     - Returns False if there are any errors
-    (such as empty fields in the source CSV file)
+    (such as empty fields in the source CSV file
+    or a missing header)
     - Otherwise, it returns True.
+    - If report (a LoadReport) is given, it is
+    filled in with the statistics of the load.
+    - With workers > 1 the file is parsed by that
+    many processes (see load_csv_parallel).
     '''
+    if workers > 1:
+        return load_csv_parallel(filename, status_collection, STATUS_HEADER,
+                                 workers, report)
 
-    # read file
-    stati = []
-    with open(filename, newline='') as csvfile:
-        filereader = csv.reader(csvfile, delimiter=',', quotechar='|')
-        for row in filereader:
-            stati.append(row)
-    stati = stati[1:]  # delete header
+    return load_csv(filename, status_collection, STATUS_HEADER, report)
 
-    try:
-        # pass data to user collection
-        ref_list = []  # ref_list will be a list of user_ids
-        for status_id, _ in status_collection.database.items():
-            ref_list.append(status_id)
-        print(ref_list)
-
-        # check for existing users
-        new_stati = []
-        for row in stati:
-            if row[0] not in ref_list:
-                new_stati.append(row)
-        print(new_stati)
-
-        # pass new accounts to user collection
-        for status_details in new_stati:
-            status_collection.add_status(*status_details)
-    except TypeError:
-        return False
-    except IndexError:
-        return False
 
-    return True
+def status_rows(status_collection):
+    '''
+    Yields one (status_id, user_id, status_text)
+    row for each status in status_collection
+    '''
+    for status_id, status_obj in status_collection.database.items():
+        yield (status_id, status_obj.user_id, status_obj.status_text)
 
 
-def save_status_updates(filename, status_collection):
+def save_status_updates(filename, status_collection,
+                        chunk_rows=SAVE_CHUNK_ROWS, atomic=False):
     '''
     Saves all statuses in status_collection into
     a CSV file
@@ -155,75 +538,211 @@ def save_status_updates(filename, status_collection):
     Requirements:
     - If there is an existing file, it will
     overwrite it.
+    - Rows are written chunk_rows at a time, so
+    memory use does not grow with the collection.
+    - If atomic is True, a crash during the save
+    leaves the previous file untouched.
     - Returns False if there are any errors
     (such an invalid filename).
     - Otherwise, it returns True.
     '''
-    # create CSV strings
-    lines = ['STATUS_ID,USER_ID,STATUS_TEXT']
-    for status_id, status_obj in status_collection.database.items():
-        user_id = status_obj.user_id
-        status_text = status_obj.status_text
+    return save_rows(filename, STATUS_HEADER,
+                     status_rows(status_collection), chunk_rows, atomic)
+
+
+def save_status_updates_in_background(filename, status_collection,
+                                      chunk_rows=SAVE_CHUNK_ROWS):
+    '''
+    Takes a point-in-time copy of the statuses in
+    status_collection and saves it atomically on
+    a background thread, so writers are only held
+    up while the copy is made
+
+    Requirements:
+    - Returns a Future whose result() is the
+    save_status_updates result (True or False).
+    '''
+    rows = list(status_rows(status_collection))
+
+    return SAVE_EXECUTOR.submit(save_rows, filename, STATUS_HEADER, rows,
+                                chunk_rows, True)
 
-        line = f'{status_id},{user_id},{status_text}'
-        lines.append(line)
-    text = '\n'.join(lines)
 
+def save_snapshot(filename, user_collection, status_collection):
+    '''
+    Saves all users and statuses into one binary
+    snapshot file (see the snapshot module), written
+    atomically
+
+    Requirements:
+    - Returns False if there are any errors
+    (such an invalid filename).
+    - Otherwise, it returns True.
+    '''
+    users_count = len(user_collection.database)
+    statuses_count = len(status_collection.database)
+    rows = itertools.chain(user_rows(user_collection),
+                           status_rows(status_collection))
     try:
-        with open(filename, 'w') as csvfile:
-            csvfile.write(text)
-    except OSError:
+        with atomic_file(filename, 'wb') as file:
+            snapshot.write(file, users_count, statuses_count, rows)
+    except (OSError, ValueError):
         return False
 
     return True
 
 
-def add_user(user_id, email, user_name, user_last_name, user_collection):
+def load_snapshot(filename, user_collection, status_collection):
+    '''
+    Memory-maps a snapshot written by save_snapshot and
+    adds its users and statuses to the collections,
+    without any CSV parsing
+
+    Requirements:
+    - Existing user_ids and status_ids are kept.
+    - Returns False if the file is not a complete
+    snapshot.
+    - Otherwise, it returns True.
+    '''
+    return snapshot.load(filename, user_collection, status_collection)
+
+
+def log_operation(oplog, result, code, *arguments):
+    '''
+    Appends a record to oplog (an oplog.OperationLog)
+    if there is one and the operation succeeded
+    '''
+    if oplog is not None and result:
+        oplog.append(code, *arguments)
+
+
+# six parameters: the four user fields, then the collection and the
+# oplog that every operation here takes
+def add_user(  # pylint: disable=R0913,R0917
+        user_id, email, user_name, user_last_name, user_collection,
+        oplog=None):
     '''
     Creates a new instance of User and stores it in user_collection
     (which is an instance of UserCollection)
 
     Requirements:
     - user_id cannot already exist in user_collection.
+    - email cannot already belong to another user (in any case).
     - Returns False if there are any errors (for example, if
     user_collection.add_user() returns False).
     - Otherwise, it returns True.
+    - If oplog is given, a successful add is logged to it.
     '''
-    for database_user_id, _ in user_collection.database.items():
-        if database_user_id == user_id:
-            return False
+    # UserCollection.add_user rejects existing ids and emails with dict lookups
+    params = (user_id, email, user_name, user_last_name)
+    result = user_collection.add_user(*params)
+    log_operation(oplog, result, 'au', *params)
 
-    user_collection.add_user(user_id, email, user_name, user_last_name)
-    return True
+    return result
 
 
-def update_user(user_id, email, user_name, user_last_name, user_collection):
+def bulk_add_users(rows, user_collection, oplog=None):
+    '''
+    Adds many users at once from an iterable of
+    (user_id, email, user_name, user_last_name) tuples
+
+    Requirements:
+    - user_ids that already exist (in user_collection
+    or earlier in rows) are skipped.
+    - Returns a tuple (inserted, skipped).
+    - If oplog is given, every inserted user is logged
+    to it (the rows are then added one at a time, so
+    only the ones accepted are logged).
+    '''
+    if oplog is None:
+        return user_collection.merge_rows(rows)
+
+    inserted = 0
+    skipped = 0
+    for row in rows:
+        if add_user(*row, user_collection, oplog):
+            inserted += 1
+        else:
+            skipped += 1
+
+    return inserted, skipped
+
+
+# six parameters: the four user fields, then the collection and the
+# oplog that every operation here takes
+def update_user(  # pylint: disable=R0913,R0917
+        user_id, email, user_name, user_last_name, user_collection,
+        oplog=None):
     '''
     Updates the values of an existing user
 
     Requirements:
-    - Returns False if there any errors.
+    - Returns False if there any errors (such as
+    another user already having the new email).
     - Otherwise, it returns True.
+    - If oplog is given, a successful update is logged to it.
     '''
     params = (user_id, email, user_name, user_last_name)
     result = user_collection.modify_user(*params)
+    log_operation(oplog, result, 'uu', *params)
 
     return result
 
 
-def delete_user(user_id, user_collection):
+def delete_user(user_id, user_collection, oplog=None):
     '''
     Deletes a user from user_collection.
 
     Requirements:
     - Returns False if there are any errors (such as user_id not found)
     - Otherwise, it returns True.
+    - If oplog is given, a successful delete is logged to it.
     '''
     result = user_collection.delete_user(user_id)
+    log_operation(oplog, result, 'du', user_id)
 
     return result
 
 
+def delete_user_cascade(user_id, user_collection, status_collection,
+                        oplog=None):
+    '''
+    Deletes a user from user_collection together
+    with all of their statuses in status_collection.
+
+    Requirements:
+    - Returns False if there are any errors (such as user_id not found),
+    in which case no statuses are deleted.
+    - Otherwise, it returns True.
+    - If oplog is given, a successful delete is logged to it.
+    '''
+    if not delete_user(user_id, user_collection, oplog):
+        return False
+
+    status_collection.delete_statuses_by_user(user_id)
+    log_operation(oplog, True, 'dc', user_id)
+    return True
+
+
+def delete_users_cascade(user_ids, user_collection, status_collection,
+                         oplog=None):
+    '''
+    Deletes many users, and all of their statuses,
+    at once (see delete_user_cascade).
+
+    Requirements:
+    - user_ids that are not found are ignored.
+    - Returns the number of users deleted.
+    '''
+    deleted = 0
+    for user_id in user_ids:
+        if delete_user_cascade(user_id, user_collection, status_collection,
+                               oplog):
+            deleted += 1
+
+    return deleted
+
+
 def search_user(user_id, user_collection):
     '''
     Searches for a user in user_collection
@@ -234,15 +753,61 @@ def search_user(user_id, user_collection):
     User instance.
     - Otherwise, it returns None.
     '''
-    result = user_collection.search_user(user_id)
+    result = user_collection.get_user(user_id)
+
+    return result
+
+
+def search_user_by_email(email, user_collection):
+    '''
+    Searches for the user with an email in
+    user_collection
+
+    Requirements:
+    - Case and surrounding spaces are ignored.
+    - If the user is found, returns the corresponding
+    User instance.
+    - Otherwise, it returns None.
+    '''
+    result = user_collection.get_user_by_email(email)
+
+    return result
+
+
+def search_users_many(user_ids, user_collection):
+    '''
+    Searches for many users in user_collection at once
 
-    if result.user_id is None:
-        return None
+    Requirements:
+    - Returns a list with, for each user_id in order,
+    the corresponding User instance, or None if it
+    is not found.
+    - Storage backends are asked in one round-trip.
+    '''
+    result = user_collection.search_users_many(user_ids)
+
+    return result
+
+
+def search_users_by_prefix(prefix, user_collection, limit=10):
+    '''
+    Searches for the users whose name or last name
+    starts with prefix, for typeahead
+
+    Requirements:
+    - Case and surrounding spaces are ignored.
+    - Returns a list of at most limit User
+    instances, ordered by the matching name, then
+    user_id; each user is listed once.
+    - Returns an empty list if nothing matches.
+    '''
+    result = user_collection.search_users_by_prefix(prefix, limit)
 
     return result
 
 
-def add_status(user_id, status_id, status_text, status_collection):
+def add_status(user_id, status_id, status_text, status_collection,
+               oplog=None):
     '''
     Creates a new instance of UserStatus and stores it in user_collection
     (which is an instance of UserStatusCollection)
@@ -252,34 +817,43 @@ def add_status(user_id, status_id, status_text, status_collection):
     - Returns False if there are any errors (for example, if
     user_collection.add_status() returns False).
     - Otherwise, it returns True.
+    - If oplog is given, a successful add is logged to it.
     '''
-    result = status_collection.add_status(status_id, user_id, status_text)
+    params = (status_id, user_id, status_text)
+    result = status_collection.add_status(*params)
+    log_operation(oplog, result, 'as', *params)
 
     return result
 
 
-def update_status(status_id, user_id, status_text, status_collection):
+def update_status(status_id, user_id, status_text, status_collection,
+                  oplog=None):
     '''
     Updates the values of an existing status_id
 
     Requirements:
     - Returns False if there any errors.
     - Otherwise, it returns True.
+    - If oplog is given, a successful update is logged to it.
     '''
-    result = status_collection.modify_status(status_id, user_id, status_text)
+    params = (status_id, user_id, status_text)
+    result = status_collection.modify_status(*params)
+    log_operation(oplog, result, 'us', *params)
 
     return result
 
 
-def delete_status(status_id, status_collection):
+def delete_status(status_id, status_collection, oplog=None):
     '''
     Deletes a status_id from user_collection.
 
     Requirements:
     - Returns False if there are any errors (such as status_id not found)
     - Otherwise, it returns True.
+    - If oplog is given, a successful delete is logged to it.
     '''
     result = status_collection.delete_status(status_id)
+    log_operation(oplog, result, 'ds', status_id)
 
     return result
 
@@ -293,9 +867,100 @@ def search_status(status_id, status_collection):
     UserStatus instance.
     - Otherwise, it returns None.
     '''
-    result = status_collection.search_status(status_id)
+    result = status_collection.get_status(status_id)
+
+    return result
+
+
+def search_statuses_many(status_ids, status_collection):
+    '''
+    Searches for many statuses in status_collection at once
 
-    if result.status_id is None:
-        return None
+    Requirements:
+    - Returns a list with, for each status_id in order,
+    the corresponding UserStatus instance, or None if
+    it is not found.
+    - Storage backends are asked in one round-trip.
+    '''
+    result = status_collection.search_statuses_many(status_ids)
 
     return result
+
+
+def search_statuses_by_user(user_id, status_collection):
+    '''
+    Searches for all the statuses of a user in
+    status_collection
+
+    Requirements:
+    - Returns a list of UserStatus instances, in
+    the order they were added.
+    - Returns an empty list if the user has no
+    statuses.
+    '''
+    result = status_collection.search_statuses_by_user(user_id)
+
+    return result
+
+
+def search_statuses_by_text(query, status_collection, match_all=True,
+                            ranked=False):
+    '''
+    Searches for the statuses whose text contains
+    the words of query (see text_index)
+
+    Requirements:
+    - A word ending in * matches every word that
+    starts with it; case is ignored.
+    - With match_all (the default) a status must
+    contain every word, otherwise any of them.
+    - Returns a list of UserStatus instances in
+    status_id order, or with ranked, most matches
+    first.
+    - Returns an empty list if nothing matches.
+    '''
+    result = status_collection.search_statuses_by_text(query, match_all,
+                                                       ranked)
+
+    return result
+
+
+def recover(snapshot_filename, log_filename, user_collection,
+            status_collection):
+    '''
+    Rebuilds the collections after a restart: loads
+    the last snapshot (if there is one), then replays
+    the operation log written since
+
+    Requirements:
+    - Returns False if the snapshot exists but cannot
+    be loaded (the log is not replayed).
+    - Otherwise, it returns True.
+    '''
+    if os.path.exists(snapshot_filename):
+        if not load_snapshot(snapshot_filename, user_collection,
+                             status_collection):
+            return False
+
+    operation_log.replay(log_filename, user_collection, status_collection)
+    return True
+
+
+def compact_oplog(snapshot_filename, oplog, user_collection,
+                  status_collection):
+    '''
+    Folds the operation log into a new snapshot:
+    saves the collections atomically, then empties oplog
+
+    Requirements:
+    - Returns False if the snapshot cannot be saved
+    (the log is kept).
+    - Otherwise, it returns True.
+    '''
+    oplog.sync()
+    if not save_snapshot(snapshot_filename, user_collection,
+                         status_collection):
+        return False
+
+    oplog.truncate()
+    return True
@@ -0,0 +1,23 @@
+'''
+Shared bulk-merge loop for the in-memory collections
+
+UserCollection, UserStatusCollection and ColumnarStatusCollection
+merge rows by adding them one at a time through their own add method,
+which already rejects ids (and emails) seen in the collection or
+earlier in the rows, and count the outcome.
+'''
+
+
+def add_each(add, rows):
+    '''
+    Calls add(*row) for every row and returns a tuple
+    (inserted, skipped) counting its True and False results
+    '''
+    inserted = 0
+    skipped = 0
+    for row in rows:
+        if add(*row):
+            inserted += 1
+        else:
+            skipped += 1
+    return inserted, skipped
@@ -0,0 +1,140 @@
+'''
+Append-only operation log (write-ahead log) for the collections
+
+Every change made through main.py can be appended here as a compact
+record, so a crash only loses what was not yet fsynced, instead of
+everything since the last full save. On disk each record is
+
+    payload length (uint32) | crc32 of payload (uint32) | payload
+
+where the payload is a UTF-8 JSON array: a short operation code
+followed by the arguments of the collection method it stands for.
+A record cut short by a crash fails its length or crc check; reading
+stops there and the next OperationLog opened on the file drops it.
+
+Records carry whole values, not deltas, so replaying a log over a
+snapshot that already holds some of its changes gives the same
+result as replaying it over the snapshot it was written against.
+'''
+import json
+import os
+import struct
+import time
+import zlib
+
+RECORD_HEADER = struct.Struct('<II')
+
+# operation code -> (collection, method) it is replayed with
+OPERATIONS = {
+    'au': ('users', 'add_user'),
+    'uu': ('users', 'modify_user'),
+    'du': ('users', 'delete_user'),
+    'as': ('statuses', 'add_status'),
+    'us': ('statuses', 'modify_status'),
+    'ds': ('statuses', 'delete_status'),
+    'dc': ('statuses', 'delete_statuses_by_user'),
+}
+
+
+def read_records(file):
+    '''
+    Yields (end offset, record) for every complete record
+    in an open binary log file, stopping at the first torn
+    or corrupt one
+    '''
+    offset = file.tell()
+    while True:
+        header = file.read(RECORD_HEADER.size)
+        if len(header) < RECORD_HEADER.size:
+            return
+        length, checksum = RECORD_HEADER.unpack(header)
+        payload = file.read(length)
+        if len(payload) < length or zlib.crc32(payload) != checksum:
+            return
+        offset += RECORD_HEADER.size + length
+        yield offset, json.loads(payload)
+
+
+def replay(filename, user_collection, status_collection):
+    '''
+    Applies the records of a log file to the collections,
+    in order. Returns the number of records applied
+    (a missing file has none)
+    '''
+    targets = {'users': user_collection, 'statuses': status_collection}
+    applied = 0
+    try:
+        with open(filename, 'rb') as file:
+            for _, (code, *arguments) in read_records(file):
+                collection, method = OPERATIONS[code]
+                getattr(targets[collection], method)(*arguments)
+                applied += 1
+    except FileNotFoundError:
+        pass
+    return applied
+
+
+class OperationLog():
+    '''
+    An open operation log. Records are fsynced in groups:
+    once sync_every records are waiting, or once
+    sync_interval seconds have passed since the last sync
+    (checked when a record is appended)
+    '''
+
+    def __init__(self, filename, sync_every=1, sync_interval=None):
+        self.filename = filename
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+        # drop a torn tail left by a crash before appending to it
+        valid_end = 0
+        if os.path.exists(filename):
+            with open(filename, 'rb') as file:
+                for valid_end, _ in read_records(file):
+                    pass
+        self.file = open(filename, 'ab')  # pylint: disable=R1732
+        self.file.truncate(valid_end)
+
+    def append(self, code, *arguments):
+        '''
+        Appends one record (code is a key of OPERATIONS)
+        and syncs if a group is complete
+        '''
+        payload = json.dumps([code, *arguments],
+                             separators=(',', ':')).encode('utf-8')
+        self.file.write(RECORD_HEADER.pack(len(payload), zlib.crc32(payload))
+                        + payload)
+        self.unsynced += 1
+
+        interval_passed = (self.sync_interval is not None and
+                           time.monotonic() - self.last_sync
+                           >= self.sync_interval)
+        if self.unsynced >= self.sync_every or interval_passed:
+            self.sync()
+
+    def sync(self):
+        '''
+        Flushes and fsyncs every record appended so far
+        '''
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def truncate(self):
+        '''
+        Empties the log (once its records are in a snapshot)
+        '''
+        self.file.flush()
+        self.file.truncate(0)
+        self.sync()
+
+    def close(self):
+        '''
+        Syncs and closes the log
+        '''
+        self.sync()
+        self.file.close()
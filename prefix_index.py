@@ -0,0 +1,207 @@
+'''
+Prefix (typeahead) index over user_name and user_last_name
+
+Every user is indexed under the case-folded forms of their name and
+last name (once if they are the same). An entry is the string
+
+    key + NUL + user_id
+
+so sorting entries sorts by key, then user_id, and all entries whose
+key starts with a prefix sit next to each other: a bisect finds the
+first one and the top matches follow it.
+
+Entries live in one large sorted list plus a small sorted list of
+recent additions (pending), so an addition moves O(sqrt(n)) pointers
+instead of O(n). Removed entries are only marked dead. Once pending or
+the dead entries grow past PENDING_FACTOR * sqrt(n), they are merged
+into the large list by splice(), which bisects for each change and
+copies the rest in slices. Searches read both lists. Bulk loads
+(UserCollection.merge_rows) append to a third, unsorted list that is
+merged once at the end, and searched only then.
+UserCollection keeps its PrefixIndex up to date on every add, modify
+and delete. Indexing costs memory (a string per name), so it is
+opt-in; scan() answers the same searches by reading every user.
+'''
+import bisect
+import contextlib
+import heapq
+import math
+
+PENDING_FACTOR = 16
+PENDING_MINIMUM = 1024
+
+
+def name_key(name):
+    '''
+    Returns the form of a name that is indexed and
+    compared (case-folded, surrounding spaces removed)
+    '''
+    return name.strip().casefold()
+
+
+def user_keys(user_name, user_last_name):
+    '''
+    Returns the distinct non-empty keys of a user's names
+    '''
+    return {key for key in (name_key(user_name), name_key(user_last_name))
+            if key}
+
+
+def match_key(user, prefix_key):
+    '''
+    Returns the smallest key of user starting with prefix_key,
+    or None (used to rank users found without an index)
+    '''
+    keys = [key for key in user_keys(user.user_name, user.user_last_name)
+            if key.startswith(prefix_key)]
+    return min(keys) if keys else None
+
+
+class PrefixIndex():
+    '''
+    Sorted entries (see the module docstring) with the pending,
+    loading and dead ones. Changes and searches are made under
+    lock (a no-op unless a thread-safe collection sets one)
+    '''
+
+    def __init__(self):
+        self.entries = []
+        self.pending = []
+        self.loading = []
+        self.dead = set()
+        self.deferred = False
+        self.lock = contextlib.nullcontext()
+
+    def clear(self):
+        '''
+        Empties the index
+        '''
+        with self.lock:
+            self.entries = []
+            self.pending = []
+            self.loading = []
+            self.dead = set()
+
+    def add(self, user_id, user_name, user_last_name):
+        '''
+        Indexes user_id under its names
+        '''
+        with self.lock:
+            for key in user_keys(user_name, user_last_name):
+                entry = f'{key}\0{user_id}'
+                if entry in self.dead:
+                    # the old copy is still in a list: revive it
+                    self.dead.discard(entry)
+                elif self.deferred:
+                    self.loading.append(entry)
+                else:
+                    bisect.insort(self.pending, entry)
+            if len(self.pending) > max(
+                    PENDING_MINIMUM,
+                    PENDING_FACTOR * math.isqrt(len(self.entries))):
+                self._merge()
+
+    def remove(self, user_id, user_name, user_last_name):
+        '''
+        Removes user_id, indexed under these names
+        '''
+        with self.lock:
+            for key in user_keys(user_name, user_last_name):
+                self.dead.add(f'{key}\0{user_id}')
+            if len(self.dead) > max(
+                    PENDING_MINIMUM,
+                    PENDING_FACTOR * math.isqrt(len(self.entries))):
+                self._merge()
+
+    @contextlib.contextmanager
+    def deferring(self):
+        '''
+        Within the block, additions go to loading and are
+        sorted in once at the end (searches see them then)
+        '''
+        self.deferred = True
+        try:
+            yield
+        finally:
+            self.deferred = False
+            with self.lock:
+                self._merge()
+
+    def _merge(self):
+        '''merges pending and loading into entries, drops dead entries'''
+        dead = self.dead
+        run = sorted(entry for entry in self.pending + self.loading
+                     if entry not in dead)
+        entries = self.entries
+        if len(run) * 8 > len(entries):
+            # a bulk load: sorting everything is as cheap
+            entries = [entry for entry in entries if entry not in dead]
+            entries += run
+            entries.sort()
+        else:
+            entries = splice(entries, run, dead)
+        self.entries = entries
+        self.pending = []
+        self.loading = []
+        self.dead = set()
+
+    def search(self, prefix, limit=10):
+        '''
+        Returns up to limit user_ids with a name starting with
+        prefix (any case), ordered by that name, then user_id
+        '''
+        prefix_key = name_key(prefix)
+        found = {}
+        with self.lock:
+            # each list read lazily from its first match on
+            matches = heapq.merge(*(
+                map(entries.__getitem__,
+                    range(bisect.bisect_left(entries, prefix_key),
+                          len(entries)))
+                for entries in (self.entries, self.pending)))
+            for entry in matches:
+                if len(found) >= limit or not entry.startswith(prefix_key):
+                    break
+                if entry not in self.dead:
+                    found.setdefault(entry[entry.rindex('\0') + 1:])
+        return list(found)
+
+
+def splice(entries, run, dead):
+    '''
+    Returns sorted entries with the sorted run inserted and
+    the dead entries left out. Each change is found with a
+    bisect and the rest is copied in slices, so a merge makes
+    O(changes * log(n)) comparisons instead of O(n)
+    '''
+    # (position, 0, entry) inserts entry, (position, 1, None) skips one
+    cuts = [(bisect.bisect_left(entries, entry), 0, entry) for entry in run]
+    for entry in dead:
+        position = bisect.bisect_left(entries, entry)
+        if position < len(entries) and entries[position] == entry:
+            cuts.append((position, 1, None))
+    cuts.sort()
+    spliced = []
+    start = 0
+    for position, skip, entry in cuts:
+        spliced += entries[start:position]
+        if skip:
+            start = position + 1
+        else:
+            spliced.append(entry)
+            start = position
+    spliced += entries[start:]
+    return spliced
+
+
+def scan(users, prefix, limit=10):
+    '''
+    PrefixIndex.search over Users without an index: every user
+    is compared. Returns the matching Users (not user_ids)
+    '''
+    prefix_key = name_key(prefix)
+    ranked = ((match_key(user, prefix_key), user.user_id, user)
+              for user in users)
+    return [user for _, _, user in heapq.nsmallest(
+        limit, (item for item in ranked if item[0] is not None),
+        key=lambda item: item[:2])]
@@ -0,0 +1,573 @@
+'''
+Collections hash-partitioned by user_id across worker processes
+
+ShardPool starts one worker process per shard. Each worker holds a
+users.UserCollection and a user_status.UserStatusCollection and serves
+method calls sent over a multiprocessing pipe. A user and all of their
+statuses live on shard crc32(user_id) % shards, so per-user work (adds,
+timelines, cascading deletes) goes to one shard:
+
+    pool = sharded.ShardPool(4)
+    main.load_users('accounts.csv', pool.users)
+    main.search_statuses_by_user('dave03', pool.statuses)
+    pool.close()
+
+pool.users and pool.statuses keep the UserCollection and
+UserStatusCollection contracts, with these differences:
+
+- lookups by status_id do not know the user, so they fan out to every
+  shard at once; add_status / merge_rows ask every shard whether a
+  status_id exists before adding it, so status_ids stay unique
+- modify_status to a user on another shard moves the status there
+- emails must be unique across shards, so add_user, modify_user and
+  merge_rows ask every shard who has an email first, and lookups by
+  email fan out
+- search_users_by_prefix asks every shard for its first limit matches
+  and merges them (ShardPool(prefix_search=True) gives each shard a
+  prefix_index.PrefixIndex)
+- search_statuses_by_text asks every shard for its matches and orders
+  them again (ShardPool(text_search=True) gives each shard a
+  text_index.TextIndex)
+- merge_rows sends SHARD_BATCH_ROWS rows at a time, split by shard,
+  and parses the next batch while the shards merge the last one
+- iteration over database (used by the save_* functions) goes shard by
+  shard, so saved files are grouped by shard instead of in insertion
+  order
+- records are copies: change them with the modify_* methods
+
+Calls from several threads are serialized on the pool.
+'''
+from collections.abc import Mapping
+import itertools
+import multiprocessing
+import threading
+import zlib
+import prefix_index
+import text_index
+from users import MISSING_USER, UserCollection, email_key
+from user_status import MISSING_STATUS, UserStatusCollection
+
+SHARD_BATCH_ROWS = 10_000
+
+
+def email_owners(collection, emails):
+    '''email_key -> user_id for the emails a shard's users have'''
+    owners = {}
+    for email in emails:
+        key = email_key(email)
+        user_id = collection.email_index.get(key)
+        if user_id is not None:
+            owners[key] = user_id
+    return owners
+
+
+# worker-side calls that are not collection methods
+SHARD_CALLS = {
+    'items': lambda collection: list(collection.database.items()),
+    'count': lambda collection: len(collection.database),
+    'existing': lambda collection, ids: [
+        id_ for id_ in ids if id_ in collection.database],
+    'email_owners': email_owners,
+}
+
+
+def shard_of(user_id, shards):
+    '''
+    Returns the shard number of user_id (stable across processes,
+    unlike hash())
+    '''
+    return zlib.crc32(user_id.encode('utf-8')) % shards
+
+
+def serve(connection, prefix_search=False, text_search=False):
+    '''
+    Worker process loop: runs (target, method, args) requests on
+    this shard's collections and sends back ('ok', result) or
+    ('error', exception), until it receives None
+    '''
+    targets = {'users': UserCollection(prefix_search),
+               'statuses': UserStatusCollection(text_search)}
+    while (request := connection.recv()) is not None:
+        target, method, args = request
+        collection = targets[target]
+        try:
+            if method in SHARD_CALLS:
+                result = SHARD_CALLS[method](collection, *args)
+            else:
+                result = getattr(collection, method)(*args)
+        except Exception as error:  # pylint: disable=W0718
+            connection.send(('error', error))
+        else:
+            connection.send(('ok', result))
+    connection.close()
+
+
+def receive(connection):
+    '''returns the result of one request, re-raising worker errors'''
+    status, result = connection.recv()
+    if status == 'error':
+        raise result
+    return result
+
+
+def receive_all(connections):
+    '''
+    Returns the results of one request on each connection, in
+    order. Every reply is read before the first worker error is
+    re-raised, so no reply is left behind for the next request
+    '''
+    replies = [connection.recv() for connection in connections]
+    for status, result in replies:
+        if status == 'error':
+            raise result
+    return [result for _, result in replies]
+
+
+class ShardPool():
+    '''
+    shards worker processes and the users / statuses
+    collections routed over them
+    '''
+
+    def __init__(self, shards=4, prefix_search=False, text_search=False):
+        self.shards = shards
+        self.lock = threading.RLock()
+        self.connections = []
+        self.processes = []
+        for _ in range(shards):
+            parent, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=serve, args=(child, prefix_search, text_search),
+                daemon=True)
+            process.start()
+            child.close()
+            self.connections.append(parent)
+            self.processes.append(process)
+        self.users = ShardedUserCollection(self)
+        self.statuses = ShardedStatusCollection(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def shard_of(self, user_id):
+        '''the shard number of user_id'''
+        return shard_of(user_id, self.shards)
+
+    def call(self, shard, target, method, *args):
+        '''
+        Runs target.method(*args) on one shard and returns the result
+        '''
+        with self.lock:
+            self.connections[shard].send((target, method, args))
+            return receive(self.connections[shard])
+
+    def call_each(self, requests):
+        '''
+        Runs {shard: (target, method, args)} on those shards at the
+        same time; returns {shard: result}
+        '''
+        with self.lock:
+            sent = []
+            try:
+                for shard, request in requests.items():
+                    self.connections[shard].send(request)
+                    sent.append(shard)
+            except BaseException:
+                for shard in sent:
+                    self.connections[shard].recv()
+                raise
+            return dict(zip(sent, receive_all(
+                [self.connections[shard] for shard in sent])))
+
+    def call_all(self, target, method, *args):
+        '''
+        Runs target.method(*args) on every shard at the same time;
+        returns the results in shard order
+        '''
+        results = self.call_each({shard: (target, method, args)
+                                  for shard in range(self.shards)})
+        return [results[shard] for shard in range(self.shards)]
+
+    def close(self):
+        '''
+        Stops the worker processes (their data is lost)
+        '''
+        with self.lock:
+            for connection, process in zip(self.connections,
+                                           self.processes):
+                connection.send(None)
+                connection.close()
+                process.join()
+            self.connections = []
+            self.processes = []
+
+
+class ShardsView(Mapping):
+    '''
+    Read-only id -> record mapping over every shard
+    '''
+
+    def __init__(self, collection):
+        self._collection = collection
+
+    def __getitem__(self, key):
+        record = self._collection.get(key)
+        if record is None:
+            raise KeyError(key)
+        return record
+
+    def __iter__(self):
+        return (key for key, _ in self.items())
+
+    def __len__(self):
+        return sum(self._collection.pool.call_all(self._collection.target,
+                                                  'count'))
+
+    def items(self):
+        '''(id, record) pairs, one shard at a time'''
+        pool = self._collection.pool
+        for shard in range(pool.shards):
+            yield from pool.call(shard, self._collection.target, 'items')
+
+
+class ShardedUserCollection():
+    '''
+    users.UserCollection partitioned over the shards of a ShardPool
+    '''
+    target = 'users'
+    # calls wait on other processes (see async_api)
+    blocking = True
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    @property
+    def database(self):
+        '''a read-only user_id -> Users view of every shard'''
+        return ShardsView(self)
+
+    def _call(self, user_id, method, *args):
+        '''runs method on the shard of user_id'''
+        return self.pool.call(self.pool.shard_of(user_id), 'users', method,
+                              *args)
+
+    def _email_owner(self, email):
+        '''the user_id that has email on any shard, or None'''
+        for owners in self.pool.call_all('users', 'email_owners', [email]):
+            if owners:
+                return owners.popitem()[1]
+        return None
+
+    def add_user(self, user_id, email, user_name, user_last_name):
+        '''
+        Adds a new user on its shard, returns False if user_id
+        or email already exists
+        '''
+        with self.pool.lock:
+            if self._email_owner(email) is not None:
+                return False
+            return self._call(user_id, 'add_user', user_id, email,
+                              user_name, user_last_name)
+
+    def merge_rows(self, rows):
+        '''
+        Adds many (user_id, email, user_name, user_last_name) rows,
+        skipping user_ids that already exist.
+        Returns a tuple (inserted, skipped)
+        '''
+        return merge_by_shard(self.pool, 'users', rows)
+
+    def modify_user(self, user_id, email, user_name, user_last_name):
+        '''
+        Modifies an existing user on its shard, returns False
+        if it does not exist or another user has the new email
+        '''
+        with self.pool.lock:
+            if self._email_owner(email) not in (None, user_id):
+                return False
+            return self._call(user_id, 'modify_user', user_id, email,
+                              user_name, user_last_name)
+
+    def delete_user(self, user_id):
+        '''
+        Deletes an existing user from its shard
+        '''
+        return self._call(user_id, 'delete_user', user_id)
+
+    def get(self, user_id):
+        '''
+        Returns the user, or None if it does not exist
+        '''
+        return self._call(user_id, 'get_user', user_id)
+
+    get_user = get
+
+    def search_user(self, user_id):
+        '''
+        Returns the user, or MISSING_USER if it does not exist
+        '''
+        user = self.get(user_id)
+        return MISSING_USER if user is None else user
+
+    def get_user_by_email(self, email):
+        '''
+        Returns the user with email (any case), or None,
+        asking every shard at the same time
+        '''
+        for user in self.pool.call_all('users', 'get_user_by_email', email):
+            if user is not None:
+                return user
+        return None
+
+    def search_user_by_email(self, email):
+        '''
+        Returns the user with email (any case), or MISSING_USER
+        '''
+        user = self.get_user_by_email(email)
+        return MISSING_USER if user is None else user
+
+    def search_users_many(self, user_ids):
+        '''
+        Returns the users of user_ids in the same order (None for
+        misses), asking every shard involved at the same time
+        '''
+        user_ids = list(user_ids)
+        by_shard = {}
+        for user_id in user_ids:
+            by_shard.setdefault(self.pool.shard_of(user_id), []).append(
+                user_id)
+        results = self.pool.call_each({
+            shard: ('users', 'search_users_many', (ids,))
+            for shard, ids in by_shard.items()})
+        found = {}
+        for shard, ids in by_shard.items():
+            found.update(zip(ids, results[shard]))
+        return [found[user_id] for user_id in user_ids]
+
+    def search_users_by_prefix(self, prefix, limit=10):
+        '''
+        Returns up to limit users with a name starting with
+        prefix (any case), ordered by that name, then user_id,
+        merging the first limit matches of every shard
+        '''
+        prefix_key = prefix_index.name_key(prefix)
+        matches = itertools.chain.from_iterable(self.pool.call_all(
+            'users', 'search_users_by_prefix', prefix, limit))
+        return sorted(matches, key=lambda user: (
+            prefix_index.match_key(user, prefix_key),
+            user.user_id))[:limit]
+
+
+class ShardedStatusCollection():
+    '''
+    user_status.UserStatusCollection partitioned by user_id over
+    the shards of a ShardPool
+    '''
+    target = 'statuses'
+    # calls wait on other processes (see async_api)
+    blocking = True
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    @property
+    def database(self):
+        '''a read-only status_id -> UserStatus view of every shard'''
+        return ShardsView(self)
+
+    def _call(self, user_id, method, *args):
+        '''runs method on the shard of user_id'''
+        return self.pool.call(self.pool.shard_of(user_id), 'statuses',
+                              method, *args)
+
+    def _shard_holding(self, status_id):
+        '''the shard that holds status_id, or None'''
+        for shard, existing in enumerate(self.pool.call_all(
+                'statuses', 'existing', [status_id])):
+            if existing:
+                return shard
+        return None
+
+    def add_status(self, status_id, user_id, status_text):
+        '''
+        Adds a status on the shard of user_id, returns False if
+        status_id already exists on any shard
+        '''
+        with self.pool.lock:
+            if self._shard_holding(status_id) is not None:
+                return False
+            return self._call(user_id, 'add_status', status_id, user_id,
+                              status_text)
+
+    def merge_rows(self, rows):
+        '''
+        Adds many (status_id, user_id, status_text) rows, skipping
+        status_ids that already exist on any shard.
+        Returns a tuple (inserted, skipped)
+        '''
+        return merge_by_shard(self.pool, 'statuses', rows)
+
+    def modify_status(self, status_id, user_id, status_text):
+        '''
+        Changes a status, moving it to the shard of its new
+        user_id if needed. Returns False if it does not exist
+        '''
+        with self.pool.lock:
+            shard = self._shard_holding(status_id)
+            if shard is None:
+                return False
+            new_shard = self.pool.shard_of(user_id)
+            if shard == new_shard:
+                return self.pool.call(shard, 'statuses', 'modify_status',
+                                      status_id, user_id, status_text)
+            # the status moves to the end of the new user's timeline
+            self.pool.call(shard, 'statuses', 'delete_status', status_id)
+            return self.pool.call(new_shard, 'statuses', 'add_status',
+                                  status_id, user_id, status_text)
+
+    def delete_status(self, status_id):
+        '''
+        Deletes a status from whichever shard holds it,
+        returns False if it does not exist
+        '''
+        return any(self.pool.call_all('statuses', 'delete_status',
+                                      status_id))
+
+    def delete_statuses_by_user(self, user_id):
+        '''
+        Deletes every status of user_id on its shard,
+        returns how many were deleted
+        '''
+        return self._call(user_id, 'delete_statuses_by_user', user_id)
+
+    def get(self, status_id):
+        '''
+        Returns the status, or None if it does not exist
+        '''
+        return self.search_statuses_many([status_id])[0]
+
+    get_status = get
+
+    def search_status(self, status_id):
+        '''
+        Returns the status, or MISSING_STATUS if it does not exist
+        '''
+        status = self.get(status_id)
+        return MISSING_STATUS if status is None else status
+
+    def search_statuses_many(self, status_ids):
+        '''
+        Returns the statuses of status_ids in the same order (None
+        for misses), asking every shard at the same time
+        '''
+        status_ids = list(status_ids)
+        found = [None] * len(status_ids)
+        for results in self.pool.call_all('statuses', 'search_statuses_many',
+                                          status_ids):
+            for number, status in enumerate(results):
+                if status is not None:
+                    found[number] = status
+        return found
+
+    def search_statuses_by_user(self, user_id):
+        '''
+        Returns the statuses of user_id, oldest first,
+        from its shard
+        '''
+        return self._call(user_id, 'search_statuses_by_user', user_id)
+
+    def search_statuses_by_text(self, query, match_all=True, ranked=False):
+        '''
+        Returns the statuses whose text matches query, in status_id
+        order or, with ranked, best first, asking every shard at the
+        same time (their matches are scored again to order them)
+        '''
+        found = {status.status_id: status
+                 for statuses in self.pool.call_all(
+                     'statuses', 'search_statuses_by_text', query,
+                     match_all, ranked)
+                 for status in statuses}
+        status_ids = text_index.scan(
+            ((status_id, status.status_text)
+             for status_id, status in found.items()),
+            query, match_all, ranked)
+        return [found[status_id] for status_id in status_ids]
+
+
+def merge_by_shard(pool, target, rows):
+    '''
+    Splits rows into SHARD_BATCH_ROWS batches, splits each batch
+    by shard of its user_id and merges the parts on all shards
+    at once, parsing the next batch meanwhile. Rows whose id (or
+    for users, email) any shard already holds, or an earlier row
+    has, are skipped first.
+    Returns a tuple (inserted, skipped)
+    '''
+    user_field = 0 if target == 'users' else 1
+    inserted = 0
+    skipped = 0
+    rows = iter(rows)
+    with pool.lock:
+        # shards with a merge_rows reply still to read
+        pending = []
+        try:
+            while True:
+                batch = list(itertools.islice(rows, SHARD_BATCH_ROWS))
+                waiting, pending = pending, []
+                for merged in receive_all([pool.connections[shard]
+                                           for shard in waiting]):
+                    inserted += merged[0]
+                    skipped += merged[1]
+                if not batch:
+                    return inserted, skipped
+
+                fresh = fresh_rows(pool, target, batch)
+                skipped += len(batch) - len(fresh)
+
+                by_shard = {}
+                for row in fresh:
+                    by_shard.setdefault(pool.shard_of(row[user_field]),
+                                        []).append(row)
+                for shard, shard_rows in by_shard.items():
+                    pool.connections[shard].send((target, 'merge_rows',
+                                                  (shard_rows,)))
+                    pending.append(shard)
+        except BaseException:
+            # leave no reply behind for the next call
+            for shard in pending:
+                pool.connections[shard].recv()
+            raise
+
+
+def fresh_rows(pool, target, batch):
+    '''
+    The rows of batch whose id (and for users, email) no
+    shard holds yet and no earlier row of batch has
+    '''
+    held, held_emails = held_keys(pool, target, batch)
+    fresh = []
+    for row in batch:
+        key = email_key(row[1]) if target == 'users' else ''
+        if row[0] not in held and (not key or key not in held_emails):
+            held.add(row[0])
+            if key:
+                held_emails.add(key)
+            fresh.append(row)
+    return fresh
+
+
+def held_keys(pool, target, batch):
+    '''
+    The ids of batch, and for users the email_keys, that
+    some shard already holds (asking every shard at once)
+    '''
+    held = set().union(*pool.call_all(target, 'existing',
+                                      [row[0] for row in batch]))
+    held_emails = set()
+    if target == 'users':
+        held_emails = held_emails.union(*pool.call_all(
+            'users', 'email_owners', [row[1] for row in batch]))
+    return held, held_emails
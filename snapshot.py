@@ -0,0 +1,157 @@
+'''
+Binary snapshot of the users and statuses (see main.save_snapshot)
+
+A snapshot is a header (magic, user count, status count), then a
+table of little-endian uint64 string end offsets, then the UTF-8
+strings themselves, each followed by a NUL: users first (4 fields
+each), then statuses (3). Loading memory-maps the file and decodes
+the strings BLOCK at a time, without any CSV parsing.
+'''
+from array import array
+import codecs
+import itertools
+import mmap
+import os
+import struct
+import sys
+
+MAGIC = b'SNAPSHT1'
+HEADER = struct.Struct('<8sQQ')
+BLOCK = 65536
+CHECK_BYTES = 16 * 2 ** 20
+
+
+def write(file, users_count, statuses_count, rows):
+    '''
+    Writes a snapshot of users_count user rows followed by
+    statuses_count status rows to a binary file. Raises
+    ValueError if rows holds a different number of fields
+    '''
+    offsets = array('Q')
+    table_size = (users_count * 4 + statuses_count * 3) * offsets.itemsize
+    # strings go after the (not yet known) offset table
+    file.seek(HEADER.size + table_size)
+    end = 0
+    for row in rows:
+        for field in row:
+            end += file.write(field.encode('utf-8') + b'\0')
+            offsets.append(end)
+    if len(offsets) * offsets.itemsize != table_size:
+        raise ValueError('collection changed during the save')
+
+    if sys.byteorder == 'big':
+        offsets.byteswap()
+    file.seek(0)
+    file.write(HEADER.pack(MAGIC, users_count, statuses_count))
+    offsets.tofile(file)
+
+
+def decode_block(view, offsets, base, first, stop):
+    '''
+    Decodes strings first to stop of a mapped snapshot
+    whose strings begin at byte base. The block is decoded
+    in one call and split on the NUL terminators; if a
+    string holds a NUL itself, the offsets are used instead
+    '''
+    start = offsets[first - 1] if first else 0
+    text = str(view[base + start:base + offsets[stop - 1]], 'utf-8')
+    strings = text.split('\0')
+    strings.pop()
+    if len(strings) == stop - first:
+        return strings
+
+    raw = view[base:base + offsets[stop - 1]]
+    return [str(raw[begin:end - 1], 'utf-8') for begin, end in
+            zip(itertools.chain((start,), offsets[first:stop]),
+                offsets[first:stop])]
+
+
+def decode_strings(view, offsets, base, first, count):
+    '''
+    Returns an iterator over count strings of a mapped
+    snapshot, starting with string number first, decoded
+    BLOCK strings at a time
+    '''
+    stop = first + count
+    blocks = range(first, stop, BLOCK)
+    return itertools.chain.from_iterable(
+        decode_block(view, offsets, base, block, min(block + BLOCK, stop))
+        for block in blocks)
+
+
+def text_ok(view):
+    '''
+    True if view (the strings of a snapshot) is valid
+    UTF-8, checked CHECK_BYTES at a time
+    '''
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    try:
+        for start in range(0, len(view), CHECK_BYTES):
+            decoder.decode(view[start:start + CHECK_BYTES])
+        decoder.decode(b'', final=True)
+    except UnicodeDecodeError:
+        return False
+    return True
+
+
+def offsets_ok(strings, offsets):
+    '''
+    True if offsets (the string end offsets of a snapshot)
+    increase and each one ends a string on its NUL
+    '''
+    previous = 0
+    for end in offsets:
+        if end <= previous or strings[end - 1]:
+            return False
+        previous = end
+    return True
+
+
+def load_view(view, user_collection, status_collection):
+    '''
+    Adds the users and statuses of a snapshot held in
+    a memoryview to the collections (see load)
+    '''
+    if len(view) < HEADER.size:
+        return False
+    magic, users_count, statuses_count = HEADER.unpack_from(view)
+    user_fields = users_count * 4
+    fields = user_fields + statuses_count * 3
+    table_end = HEADER.size + fields * 8
+    if magic != MAGIC or len(view) < table_end:
+        return False
+
+    offsets = array('Q')
+    offsets.frombytes(view[HEADER.size:table_end])
+    if sys.byteorder == 'big':
+        offsets.byteswap()
+    if table_end + (offsets[-1] if offsets else 0) != len(view):
+        return False
+    # a corrupt offset or string must not leave the collections
+    # half-loaded
+    if not (offsets_ok(view[table_end:], offsets) and
+            text_ok(view[table_end:])):
+        return False
+
+    strings = decode_strings(view, offsets, table_end, 0, user_fields)
+    user_collection.merge_rows(zip(strings, strings, strings, strings))
+    strings = decode_strings(view, offsets, table_end, user_fields,
+                             fields - user_fields)
+    status_collection.merge_rows(zip(strings, strings, strings))
+
+    return True
+
+
+def load(filename, user_collection, status_collection):
+    '''
+    Memory-maps the snapshot filename and adds its users
+    and statuses to the collections. Returns False if the
+    file is not a complete snapshot
+    '''
+    with open(filename, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            # mmap refuses empty files
+            return False
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) \
+                as mapped, memoryview(mapped) as view:
+            return load_view(view, user_collection, status_collection)
@@ -0,0 +1,429 @@
+'''
+SQLite-backed collections for data sets that do not fit in memory
+
+SQLiteUserCollection and SQLiteStatusCollection keep the method
+contracts of users.UserCollection and user_status.UserStatusCollection
+but store the records in an on-disk SQLite database (stdlib sqlite3):
+
+- users and statuses are rowid tables with an indexed primary key, so
+  iteration follows insertion order like the dict-backed collections
+- statuses have an index on (user_id, seq) for the per-user timeline:
+  seq numbers each user's statuses in the order they joined the
+  timeline (added, or reassigned to the user), like the dict-backed
+  collections
+- users have a unique index on email_key(email) (users.email_key,
+  registered on each connection), so emails are unique in any case and
+  login lookups by email use the index
+- users have indexes on (name_key(user_name), user_id) and
+  (name_key(user_last_name), user_id) (prefix_index.name_key), so a
+  typeahead search is two index range scans of at most limit rows
+- the database runs in WAL journal mode, so readers do not block the
+  writer
+- every statement is a constant string, so sqlite3's statement cache
+  prepares each one once per connection
+- merge_rows inserts with executemany, MERGE_BATCH_ROWS rows per
+  transaction
+- search_*_many look up LOOKUP_BATCH_IDS ids per SELECT ... IN query
+
+Records returned by searches are copies; change them with the
+modify_* methods.
+'''
+from collections.abc import Mapping
+import itertools
+import sqlite3
+import prefix_index
+import text_index
+from users import MISSING_USER, Users, email_key
+from user_status import MISSING_STATUS, UserStatus
+
+MERGE_BATCH_ROWS = 10_000
+# ids per SELECT ... IN (...), below SQLite's bound-parameter limit
+LOOKUP_BATCH_IDS = 500
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS users (
+    user_id TEXT PRIMARY KEY,
+    email TEXT,
+    user_name TEXT,
+    user_last_name TEXT
+);
+CREATE TABLE IF NOT EXISTS statuses (
+    status_id TEXT PRIMARY KEY,
+    user_id TEXT,
+    status_text TEXT,
+    seq INTEGER
+);
+CREATE UNIQUE INDEX IF NOT EXISTS users_email ON users (email_key(email))
+    WHERE email_key(email) <> '';
+CREATE INDEX IF NOT EXISTS users_name
+    ON users (name_key(user_name), user_id);
+CREATE INDEX IF NOT EXISTS users_last_name
+    ON users (name_key(user_last_name), user_id);
+'''
+# databases created before statuses had a seq column
+MIGRATION = '''
+ALTER TABLE statuses ADD COLUMN seq INTEGER;
+UPDATE statuses SET seq = rowid;
+DROP INDEX IF EXISTS statuses_user_id;
+'''
+INDEXES = '''
+CREATE INDEX IF NOT EXISTS statuses_user_seq ON statuses (user_id, seq);
+'''
+# ?2 is the user_id: the status goes after the user's last one
+NEXT_SEQ = ('(SELECT COALESCE(MAX(seq), 0) + 1 FROM statuses '
+            'WHERE user_id = ?2)')
+INSERT_STATUS = ('INSERT OR IGNORE INTO statuses VALUES (?1, ?2, ?3, ' +
+                 NEXT_SEQ + ')')
+
+# the first limit users of each name index in a key range, then the
+# first limit of both, each user once under its smallest matching key
+PREFIX_QUERY = '''
+SELECT users.* FROM (
+    SELECT user_id, MIN(key) AS key FROM (
+        SELECT * FROM (
+            SELECT user_id, name_key(user_name) AS key FROM users
+            WHERE name_key(user_name) >= :low
+                AND name_key(user_name) < :high
+                AND name_key(user_name) <> ''
+            ORDER BY key, user_id LIMIT :limit)
+        UNION ALL
+        SELECT * FROM (
+            SELECT user_id, name_key(user_last_name) AS key FROM users
+            WHERE name_key(user_last_name) >= :low
+                AND name_key(user_last_name) < :high
+                AND name_key(user_last_name) <> ''
+            ORDER BY key, user_id LIMIT :limit))
+    GROUP BY user_id ORDER BY key, user_id LIMIT :limit) AS found
+JOIN users USING (user_id)
+ORDER BY found.key, user_id
+'''
+# sorts after every character: prefix + MAX_CHAR bounds its key range
+MAX_CHAR = '\U0010ffff'
+
+
+def connect(filename):
+    '''
+    Opens (or creates) a SQLite database for the collections
+    in WAL mode and returns the connection
+    '''
+    connection = sqlite3.connect(filename, check_same_thread=False)
+    connection.create_function('email_key', 1, email_key, deterministic=True)
+    connection.create_function('name_key', 1, prefix_index.name_key,
+                               deterministic=True)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    connection.executescript(SCHEMA)
+    columns = [row[1] for row in
+               connection.execute('PRAGMA table_info(statuses)')]
+    if 'seq' not in columns:
+        connection.executescript(MIGRATION)
+    connection.executescript(INDEXES)
+    return connection
+
+
+def merge_batches(connection, statement, rows):
+    '''
+    Runs statement (an INSERT OR IGNORE) for every row,
+    MERGE_BATCH_ROWS rows per transaction.
+    Returns a tuple (inserted, skipped)
+    '''
+    inserted = 0
+    skipped = 0
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, MERGE_BATCH_ROWS))
+        if not batch:
+            return inserted, skipped
+        before = connection.total_changes
+        with connection:
+            connection.executemany(statement, batch)
+        changed = connection.total_changes - before
+        inserted += changed
+        skipped += len(batch) - changed
+
+
+def lookup_many(collection, table, key, ids):
+    '''
+    Returns the records of ids in the same order (None for
+    the missing ones), reading LOOKUP_BATCH_IDS distinct ids
+    per query
+    '''
+    ids = list(ids)
+    found = {}
+    wanted = list(dict.fromkeys(ids))
+    record = collection.record
+    for start in range(0, len(wanted), LOOKUP_BATCH_IDS):
+        batch = wanted[start:start + LOOKUP_BATCH_IDS]
+        cursor = collection.connection.execute(
+            f'SELECT {collection.columns} FROM {table} WHERE {key} IN '
+            f'({", ".join("?" * len(batch))})', batch)
+        for row in cursor:
+            found[row[0]] = record(*row)
+    return [found.get(id_) for id_ in ids]
+
+
+class TableView(Mapping):
+    '''
+    Read-only id -> record mapping over a table, so code
+    written against the dict-backed database keeps working
+    '''
+
+    def __init__(self, collection, table, key):
+        self._collection = collection
+        self._table = table
+        self._key = key
+
+    def __getitem__(self, key):
+        record = self._collection.get(key)
+        if record is None:
+            raise KeyError(key)
+        return record
+
+    def __iter__(self):
+        cursor = self._collection.connection.execute(
+            f'SELECT {self._key} FROM {self._table} ORDER BY rowid')
+        return (key for key, in cursor)
+
+    def __len__(self):
+        cursor = self._collection.connection.execute(
+            f'SELECT COUNT(*) FROM {self._table}')
+        return cursor.fetchone()[0]
+
+    def items(self):
+        '''(id, record) pairs read with a single query'''
+        cursor = self._collection.connection.execute(
+            f'SELECT {self._collection.columns} FROM {self._table} '
+            'ORDER BY rowid')
+        record = self._collection.record
+        return ((row[0], record(*row)) for row in cursor)
+
+
+class SQLiteUserCollection():
+    '''
+    users.UserCollection stored in a SQLite database
+    '''
+    record = Users
+    columns = 'user_id, email, user_name, user_last_name'
+    # calls wait on disk I/O (see async_api)
+    blocking = True
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    @property
+    def database(self):
+        '''a read-only user_id -> Users view of the table'''
+        return TableView(self, 'users', 'user_id')
+
+    def add_user(self, user_id, email, user_name, user_last_name):
+        '''
+        Adds a new user, returns False if user_id or email
+        already exists
+        '''
+        with self.connection:
+            cursor = self.connection.execute(
+                'INSERT OR IGNORE INTO users VALUES (?, ?, ?, ?)',
+                (user_id, email, user_name, user_last_name))
+        return cursor.rowcount == 1
+
+    def merge_rows(self, rows):
+        '''
+        Adds many (user_id, email, user_name, user_last_name) rows,
+        skipping user_ids and emails that already exist.
+        Returns a tuple (inserted, skipped)
+        '''
+        return merge_batches(self.connection,
+                             'INSERT OR IGNORE INTO users VALUES (?, ?, ?, ?)',
+                             rows)
+
+    def modify_user(self, user_id, email, user_name, user_last_name):
+        '''
+        Modifies an existing user, returns False if it does not
+        exist or another user has the new email
+        '''
+        with self.connection:
+            cursor = self.connection.execute(
+                'UPDATE OR IGNORE users SET email = ?, user_name = ?, '
+                'user_last_name = ? WHERE user_id = ?',
+                (email, user_name, user_last_name, user_id))
+        return cursor.rowcount == 1
+
+    def delete_user(self, user_id):
+        '''
+        Deletes an existing user, returns False if it does not exist
+        '''
+        with self.connection:
+            cursor = self.connection.execute(
+                'DELETE FROM users WHERE user_id = ?', (user_id,))
+        return cursor.rowcount == 1
+
+    def get(self, user_id):
+        '''
+        Returns the user, or None if it does not exist
+        '''
+        row = self.connection.execute(
+            'SELECT * FROM users WHERE user_id = ?', (user_id,)).fetchone()
+        return None if row is None else Users(*row)
+
+    get_user = get
+
+    def search_user(self, user_id):
+        '''
+        Returns the user, or MISSING_USER if it does not exist
+        '''
+        user = self.get(user_id)
+        return MISSING_USER if user is None else user
+
+    def get_user_by_email(self, email):
+        '''
+        Returns the user with email (any case), or None,
+        through the email index
+        '''
+        key = email_key(email)
+        row = self.connection.execute(
+            "SELECT * FROM users WHERE email_key(email) = ? "
+            "AND email_key(email) <> ''", (key,)).fetchone()
+        return None if row is None else Users(*row)
+
+    def search_user_by_email(self, email):
+        '''
+        Returns the user with email (any case), or MISSING_USER
+        '''
+        user = self.get_user_by_email(email)
+        return MISSING_USER if user is None else user
+
+    def search_users_many(self, user_ids):
+        '''
+        Returns the users of user_ids in the same order, with None
+        for each one that does not exist, in one query per
+        LOOKUP_BATCH_IDS ids
+        '''
+        return lookup_many(self, 'users', 'user_id', user_ids)
+
+    def search_users_by_prefix(self, prefix, limit=10):
+        '''
+        Returns up to limit users with a name starting with
+        prefix (any case), ordered by that name, then user_id,
+        through the name indexes
+        '''
+        key = prefix_index.name_key(prefix)
+        cursor = self.connection.execute(
+            PREFIX_QUERY, {'low': key, 'high': key + MAX_CHAR,
+                           'limit': limit})
+        return [Users(*row) for row in cursor]
+
+
+class SQLiteStatusCollection():
+    '''
+    user_status.UserStatusCollection stored in a SQLite database
+    '''
+    record = UserStatus
+    columns = 'status_id, user_id, status_text'
+    # calls wait on disk I/O (see async_api)
+    blocking = True
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    @property
+    def database(self):
+        '''a read-only status_id -> UserStatus view of the table'''
+        return TableView(self, 'statuses', 'status_id')
+
+    def add_status(self, status_id, user_id, status_text):
+        '''
+        Adds a status, returns False if status_id already exists
+        '''
+        with self.connection:
+            cursor = self.connection.execute(
+                INSERT_STATUS, (status_id, user_id, status_text))
+        return cursor.rowcount == 1
+
+    def merge_rows(self, rows):
+        '''
+        Adds many (status_id, user_id, status_text) rows,
+        skipping status_ids that already exist.
+        Returns a tuple (inserted, skipped)
+        '''
+        return merge_batches(self.connection, INSERT_STATUS, rows)
+
+    def modify_status(self, status_id, user_id, status_text):
+        '''
+        Changes a status, returns False if it does not exist
+        (given to another user, it goes to the end of their
+        timeline)
+        '''
+        with self.connection:
+            cursor = self.connection.execute(
+                'UPDATE statuses SET seq = CASE WHEN user_id IS ?2 '
+                'THEN seq ELSE ' + NEXT_SEQ + ' END, '
+                'user_id = ?2, status_text = ?3 WHERE status_id = ?1',
+                (status_id, user_id, status_text))
+        return cursor.rowcount == 1
+
+    def delete_status(self, status_id):
+        '''
+        Deletes a status, returns False if it does not exist
+        '''
+        with self.connection:
+            cursor = self.connection.execute(
+                'DELETE FROM statuses WHERE status_id = ?', (status_id,))
+        return cursor.rowcount == 1
+
+    def delete_statuses_by_user(self, user_id):
+        '''
+        Deletes every status of user_id through the user_id index,
+        returns how many were deleted
+        '''
+        with self.connection:
+            cursor = self.connection.execute(
+                'DELETE FROM statuses WHERE user_id = ?', (user_id,))
+        return cursor.rowcount
+
+    def get(self, status_id):
+        '''
+        Returns the status, or None if it does not exist
+        '''
+        row = self.connection.execute(
+            'SELECT status_id, user_id, status_text FROM statuses '
+            'WHERE status_id = ?',
+            (status_id,)).fetchone()
+        return None if row is None else UserStatus(*row)
+
+    get_status = get
+
+    def search_status(self, status_id):
+        '''
+        Returns the status, or MISSING_STATUS if it does not exist
+        '''
+        status = self.get(status_id)
+        return MISSING_STATUS if status is None else status
+
+    def search_statuses_many(self, status_ids):
+        '''
+        Returns the statuses of status_ids in the same order, with
+        None for each one that does not exist, in one query per
+        LOOKUP_BATCH_IDS ids
+        '''
+        return lookup_many(self, 'statuses', 'status_id', status_ids)
+
+    def search_statuses_by_text(self, query, match_all=True, ranked=False):
+        '''
+        Returns the statuses whose text matches query
+        (see text_index.scan; every row is read)
+        '''
+        cursor = self.connection.execute(
+            'SELECT status_id, status_text FROM statuses')
+        return self.search_statuses_many(
+            text_index.scan(cursor, query, match_all, ranked))
+
+    def search_statuses_by_user(self, user_id):
+        '''
+        Returns the statuses of user_id, in the order they
+        joined the timeline, through the (user_id, seq) index
+        '''
+        cursor = self.connection.execute(
+            'SELECT status_id, user_id, status_text FROM statuses '
+            'WHERE user_id = ? ORDER BY seq',
+            (user_id,))
+        return [UserStatus(*row) for row in cursor]
@@ -1,12 +1,32 @@
 '''This module contains tests for main.py, users.py and user_status.py'''
 # pylint: disable=W0621
 
+import asyncio
+import csv
+import io
 import os
-from unittest.mock import patch
+import pickle
+import random
+import sqlite3
+import sys
+import threading
+from unittest.mock import Mock, call, patch
 from unittest.mock import mock_open
 import copy
 import pytest
+import async_api
+import bloom
+import cache
+import columnar_status
+import concurrent_collections
+import interning
 import main
+import oplog
+import prefix_index
+import sharded
+import snapshot
+import sqlite_backend
+import text_index
 import users
 import user_status
 
@@ -178,6 +198,16 @@ def test_users_init(tolby):
     assert tolby.email == 'mommasboy2001@gmail.com'
 
 
+def test_users_slots(tolby):
+    '''test Users keeps attribute access without a __dict__'''
+    tolby.email = 'tolby@example.com'
+
+    assert tolby.email == 'tolby@example.com'
+    assert not hasattr(tolby, '__dict__')
+    with pytest.raises(AttributeError):
+        tolby.nickname = 'Tolb'
+
+
 def test_user_collection_init(collection):
     '''test UsersCollection init'''
     assert collection.database == {}
@@ -257,6 +287,73 @@ def test_user_collection_search_user_not_existing(collection, database):
     assert result.user_id is None
 
 
+def test_user_collection_merge_rows(collection, database):
+    '''test merge_rows skips existing ids and repeats within the batch'''
+    collection.database = database
+    rows = [('evmiles97', 'eve.miles@uw.edu', 'Eve', 'Miles'),
+            ('Big****123', 'AElrick@BTISolutions.com', 'My', 'Secret'),
+            ('Big****123', 'other@BTISolutions.com', 'Not', 'Me')]
+
+    result = collection.merge_rows(iter(rows))
+
+    assert result == (1, 2)
+    assert collection.database['Big****123'].user_name == 'My'
+    assert len(collection.database) == 4
+
+
+def test_user_collection_merge_rows_malformed(collection):
+    '''test merge_rows raises TypeError on a row with missing fields'''
+    with pytest.raises(TypeError):
+        collection.merge_rows([('evmiles97', 'eve.miles@uw.edu', 'Miles')])
+
+
+def test_user_collection_email_index(collection, database):
+    '''test emails are unique in any case and the index follows changes'''
+    collection.database = database
+
+    assert collection.add_user('eve2', ' Eve.Miles@UW.edu', 'E', 'M') is False
+    assert collection.search_user_by_email('EVE.MILES@uw.edu').user_id == \
+        'evmiles97'
+    assert collection.search_user_by_email('nobody@x') is users.MISSING_USER
+    assert collection.modify_user('dave03', 'eve.miles@uw.edu', 'D',
+                                  'Y') is False
+    assert collection.modify_user('dave03', 'Dave@Example.com', 'D',
+                                  'Y') is True
+    assert collection.get_user_by_email('david.yuen@gmail.com') is None
+    assert collection.get_user_by_email('dave@example.com').user_id == \
+        'dave03'
+    assert collection.delete_user('evmiles97') is True
+    assert collection.add_user('eve2', 'eve.miles@uw.edu', 'E', 'M') is True
+    assert collection.add_user('a', '', 'A', 'A') is True
+    assert collection.add_user('b', ' ', 'B', 'B') is True
+    assert collection.merge_rows([('c', 'X@y', 'C', 'C'),
+                                  ('d', 'x@Y', 'D', 'D')]) == (1, 1)
+    assert collection.email_index == {'dave@example.com': 'dave03',
+                                      'mommasboy2001@gmail.com':
+                                      'Cool_kid187',
+                                      'eve.miles@uw.edu': 'eve2',
+                                      'x@y': 'c'}
+
+
+def test_user_collection_search_user_shared_sentinel(collection):
+    '''test misses return the same read-only MISSING_USER'''
+    first = collection.search_user('ClicheKHFan')
+    second = collection.search_user('nobody')
+
+    assert first is users.MISSING_USER
+    assert second is users.MISSING_USER
+    with pytest.raises(AttributeError):
+        first.user_id = 'ClicheKHFan'
+
+
+def test_user_collection_get_user(collection, database):
+    '''test get_user returns the user or None'''
+    collection.database = database
+
+    assert collection.get_user('evmiles97').user_name == 'Eve'
+    assert collection.get_user('ClicheKHFan') is None
+
+
 # user status tests
 
 
@@ -265,6 +362,12 @@ def test_user_status_init(impeach):
     assert impeach.status_id == 'XKPiC6*iW!H3#6'
 
 
+def test_user_status_slots(impeach):
+    '''test UserStatus keeps attribute access without a __dict__'''
+    assert impeach.status_text == 'Impeach Trump!'
+    assert not hasattr(impeach, '__dict__')
+
+
 def test_status_collection_init(status_collection):
     '''test UserStatusCollection init'''
     assert status_collection.database == {}
@@ -380,6 +483,190 @@ def test_userstatuscollection_search_status_return_status(status_collection, sta
     assert len(status_database) == initial_database_length
 
 
+def test_userstatuscollection_merge_rows(status_collection, status_database):
+    '''test merge_rows counts inserted and skipped statuses'''
+    status_collection.database = status_database
+    rows = [('XKPiC6*iW!H3#6', 'Hardline_Dem173', 'Impeach Trump!'),
+            ('byg8L^qJDjAkR6', 'Faithless_Floridian', 'God is dead!'),
+            ('byg8L^qJDjAkR6', 'Faithless_Floridian', 'God is back!')]
+
+    result = status_collection.merge_rows(rows)
+
+    assert result == (1, 2)
+    assert status_collection.database['byg8L^qJDjAkR6'].status_text == 'God is dead!'
+
+
+def test_userstatuscollection_merge_rows_malformed(status_collection):
+    '''test merge_rows raises TypeError on an empty row'''
+    with pytest.raises(TypeError):
+        status_collection.merge_rows([[]])
+
+
+def test_userstatuscollection_user_index(status_collection, status_database):
+    '''test assigning a database builds the user_id index'''
+    status_collection.database = status_database
+
+    assert status_collection.user_index == {
+        'Hardline_Dem173': {'XKPiC6*iW!H3#6': None},
+        'Hardline_GOP173': {'RbLr8!yCs*3DSC': None},
+        'The_Real_Bill_Nye': {'G5Yz%#kTda&TFt': None},
+    }
+
+
+def test_userstatuscollection_search_statuses_by_user(status_collection):
+    '''test the user_id index follows add, modify and delete'''
+    status_collection.add_status('eve_1', 'evmiles97', 'one')
+    status_collection.add_status('dave_1', 'dave03', 'two')
+    status_collection.add_status('eve_2', 'evmiles97', 'three')
+
+    timeline = status_collection.search_statuses_by_user('evmiles97')
+    assert [status.status_id for status in timeline] == ['eve_1', 'eve_2']
+
+    status_collection.modify_status('eve_1', 'dave03', 'one, by dave')
+    timeline = status_collection.search_statuses_by_user('dave03')
+    assert [status.status_id for status in timeline] == ['dave_1', 'eve_1']
+
+    status_collection.delete_status('eve_2')
+    assert status_collection.search_statuses_by_user('evmiles97') == []
+    assert 'evmiles97' not in status_collection.user_index
+
+
+def test_userstatuscollection_delete_statuses_by_user(status_collection):
+    '''test delete_statuses_by_user only removes that user's statuses'''
+    status_collection.add_status('eve_1', 'evmiles97', 'one')
+    status_collection.add_status('dave_1', 'dave03', 'two')
+    status_collection.add_status('eve_2', 'evmiles97', 'three')
+
+    assert status_collection.delete_statuses_by_user('evmiles97') == 2
+    assert list(status_collection.database) == ['dave_1']
+    assert status_collection.delete_statuses_by_user('evmiles97') == 0
+
+
+def test_userstatuscollection_search_status_shared_sentinel(status_collection):
+    '''test misses return the same read-only MISSING_STATUS'''
+    result = status_collection.search_status('test')
+
+    assert result is user_status.MISSING_STATUS
+    assert status_collection.search_status('other') is result
+    with pytest.raises(AttributeError):
+        result.status_text = 'test'
+
+
+def test_userstatuscollection_get_status(status_collection, status_database):
+    '''test get_status returns the status or None'''
+    status_collection.database = status_database
+
+    assert status_collection.get_status('XKPiC6*iW!H3#6').user_id == 'Hardline_Dem173'
+    assert status_collection.get_status('test') is None
+
+
+# interning tests
+
+
+def test_intern_id():
+    '''test intern_id returns one shared copy per id string'''
+    first = ''.join(['evmiles', '97'])
+    second = ''.join(['evmiles', '9', '7'])
+
+    assert first is not second
+    assert interning.intern_id(first) is interning.intern_id(second)
+    assert interning.intern_id(None) is None
+
+
+def test_collections_share_interned_ids(collection, status_collection):
+    '''test both collections store the same user_id object'''
+    collection.add_user(''.join(['dave', '03']), 'david.yuen@gmail.com',
+                        'David', 'Yuen')
+    status_collection.add_status('dave03_00001', ''.join(['dave', '0', '3']),
+                                 'Sunny in Seattle this morning')
+    status_collection.add_status('dave03_00002', ''.join(['da', 've03']),
+                                 'Rain again')
+
+    user_id = next(iter(collection.database))
+    for status in status_collection.database.values():
+        assert status.user_id is user_id
+
+
+# columnar status tests
+
+
+def test_columnar_status_collection_api():
+    '''test the columnar backend follows the UserStatusCollection API'''
+    collection = columnar_status.ColumnarStatusCollection()
+
+    assert collection.add_status('eve_1', 'evmiles97', 'Café open') is True
+    assert collection.add_status('eve_1', 'evmiles97', 'again') is False
+    assert collection.merge_rows([('dave_1', 'dave03', 'two'),
+                                  ('eve_2', 'evmiles97', 'three')]) == (2, 0)
+    assert collection.search_status('eve_1').status_text == 'Café open'
+    assert collection.search_status('nope') is user_status.MISSING_STATUS
+    assert collection.get_status('nope') is None
+
+    assert collection.modify_status('eve_1', 'dave03', 'moved') is True
+    assert collection.modify_status('nope', 'dave03', 'moved') is False
+    timeline = collection.search_statuses_by_user('dave03')
+    assert [(s.status_id, s.status_text) for s in timeline] == [
+        ('dave_1', 'two'), ('eve_1', 'moved')]
+
+    assert collection.delete_status('dave_1') is True
+    assert collection.delete_status('dave_1') is False
+    assert collection.delete_statuses_by_user('evmiles97') == 1
+    assert list(collection.database) == ['eve_1']
+    assert len(collection.database) == 1
+    with pytest.raises(KeyError):
+        collection.database['dave_1']
+
+
+def test_columnar_status_collection_compact():
+    '''test compaction drops tombstones and old text but keeps statuses'''
+    collection = columnar_status.ColumnarStatusCollection()
+    collection.merge_rows((f'status{number}', f'user{number % 3}', 'x' * 10)
+                          for number in range(3000))
+    for number in range(0, 3000, 2):
+        collection.delete_status(f'status{number}')
+    collection.modify_status('status1', 'user9', 'changed')
+
+    collection.compact()
+
+    assert collection.dead_rows == 0
+    assert len(collection.status_ids) == 1500
+    assert len(collection.arena) == 1499 * 10 + len('changed')
+    assert collection.search_status('status1').user_id == 'user9'
+    assert collection.search_status('status2999').status_text == 'x' * 10
+    assert len(collection.search_statuses_by_user('user0')) == 500
+
+
+def test_columnar_status_collection_auto_compact():
+    '''test compaction runs on its own once most rows are deleted'''
+    collection = columnar_status.ColumnarStatusCollection()
+    collection.merge_rows((f'status{number}', 'user', 'text')
+                          for number in range(3000))
+
+    collection.delete_statuses_by_user('user')
+
+    assert collection.status_ids == []
+    assert collection.arena == bytearray()
+
+
+def test_columnar_status_collection_main(temp_file):
+    '''test main loads into and saves from the columnar backend'''
+    collection = columnar_status.ColumnarStatusCollection()
+
+    assert main.load_status_updates('status_updates.csv', collection) is True
+    assert main.save_status_updates(temp_file, collection) is True
+    loaded = user_status.UserStatusCollection()
+    main.load_status_updates(temp_file, loaded)
+
+    clean_temp_file()
+
+    assert {key: value.status_text for key, value in loaded.database.items()} \
+        == {key: value.status_text for key, value in collection.database.items()}
+    assert main.search_status('dave03_00001', collection).user_id == 'dave03'
+    assert [status and status.status_text for status in
+            main.search_statuses_many(['ted_moop', 'nope'], collection)] == \
+        ['"Perfect weather for a hike"', None]
+
+
 # test main
 
 
@@ -453,6 +740,65 @@ def test_load_users_ignore_existing(filename, csv_collection):
     assert len(loaded_users) == 3
 
 
+def test_check_header():
+    '''test check_header ignores case and spaces, rejects empty files'''
+    assert main.check_header(['USER_ID', ' email', 'Name ', 'LASTNAME'],
+                             main.USER_HEADER) is True
+    assert main.check_header(['USER_ID', 'EMAIL'], main.USER_HEADER) is False
+    assert main.check_header(None, main.USER_HEADER) is False
+
+
+def test_load_users_bad_header(collection):
+    '''test load users rejects a file without the accounts header'''
+    file = '''STATUS_ID,USER_ID,STATUS_TEXT
+evmiles97,eve.miles@uw.edu,Eve,Miles'''
+
+    with patch('builtins.open', mock_open(read_data=file)) as mock_file:
+        result = main.load_users(mock_file, collection)
+
+    assert result is False
+    assert collection.database == {}
+
+
+def test_load_users_streams_rows(filename, collection):
+    '''test load users passes each row to add_user as it is read'''
+    collection.add_user = Mock(return_value=True)
+
+    result = main.load_users(filename, collection)
+
+    assert result is True
+    assert collection.add_user.call_count == 3
+    first_call = collection.add_user.call_args_list[0]
+    assert first_call == call('evmiles97', 'eve.miles@uw.edu', 'Eve', 'Miles')
+
+
+def test_load_users_report(filename, csv_collection):
+    '''test load users fills in a LoadReport when one is given'''
+    report = main.LoadReport()
+
+    result = main.load_users(filename, csv_collection, report)
+
+    assert result is True
+    assert report.rows_read == 3
+    assert report.inserted == 1
+    assert report.skipped == 2
+    assert report.rejected == 0
+    assert report.bytes_read == os.path.getsize(filename)
+    assert report.elapsed > 0
+
+
+def test_load_users_report_rejected(collection):
+    '''test malformed rows are counted and the good rows still load'''
+    report = main.LoadReport()
+
+    result = main.load_users('missing_fields.csv', collection, report)
+
+    assert result is False
+    assert report.rows_read == 2
+    assert report.rejected == 2
+    assert report.inserted == 0
+
+
 def test_save_users_false(collection):
     '''
     Saves all users in user_collection into
@@ -504,6 +850,87 @@ def test_save_users_existing_file(temp_file, csv_collection):
     assert comparison
 
 
+def test_save_users_chunked(temp_file, database):
+    '''test save users writes the same file whatever the chunk size'''
+    collection = users.UserCollection()
+    collection.database = database
+
+    texts = []
+    for chunk_rows in (1, 2, 3, 1000):
+        main.save_users(temp_file, collection, chunk_rows)
+        with open(temp_file, 'r') as file:
+            texts.append(file.read())
+
+    clean_temp_file()
+
+    assert len(set(texts)) == 1
+    assert not texts[0].endswith('\n')
+    assert texts[0].count('\n') == 3
+
+
+def test_write_csv_chunks():
+    '''test write_csv only writes once per chunk of rows'''
+    csvfile = Mock()
+    rows = [('a', 'b', 'c')] * 5
+
+    main.write_csv(csvfile, main.STATUS_HEADER, rows, chunk_rows=2)
+
+    assert csvfile.write.call_count == 3
+    written = ''.join(args[0] for args, _ in csvfile.write.call_args_list)
+    assert written == 'STATUS_ID,USER_ID,STATUS_TEXT' + '\na,b,c' * 5
+
+
+def test_save_users_atomic(temp_file, csv_collection):
+    '''test an atomic save writes the same file and leaves no temp file'''
+    main.save_users(temp_file, csv_collection)
+    with open(temp_file, 'r') as file:
+        plain = file.read()
+
+    result = main.save_users(temp_file, csv_collection, atomic=True)
+    with open(temp_file, 'r') as file:
+        atomic = file.read()
+
+    clean_temp_file()
+
+    assert result is True
+    assert atomic == plain
+    assert not [name for name in os.listdir('.') if name.endswith('.tmp')]
+
+
+def test_save_users_atomic_failure_keeps_old_file(temp_file, csv_collection):
+    '''test a failed atomic save leaves the previous file in place'''
+    main.save_users(temp_file, csv_collection)
+    with open(temp_file, 'r') as file:
+        before = file.read()
+
+    with patch('main.write_csv', side_effect=OSError('disk full')):
+        result = main.save_users(temp_file, users.UserCollection(),
+                                 atomic=True)
+    with open(temp_file, 'r') as file:
+        after = file.read()
+
+    clean_temp_file()
+
+    assert result is False
+    assert after == before
+    assert not [name for name in os.listdir('.') if name.endswith('.tmp')]
+
+
+def test_save_users_in_background(temp_file, csv_collection):
+    '''test a background save writes the collection as it was when called'''
+    future = main.save_users_in_background(temp_file, csv_collection)
+    csv_collection.modify_user('dave03', 'dave@example.com', 'Dave', 'Yuen')
+
+    result = future.result()
+    with open(temp_file, 'r') as file:
+        text = file.read()
+
+    clean_temp_file()
+
+    assert result is True
+    assert 'david.yuen@gmail.com' in text
+
+
 def test_load_status_updates_false(status_collection, status_database):
     '''
     Opens a CSV file with status data and
@@ -554,6 +981,160 @@ def test_load_status_updates_not_exists(status_collection):
     assert status_collection.database != old_database
 
 
+def test_load_status_updates_bad_header(status_collection):
+    '''test load status rejects a file without the status header'''
+    result = main.load_status_updates('accounts.csv', status_collection)
+
+    assert result is False
+    assert status_collection.database == {}
+
+
+def test_load_status_updates_no_output(status_collection, capsys):
+    '''test load status does not print the datasets'''
+    report = main.LoadReport()
+
+    result = main.load_status_updates('missing_fields_status.csv',
+                                      status_collection, report)
+
+    assert result is False
+    assert capsys.readouterr().out == ''
+    assert report.inserted == 1
+    assert report.rejected == 3
+
+
+def test_csv_chunk_bounds(temp_file):
+    '''test chunk boundaries fall right after newlines'''
+    with open(temp_file, 'w') as file:
+        file.write('STATUS_ID,USER_ID,STATUS_TEXT\n')
+        file.write(''.join(f's{number},u,text {number}\n'
+                           for number in range(100)))
+
+    bounds = main.csv_chunk_bounds(temp_file, 7)
+    with open(temp_file, 'rb') as file:
+        data = file.read()
+
+    clean_temp_file()
+
+    assert bounds[0] == len('STATUS_ID,USER_ID,STATUS_TEXT\n')
+    assert bounds[-1] == len(data)
+    assert len(bounds) == 8
+    for bound in bounds:
+        assert data[bound - 1:bound] == b'\n'
+
+
+def test_load_status_updates_parallel(temp_file, status_collection):
+    '''test a parallel load matches a serial one, first occurrence wins'''
+    with open(temp_file, 'w') as file:
+        file.write('STATUS_ID,USER_ID,STATUS_TEXT\n')
+        file.write('\n'.join(f's{number % 700},u{number},text {number}'
+                              for number in range(1000)))
+    serial = user_status.UserStatusCollection()
+    main.load_status_updates(temp_file, serial)
+    report = main.LoadReport()
+
+    with patch('main.PARALLEL_CHUNK_BYTES', 1000):
+        result = main.load_status_updates(temp_file, status_collection,
+                                          report, workers=2)
+
+    clean_temp_file()
+
+    assert result is True
+    assert list(main.status_rows(status_collection)) == \
+        list(main.status_rows(serial))
+    assert (report.rows_read, report.inserted, report.skipped) == \
+        (1000, 700, 300)
+
+
+def test_load_status_updates_parallel_quoted_newlines(temp_file,
+                                                      status_collection):
+    '''test chunks never split a quoted field that holds newlines'''
+    saved = user_status.UserStatusCollection()
+    saved.merge_rows((f's{number}', 'u', f'hello, "world" | pipe\n{number}'
+                      '\n' * (number % 3))
+                     for number in range(300))
+    main.save_status_updates(temp_file, saved)
+
+    with patch('main.PARALLEL_CHUNK_BYTES', 100):
+        result = main.load_status_updates(temp_file, status_collection,
+                                          workers=2)
+        bounds = main.csv_chunk_bounds(temp_file, 50)
+    with open(temp_file, 'rb') as file:
+        data = file.read()
+
+    clean_temp_file()
+
+    assert result is True
+    assert list(main.status_rows(status_collection)) == \
+        list(main.status_rows(saved))
+    assert len(bounds) > 40
+    for bound in bounds[1:-1]:
+        assert data[bound:bound + 1] == b's'
+
+
+def test_load_status_updates_parallel_stray_pipes(temp_file,
+                                                  status_collection):
+    '''test | inside unquoted fields does not confuse the chunk split'''
+    with open(temp_file, 'w') as file:
+        file.write('STATUS_ID,USER_ID,STATUS_TEXT\n')
+        file.write('s0,u,a | b\n')
+        file.write(''.join(f's{number},u,|line one\nline {number}|\n'
+                           if number % 10 == 0 else
+                           f's{number},u,text {number}\n'
+                           for number in range(1, 200)))
+        file.write('s200,u,c | d')
+    serial = user_status.UserStatusCollection()
+    assert main.load_status_updates(temp_file, serial) is True
+
+    with patch('main.PARALLEL_CHUNK_BYTES', 300):
+        result = main.load_status_updates(temp_file, status_collection,
+                                          workers=2)
+
+    clean_temp_file()
+
+    assert result is True
+    assert list(main.status_rows(status_collection)) == \
+        list(main.status_rows(serial))
+    assert serial.search_status('s30').status_text == 'line one\nline 30'
+
+
+def test_csv_chunk_bounds_match_serial_parse(temp_file):
+    '''test chunks parse to the same rows as the whole file, for files
+    mixing quoted fields, stray |, || and every kind of newline'''
+    pieces = ['a', '|', ',', '\n', '||', ' ', '\r\n', '\r']
+    for seed in range(40):
+        generator = random.Random(seed)
+        lines = ['STATUS_ID,USER_ID,STATUS_TEXT\n']
+        for number in range(generator.randint(0, 40)):
+            text = ''.join(generator.choice(pieces)
+                           for _ in range(generator.randint(0, 8)))
+            buffer = io.StringIO()
+            csv.writer(buffer, quotechar='|', lineterminator='\n') \
+                .writerow([f's{number}', 'u', text])
+            lines.append(buffer.getvalue() if generator.random() < 0.5
+                         else f's{number},u,{text}\n')
+        with open(temp_file, 'w', newline='') as file:
+            file.write(''.join(lines))
+        with open(temp_file, 'r', newline='') as file:
+            expected = list(csv.reader(file, quotechar='|'))[1:]
+
+        for chunks in (2, 7, 60):
+            bounds = main.csv_chunk_bounds(temp_file, chunks)
+            assert [row for start, end in zip(bounds, bounds[1:])
+                    for row in main.parse_csv_chunk(temp_file, start,
+                                                    end)] == expected
+
+    clean_temp_file()
+
+
+def test_load_status_updates_parallel_false(status_collection):
+    '''test a parallel load reports bad headers and malformed rows'''
+    assert main.load_status_updates('accounts.csv', status_collection,
+                                    workers=2) is False
+    assert main.load_status_updates('missing_fields_status.csv',
+                                    status_collection, workers=2) is False
+    assert list(status_collection.database) == ['evmiles97_00002']
+
+
 def test_save_status_updates_false(status_collection):
     '''
     Saves all statuses in status_collection into
@@ -596,6 +1177,36 @@ def test_save_status_updates_not_exists(status_collection):
     assert text != ''
 
 
+def test_save_status_updates_round_trip(temp_file, status_collection):
+    '''test statuses with commas survive a save and a load'''
+    status_collection.add_status('dave03_00002', 'dave03', 'Rain, then sun')
+
+    main.save_status_updates(temp_file, status_collection)
+    loaded = user_status.UserStatusCollection()
+    result = main.load_status_updates(temp_file, loaded)
+
+    clean_temp_file()
+
+    assert result is True
+    assert loaded.database['dave03_00002'].status_text == 'Rain, then sun'
+
+
+def test_save_status_updates_in_background(temp_file, status_collection,
+                                           status_database):
+    '''test a background status save can be loaded back'''
+    status_collection.database = status_database
+
+    result = main.save_status_updates_in_background(temp_file,
+                                                    status_collection).result()
+    loaded = user_status.UserStatusCollection()
+    main.load_status_updates(temp_file, loaded)
+
+    clean_temp_file()
+
+    assert result is True
+    assert set(loaded.database) == set(status_database)
+
+
 def test_add_user_false(tolby, collection, database):
     '''
     Creates a new instance of User and stores it in user_collection
@@ -633,6 +1244,30 @@ def test_add_user_true(tolby, collection):
     assert result is True
 
 
+def test_add_user_uses_collection_check():
+    '''test add user relies on UserCollection.add_user, not a scan'''
+    mock_collection = Mock()
+    mock_collection.add_user.return_value = False
+
+    result = main.add_user('evmiles97', 'eve.miles@uw.edu', 'Eve', 'Miles',
+                           mock_collection)
+
+    assert result is False
+    mock_collection.database.items.assert_not_called()
+
+
+def test_bulk_add_users(collection, database):
+    '''test bulk add users inserts new users and skips existing ones'''
+    collection.database = database
+    rows = [('evmiles97', 'eve.miles@uw.edu', 'Eve', 'Miles'),
+            ('Big****123', 'AElrick@BTISolutions.com', 'My', 'Secret')]
+
+    result = main.bulk_add_users(rows, collection)
+
+    assert result == (1, 1)
+    assert collection.database['Big****123'].user_last_name == 'Secret'
+
+
 def test_update_user_false(tolby, collection):
     '''
     Updates the values of an existing user
@@ -693,6 +1328,46 @@ def test_delete_user_true(collection, database):
     assert result is True
 
 
+def test_delete_user_cascade(collection, database, status_collection):
+    '''test deleting a user also deletes their statuses'''
+    collection.database = database
+    status_collection.add_status('eve_1', 'evmiles97', 'one')
+    status_collection.add_status('dave_1', 'dave03', 'two')
+
+    result = main.delete_user_cascade('evmiles97', collection,
+                                      status_collection)
+
+    assert result is True
+    assert 'evmiles97' not in collection.database
+    assert list(status_collection.database) == ['dave_1']
+
+
+def test_delete_user_cascade_false(collection, status_collection):
+    '''test a missing user leaves the statuses alone'''
+    status_collection.add_status('eve_1', 'evmiles97', 'one')
+
+    result = main.delete_user_cascade('evmiles97', collection,
+                                      status_collection)
+
+    assert result is False
+    assert list(status_collection.database) == ['eve_1']
+
+
+def test_delete_users_cascade(collection, database, status_collection):
+    '''test the batch cascade counts only the users it deleted'''
+    collection.database = database
+    status_collection.add_status('eve_1', 'evmiles97', 'one')
+    status_collection.add_status('dave_1', 'dave03', 'two')
+    status_collection.add_status('tolby_1', 'Cool_kid187', 'three')
+
+    result = main.delete_users_cascade(['evmiles97', 'dave03', 'nobody'],
+                                       collection, status_collection)
+
+    assert result == 2
+    assert list(collection.database) == ['Cool_kid187']
+    assert list(status_collection.database) == ['tolby_1']
+
+
 def test_search_user(collection, database):
     '''
     Searches for a user in user_collection
@@ -839,5 +1514,1303 @@ def test_search_status(status_collection, status_database):
     assert result is None
 
 
+def test_search_statuses_by_user(status_collection, status_database):
+    '''test main search_statuses_by_user returns the user's statuses'''
+    status_collection.database = status_database
+
+    result = main.search_statuses_by_user('Hardline_GOP173', status_collection)
+
+    assert [status.status_id for status in result] == ['RbLr8!yCs*3DSC']
+    assert main.search_statuses_by_user('nobody', status_collection) == []
+
+
+def test_search_user_by_email(collection):
+    '''test main rejects duplicate emails on add and load and finds by email'''
+    assert main.load_users('accounts.csv', collection) is True
+    assert main.add_user('eve2', 'EVE.miles@uw.edu', 'Eve', 'Miles',
+                         collection) is False
+    assert main.update_user('dave03', 'Eve.Miles@uw.edu', 'D', 'Y',
+                            collection) is False
+    assert main.search_user_by_email('Eve.Miles@UW.EDU',
+                                     collection).user_id == 'evmiles97'
+    assert main.search_user_by_email('nobody@x', collection) is None
+
+    report = main.LoadReport()
+    other = users.UserCollection()
+    other.add_user('first', 'DAVID.YUEN@gmail.com', 'F', 'F')
+    assert main.load_users('accounts.csv', other, report) is True
+    assert report.skipped == 1
+    assert main.search_user('dave03', other) is None
+
+
+def test_search_users_many(collection, database):
+    '''test main search_users_many keeps the order and gives None for misses'''
+    collection.database = database
+
+    result = main.search_users_many(
+        iter(['dave03', 'ClicheKHFan', 'evmiles97', 'dave03']), collection)
+
+    assert [user and user.user_id for user in result] == \
+        ['dave03', None, 'evmiles97', 'dave03']
+    assert main.search_users_many([], collection) == []
+
+
+def test_search_statuses_many(status_collection, status_database):
+    '''test main search_statuses_many keeps the order and gives None for misses'''
+    status_collection.database = status_database
+
+    result = main.search_statuses_many(['test', 'RbLr8!yCs*3DSC'],
+                                       status_collection)
+
+    assert result[0] is None
+    assert result[1].user_id == 'Hardline_GOP173'
+
+
+def test_snapshot_round_trip(temp_file, database, status_database):
+    '''test a snapshot loads back the same users and statuses'''
+    user_collection = users.UserCollection()
+    user_collection.database = database
+    status_collection = user_status.UserStatusCollection()
+    status_collection.database = status_database
+    status_collection.add_status('eve_1', 'evmiles97', 'Café, then a hike')
+    status_collection.add_status('eve_2', 'evmiles97', 'NUL \0 inside')
+
+    assert main.save_snapshot(temp_file, user_collection,
+                              status_collection) is True
+    loaded_users = users.UserCollection()
+    loaded_stati = user_status.UserStatusCollection()
+    result = main.load_snapshot(temp_file, loaded_users, loaded_stati)
+
+    clean_temp_file()
+
+    assert result is True
+    assert list(main.user_rows(loaded_users)) == \
+        list(main.user_rows(user_collection))
+    assert list(main.status_rows(loaded_stati)) == \
+        list(main.status_rows(status_collection))
+
+
+def test_snapshot_empty_collections(temp_file, collection, status_collection):
+    '''test empty collections make a valid snapshot'''
+    assert main.save_snapshot(temp_file, collection, status_collection)
+
+    result = main.load_snapshot(temp_file, collection, status_collection)
+
+    clean_temp_file()
+
+    assert result is True
+    assert collection.database == {}
+
+
+def test_load_snapshot_false(temp_file, csv_collection, collection,
+                             status_collection):
+    '''test empty, foreign and truncated files are rejected'''
+    assert main.load_snapshot(temp_file, collection, status_collection) is False
+    assert main.load_snapshot('accounts.csv', collection,
+                              status_collection) is False
+
+    main.save_snapshot(temp_file, csv_collection, status_collection)
+    with open(temp_file, 'rb+') as file:
+        file.truncate(os.path.getsize(temp_file) - 1)
+    result = main.load_snapshot(temp_file, collection, status_collection)
+
+    clean_temp_file()
+
+    assert result is False
+    assert collection.database == {}
+
+
+def test_load_snapshot_corrupt_text(temp_file, csv_collection, collection,
+                                    status_collection):
+    '''test a snapshot with invalid UTF-8 is rejected before any merge'''
+    stati = user_status.UserStatusCollection()
+    stati.add_status('eve_1', 'evmiles97', 'hike')
+    main.save_snapshot(temp_file, csv_collection, stati)
+    with open(temp_file, 'rb+') as file:
+        # the last byte of the last status_text, before its NUL
+        file.seek(-2, os.SEEK_END)
+        file.write(b'\xff')
+    result = main.load_snapshot(temp_file, collection, status_collection)
+
+    clean_temp_file()
+
+    assert result is False
+    assert collection.database == {}
+    assert status_collection.database == {}
+
+
+def test_load_snapshot_corrupt_offsets(temp_file, csv_collection, collection,
+                                       status_collection):
+    '''test a snapshot with misplaced offsets is rejected before any merge'''
+    main.save_snapshot(temp_file, csv_collection, status_collection)
+    with open(temp_file, 'rb') as file:
+        data = bytearray(file.read())
+    table = snapshot.HEADER.size
+    swapped = bytearray(data)
+    # the end offsets of the first two strings, in the other order
+    swapped[table:table + 16] = data[table + 8:table + 16] + \
+        data[table:table + 8]
+    shifted = bytearray(data)
+    # the first string ends one byte early, off its NUL
+    shifted[table:table + 8] = (int.from_bytes(data[table:table + 8],
+                                               'little') - 1).to_bytes(
+                                                   8, 'little')
+
+    results = []
+    for corrupt in (swapped, shifted):
+        with open(temp_file, 'wb') as file:
+            file.write(corrupt)
+        results.append(main.load_snapshot(temp_file, collection,
+                                          status_collection))
+    clean_temp_file()
+
+    assert results == [False, False]
+    assert collection.database == {}
+
+
+def test_save_snapshot_false(collection, status_collection):
+    '''test save snapshot returns False for an invalid filename'''
+    filename = ' C:by.pyg8 : L^qJ/D-jA.kR6'
+
+    result = main.save_snapshot(filename, collection, status_collection)
+
+    assert result is False
+
+
+# operation log tests
+
+
+@pytest.fixture
+def log_file():
+    '''return the name of an operation log, removed after the test'''
+    filename = 'test.log'
+
+    yield filename
+
+    for name in (filename, 'test.snapshot'):
+        if os.path.exists(name):
+            os.remove(name)
+
+
+def test_oplog_replays_main_operations(log_file, collection, status_collection):
+    '''test successful main operations are logged and replayed'''
+    log = oplog.OperationLog(log_file)
+    main.add_user('evmiles97', 'eve.miles@uw.edu', 'Eve', 'Miles', collection,
+                  log)
+    main.add_user('evmiles97', 'again@uw.edu', 'Eve', 'Miles', collection, log)
+    main.add_user('dave03', 'david.yuen@gmail.com', 'David', 'Yuen',
+                  collection, log)
+    main.update_user('dave03', 'dave@example.com', 'Dave', 'Yuen', collection,
+                     log)
+    main.add_status('evmiles97', 'eve_1', 'one', status_collection, log)
+    main.add_status('dave03', 'dave_1', 'two', status_collection, log)
+    main.add_status('dave03', 'dave_2', 'three', status_collection, log)
+    main.update_status('eve_1', 'evmiles97', 'one, edited', status_collection,
+                       log)
+    main.delete_status('dave_2', status_collection, log)
+    main.delete_user_cascade('dave03', collection, status_collection, log)
+    main.delete_user('nobody', collection, log)
+    log.close()
+
+    users_after = users.UserCollection()
+    stati_after = user_status.UserStatusCollection()
+    applied = oplog.replay(log_file, users_after, stati_after)
+
+    assert applied == 10
+    assert list(main.user_rows(users_after)) == list(main.user_rows(collection))
+    assert list(main.status_rows(stati_after)) == \
+        [('eve_1', 'evmiles97', 'one, edited')]
+
+
+def test_oplog_replays_bulk_add_users(log_file, collection):
+    '''test users added in bulk are logged and replayed'''
+    log = oplog.OperationLog(log_file)
+    main.add_user('dave03', 'david.yuen@gmail.com', 'David', 'Yuen',
+                  collection, log)
+    rows = [('evmiles97', 'eve.miles@uw.edu', 'Eve', 'Miles'),
+            ('dave03', 'dave@x', 'Dave', 'Y'),
+            ('taken', 'DAVID.yuen@gmail.com', 'T', 'K'),
+            ('Cool_kid187', 'mommasboy2001@gmail.com', 'Tolby', 'Bryant')]
+    assert main.bulk_add_users(rows, collection, log) == (2, 2)
+    log.close()
+
+    users_after = users.UserCollection()
+    applied = oplog.replay(log_file, users_after,
+                           user_status.UserStatusCollection())
+
+    assert applied == 3
+    assert list(main.user_rows(users_after)) == list(main.user_rows(collection))
+
+
+def test_oplog_torn_tail(log_file, collection, status_collection):
+    '''test a half-written record is ignored and dropped on reopen'''
+    log = oplog.OperationLog(log_file)
+    log.append('au', 'evmiles97', 'eve.miles@uw.edu', 'Eve', 'Miles')
+    log.close()
+    good_size = os.path.getsize(log_file)
+    with open(log_file, 'ab') as file:
+        file.write(b'\x30\x00\x00\x00\x01\x02\x03\x04["au","da')
+
+    assert oplog.replay(log_file, collection, status_collection) == 1
+
+    log = oplog.OperationLog(log_file)
+    log.append('du', 'evmiles97')
+    log.close()
+
+    assert os.path.getsize(log_file) > good_size
+    assert oplog.replay(log_file, users.UserCollection(), status_collection) \
+        == 2
+    assert oplog.replay('missing.log', collection, status_collection) == 0
+
+
+def test_oplog_group_commit(log_file):
+    '''test records are fsynced in groups of sync_every'''
+    log = oplog.OperationLog(log_file, sync_every=3)
+
+    with patch('oplog.os.fsync') as mock_fsync:
+        for number in range(7):
+            log.append('du', f'user{number}')
+        assert mock_fsync.call_count == 2
+        log.close()
+        assert mock_fsync.call_count == 3
+
+
+def test_oplog_sync_interval(log_file):
+    '''test a record is fsynced once sync_interval has passed'''
+    log = oplog.OperationLog(log_file, sync_every=100, sync_interval=0)
+
+    with patch('oplog.os.fsync') as mock_fsync:
+        log.append('du', 'evmiles97')
+        assert mock_fsync.call_count == 1
+        log.close()
+
+
+def test_recover_and_compact(log_file, collection, status_collection):
+    '''test recovery replays the log tail on top of the last snapshot'''
+    snapshot = 'test.snapshot'
+    log = oplog.OperationLog(log_file)
+    main.add_user('evmiles97', 'eve.miles@uw.edu', 'Eve', 'Miles', collection,
+                  log)
+    assert main.compact_oplog(snapshot, log, collection, status_collection)
+    assert os.path.getsize(log_file) == 0
+    main.add_status('evmiles97', 'eve_1', 'after the snapshot',
+                    status_collection, log)
+    log.close()
+
+    users_after = users.UserCollection()
+    stati_after = user_status.UserStatusCollection()
+    result = main.recover(snapshot, log_file, users_after, stati_after)
+
+    assert result is True
+    assert list(users_after.database) == ['evmiles97']
+    assert list(stati_after.database) == ['eve_1']
+
+
+def test_recover_false(log_file, temp_file, collection, status_collection):
+    '''test recovery stops when the snapshot is damaged'''
+    assert main.recover('missing.snapshot', log_file, collection,
+                        status_collection) is True
+    assert main.recover(temp_file, log_file, collection,
+                        status_collection) is False
+
+    clean_temp_file()
+
+
+def test_compact_oplog_false(log_file, collection, status_collection):
+    '''test a failed snapshot keeps the log'''
+    log = oplog.OperationLog(log_file)
+    log.append('du', 'evmiles97')
+
+    result = main.compact_oplog(' C:by.pyg8 : L^qJ/D-jA.kR6', log, collection,
+                                status_collection)
+    log.close()
+
+    assert result is False
+    assert os.path.getsize(log_file) > 0
+
+
+# sqlite backend tests
+
+
+@pytest.fixture
+def sqlite_file():
+    '''return the name of a SQLite database, removed after the test'''
+    filename = 'test.sqlite'
+
+    yield filename
+
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(filename + suffix):
+            os.remove(filename + suffix)
+
+
+def test_init_collections_backends(sqlite_file):
+    '''test init_*_collection pick the requested backend'''
+    user_collection = main.init_user_collection('sqlite', sqlite_file)
+    status_collection = main.init_status_collection('sqlite', sqlite_file)
+
+    assert isinstance(user_collection, sqlite_backend.SQLiteUserCollection)
+    assert isinstance(status_collection, sqlite_backend.SQLiteStatusCollection)
+    assert isinstance(main.init_status_collection('columnar'),
+                      columnar_status.ColumnarStatusCollection)
+    journal = user_collection.connection.execute('PRAGMA journal_mode')
+    assert journal.fetchone()[0] == 'wal'
+    with pytest.raises(ValueError):
+        main.init_user_collection('redis')
+    with pytest.raises(ValueError):
+        main.init_status_collection('redis')
+
+
+def test_sqlite_user_collection(sqlite_file):
+    '''test the SQLite users backend keeps the UserCollection contract'''
+    collection = main.init_user_collection('sqlite', sqlite_file)
+
+    assert main.load_users('accounts.csv', collection) is True
+    assert collection.add_user('evmiles97', 'x', 'y', 'z') is False
+    assert main.add_user('Big****123', 'AElrick@BTISolutions.com', 'My',
+                         'Secret', collection) is True
+    assert collection.modify_user('dave03', 'dave@example.com', 'Dave',
+                                  'Yuen') is True
+    assert collection.modify_user('nobody', 'x', 'y', 'z') is False
+    assert collection.delete_user('Cool_kid187') is True
+    assert collection.delete_user('Cool_kid187') is False
+    assert main.search_user('dave03', collection).email == 'dave@example.com'
+    assert main.search_user('nobody', collection) is None
+    assert collection.search_user('nobody') is users.MISSING_USER
+    assert collection.search_user('evmiles97').user_last_name == 'Miles'
+    assert list(collection.database) == ['evmiles97', 'dave03', 'Big****123']
+    assert len(collection.database) == 3
+    with pytest.raises(KeyError):
+        collection.database['nobody']
+
+    reopened = main.init_user_collection('sqlite', sqlite_file)
+    assert reopened.database['evmiles97'].user_name == 'Eve'
+
+
+def test_sqlite_user_email_index(sqlite_file):
+    '''test the SQLite users backend keeps emails unique and indexed'''
+    collection = main.init_user_collection('sqlite', sqlite_file)
+    main.load_users('accounts.csv', collection)
+
+    assert main.add_user('eve2', ' EVE.miles@uw.edu', 'E', 'M',
+                         collection) is False
+    assert main.update_user('dave03', 'eve.miles@UW.edu', 'D', 'Y',
+                            collection) is False
+    assert main.search_user('dave03', collection).user_name == 'David'
+    assert collection.merge_rows([('a', '', 'A', 'A'), ('b', '', 'B', 'B'),
+                                  ('c', 'Mommasboy2001@gmail.com', 'C',
+                                   'C')]) == (2, 1)
+    assert main.search_user_by_email('MOMMASBOY2001@gmail.com',
+                                     collection).user_id == 'Cool_kid187'
+    assert collection.search_user_by_email('') is users.MISSING_USER
+    plan = collection.connection.execute(
+        "EXPLAIN QUERY PLAN SELECT * FROM users WHERE email_key(email) = ? "
+        "AND email_key(email) <> ''", ('x',)).fetchall()
+    assert 'users_email' in plan[0][-1]
+
+
+def test_user_email_none(collection):
+    '''test a user without a str email is added and updated as having none'''
+    assert main.add_user('x', None, 'a', 'b', collection) is True
+    assert main.add_user('y', None, 'c', 'd', collection) is True
+    assert main.update_user('x', None, 'e', 'f', collection) is True
+    assert main.update_user('y', 'y@example.com', 'c', 'd', collection) is True
+    assert main.update_user('y', None, 'c', 'd', collection) is True
+    assert collection.email_index == {}
+    assert main.search_user_by_email(None, collection) is None
+    collection.database = dict(collection.database)
+    assert collection.email_index == {}
+
+
+def test_sqlite_user_email_none(sqlite_file):
+    '''test the SQLite users backend treats a NULL email as none'''
+    collection = main.init_user_collection('sqlite', sqlite_file)
+
+    assert main.add_user('x', None, 'a', 'b', collection) is True
+    assert main.add_user('y', None, 'c', 'd', collection) is True
+    assert main.update_user('x', None, 'e', 'f', collection) is True
+    assert main.search_user('x', collection).user_name == 'e'
+    assert main.search_user_by_email(None, collection) is None
+
+
+def test_sqlite_status_collection(sqlite_file, temp_file):
+    '''test the SQLite status backend keeps the UserStatusCollection contract'''
+    collection = main.init_status_collection('sqlite', sqlite_file)
+
+    assert main.load_status_updates('status_updates.csv', collection) is True
+    assert main.add_status('dave03', 'dave03_00001', 'dup', collection) is False
+    assert collection.modify_status('ted_00002', 'dave03', 'moved') is True
+    assert collection.modify_status('nobody', 'dave03', 'x') is False
+    timeline = main.search_statuses_by_user('dave03', collection)
+    assert [status.status_id for status in timeline] == ['dave03_00001',
+                                                          'ted_00002']
+    assert collection.search_status('nobody') is user_status.MISSING_STATUS
+    assert collection.search_status('ted_00002').status_text == 'moved'
+    assert collection.delete_status('ted_00002') is True
+    assert collection.delete_status('ted_00002') is False
+    assert collection.delete_statuses_by_user('evmiles97') == 2
+    assert main.search_status('dave03_00001', collection).user_id == 'dave03'
+    assert main.save_status_updates(temp_file, collection) is True
+
+    with open(temp_file, 'r') as file:
+        text = file.read()
+    clean_temp_file()
+
+    assert text == ('STATUS_ID,USER_ID,STATUS_TEXT\n'
+                    'dave03_00001,dave03,"Sunny in Seattle this morning"\n'
+                    'ted_moop,ted,"Perfect weather for a hike"')
+
+
+def test_timeline_order_backends(sqlite_file, shard_pool):
+    '''test a reassigned status goes to the end of the new user's timeline'''
+    for collection in (main.init_status_collection(),
+                       main.init_status_collection('concurrent'),
+                       main.init_status_collection('columnar'),
+                       main.init_status_collection('sqlite', sqlite_file),
+                       shard_pool.statuses):
+        for status_id, user_id in (('a', 'u1'), ('b', 'u2'), ('c', 'u1')):
+            assert main.add_status(user_id, status_id, 'x', collection)
+        assert main.update_status('b', 'u1', 'y', collection) is True
+        assert main.update_status('a', 'u1', 'z', collection) is True
+        collection.merge_rows([('d', 'u1', 'x')])
+        assert [status.status_id for status in main.search_statuses_by_user(
+            'u1', collection)] == ['a', 'c', 'b', 'd']
+
+
+def test_sqlite_migrates_statuses_seq(sqlite_file):
+    '''test a database without the seq column gets it, in rowid order'''
+    connection = sqlite3.connect(sqlite_file)
+    with connection:
+        connection.execute('CREATE TABLE statuses (status_id TEXT PRIMARY KEY, '
+                           'user_id TEXT, status_text TEXT)')
+        connection.executemany('INSERT INTO statuses VALUES (?, ?, ?)',
+                               [('a', 'u', 'x'), ('b', 'u', 'y')])
+    connection.close()
+
+    collection = main.init_status_collection('sqlite', sqlite_file)
+    assert main.add_status('u', 'c', 'z', collection) is True
+    assert [status.status_id for status in main.search_statuses_by_user(
+        'u', collection)] == ['a', 'b', 'c']
+
+
+def test_sqlite_merge_rows_batches(sqlite_file):
+    '''test merge_rows counts across several executemany batches'''
+    collection = main.init_status_collection('sqlite', sqlite_file)
+    rows = [(f's{number % 25}', 'u', 'text') for number in range(40)]
+
+    with patch('sqlite_backend.MERGE_BATCH_ROWS', 10):
+        result = collection.merge_rows(iter(rows))
+
+    assert result == (25, 15)
+    assert len(collection.database) == 25
+
+
+def test_sqlite_search_many_batches(sqlite_file):
+    '''test batch lookups split into IN queries and keep duplicates and order'''
+    user_collection = main.init_user_collection('sqlite', sqlite_file)
+    main.load_users('accounts.csv', user_collection)
+    status_collection = main.init_status_collection('sqlite', sqlite_file)
+    main.load_status_updates('status_updates.csv', status_collection)
+    user_ids = ['Cool_kid187', 'nobody', 'evmiles97', 'dave03', 'evmiles97']
+
+    with patch('sqlite_backend.LOOKUP_BATCH_IDS', 2):
+        result = main.search_users_many(user_ids, user_collection)
+        statuses = main.search_statuses_many(['ted_moop', 'x'],
+                                             status_collection)
+
+    assert [user and user.user_id for user in result] == \
+        ['Cool_kid187', None, 'evmiles97', 'dave03', 'evmiles97']
+    assert statuses[0].user_id == 'ted'
+    assert statuses[1] is None
+
+
+# cache tests
+
+
+def test_lru_cache_evicts_least_recently_used():
+    '''test the LRU order, entry limit and counters'''
+    lru = cache.LRUCache(max_entries=2)
+    lru.put('a', 'A')
+    lru.put('b', 'B')
+    assert lru.get('a') == 'A'
+    lru.put('c', 'C')
+
+    assert lru.get('b') is None
+    assert list(lru.entries) == ['a', 'c']
+    assert lru.stats() == {'entries': 2, 'bytes': 0, 'hits': 1, 'misses': 1,
+                           'evictions': 1}
+
+
+def test_lru_cache_byte_limit(eve, dave, tolby):
+    '''test max_bytes bounds the estimated size of the cached records'''
+    lru = cache.LRUCache(max_entries=None,
+                         max_bytes=cache.record_size(eve) +
+                         cache.record_size(dave))
+    lru.put('evmiles97', eve)
+    lru.put('dave03', dave)
+    lru.put('Cool_kid187', tolby)
+
+    assert 'evmiles97' not in lru.entries
+    assert lru.bytes <= lru.max_bytes
+    lru.invalidate('dave03')
+    lru.invalidate('dave03')
+    assert lru.bytes == cache.record_size(tolby)
+
+
+def test_cached_user_collection(sqlite_file):
+    '''test cached user lookups stay correct across changes'''
+    backend = main.init_user_collection('sqlite', sqlite_file)
+    collection = cache.CachedUserCollection(backend, max_entries=10)
+    main.load_users('accounts.csv', collection)
+
+    assert main.search_user('dave03', collection).user_name == 'David'
+    assert main.search_user('dave03', collection).user_name == 'David'
+    assert collection.cache.hits == 1
+    assert main.update_user('dave03', 'dave@example.com', 'Dave', 'Yuen',
+                            collection) is True
+    assert collection.search_user('dave03').user_name == 'Dave'
+    assert main.delete_user('dave03', collection) is True
+    assert collection.search_user('dave03') is users.MISSING_USER
+    assert main.add_user('dave03', 'david.yuen@gmail.com', 'David', 'Yuen',
+                         collection) is True
+    assert main.search_user('dave03', collection).email == \
+        'david.yuen@gmail.com'
+    assert len(collection.database) == 3
+
+
+def test_cached_search_many(sqlite_file):
+    '''test batch lookups only send the uncached ids to the backend, once'''
+    backend = main.init_user_collection('sqlite', sqlite_file)
+    collection = cache.CachedUserCollection(backend)
+    main.load_users('accounts.csv', collection)
+    main.search_user('dave03', collection)
+    backend.search_users_many = Mock(wraps=backend.search_users_many)
+
+    result = main.search_users_many(['dave03', 'evmiles97', 'nobody',
+                                     'evmiles97'], collection)
+
+    assert [user and user.user_id for user in result] == \
+        ['dave03', 'evmiles97', None, 'evmiles97']
+    backend.search_users_many.assert_called_once_with(['evmiles97', 'nobody'])
+    assert list(collection.cache.entries) == ['dave03', 'evmiles97']
+
+    statuses = cache.CachedStatusCollection(user_status.UserStatusCollection())
+    main.load_status_updates('status_updates.csv', statuses)
+    assert main.search_statuses_many(['ted_moop'], statuses)[0].user_id == \
+        'ted'
+    assert statuses.search_status('ted_moop').user_id == 'ted'
+    assert statuses.cache.hits == 1
+
+
+def test_cached_status_collection(sqlite_file):
+    '''test cached status lookups stay correct across changes'''
+    backend = main.init_status_collection('sqlite', sqlite_file)
+    collection = cache.CachedStatusCollection(backend)
+    main.load_status_updates('status_updates.csv', collection)
+
+    assert main.search_status('ted_moop', collection).user_id == 'ted'
+    assert main.update_status('ted_moop', 'dave03', 'mine now',
+                              collection) is True
+    assert collection.search_status('ted_moop').status_text == 'mine now'
+    assert main.delete_status('ted_moop', collection) is True
+    assert collection.search_status('ted_moop') is user_status.MISSING_STATUS
+    assert main.add_status('ted', 'ted_moop', 'back', collection) is True
+    assert main.search_status('ted_moop', collection).status_text == 'back'
+
+    main.search_status('evmiles97_00001', collection)
+    assert collection.delete_statuses_by_user('evmiles97') == 3
+    assert main.search_status('evmiles97_00001', collection) is None
+    assert collection.cache.stats()['misses'] == 6
+
+
+# bloom filter tests
+
+
+def test_counting_bloom_filter():
+    '''test no false negatives, removal, and a false-positive rate on target'''
+    bloom_filter = bloom.CountingBloomFilter(10_000, error_rate=0.01)
+    for number in range(10_000):
+        bloom_filter.add(f'user{number}')
+
+    assert all(f'user{number}' in bloom_filter for number in range(10_000))
+    false_positives = sum(f'other{number}' in bloom_filter
+                          for number in range(10_000))
+    assert false_positives < 200
+
+    for number in range(10_000):
+        bloom_filter.remove(f'user{number}')
+    assert not any(bloom_filter.buckets)
+    assert bloom_filter.count == 0
+
+
+def test_bloom_user_collection_short_circuits(collection, database):
+    '''test definite misses never reach the backend'''
+    collection.database = database
+    filtered = bloom.BloomUserCollection(collection)
+    collection.get_user = Mock(wraps=collection.get_user)
+
+    assert main.search_user('ClicheKHFan', filtered) is None
+    assert filtered.search_user('ClicheKHFan') is users.MISSING_USER
+    assert main.search_user('dave03', filtered).user_name == 'David'
+    assert collection.get_user.call_count == 1
+    assert filtered.negatives == 2
+    assert filtered.false_positive_rate() == 0.0
+
+
+def test_bloom_user_collection_changes(collection):
+    '''test adds, merges, deletes and rebuilds keep the filter correct'''
+    filtered = bloom.BloomUserCollection(collection)
+
+    assert main.load_users('accounts.csv', filtered) is True
+    assert main.add_user('Big****123', 'AElrick@BTISolutions.com', 'My',
+                         'Secret', filtered) is True
+    assert main.search_user('Big****123', filtered).user_name == 'My'
+    assert main.delete_user('dave03', filtered) is True
+    assert main.delete_user('dave03', filtered) is False
+    assert main.search_user('dave03', filtered) is None
+    assert len(filtered.database) == 3
+
+    main.bulk_add_users([(f'user{number}', f'user{number}@e', 'n', 'l')
+                         for number in range(3000)], filtered)
+    assert filtered.filter.capacity >= 6000
+    assert all(main.search_user(f'user{number}', filtered)
+               for number in range(3000))
+
+
+def test_bloom_status_collection(status_collection):
+    '''test the status filter follows adds, deletes and cascades'''
+    filtered = bloom.BloomStatusCollection(status_collection, error_rate=0.001)
+    main.load_status_updates('status_updates.csv', filtered)
+
+    assert main.search_status('ted_moop', filtered).user_id == 'ted'
+    assert filtered.search_status('nope') is user_status.MISSING_STATUS
+    assert main.add_status('ted', 'ted_2', 'again', filtered) is True
+    assert main.delete_status('ted_moop', filtered) is True
+    assert main.search_status('ted_moop', filtered) is None
+    assert filtered.delete_statuses_by_user('evmiles97') == 3
+    assert main.search_status('evmiles97_00001', filtered) is None
+    assert filtered.filter.count == 2
+    assert main.search_status('ted_2', filtered).status_text == 'again'
+
+
+def test_bloom_search_many(collection, database):
+    '''test batch lookups skip definite misses before the backend'''
+    collection.database = database
+    filtered = bloom.BloomUserCollection(collection)
+    collection.search_users_many = Mock(wraps=collection.search_users_many)
+
+    result = main.search_users_many(['nobody', 'dave03', 'ClicheKHFan'],
+                                    filtered)
+
+    assert [user and user.user_id for user in result] == [None, 'dave03', None]
+    collection.search_users_many.assert_called_once_with(['dave03'])
+    assert filtered.negatives == 2
+    assert main.search_users_many(['nobody'], filtered) == [None]
+    assert collection.search_users_many.call_count == 1
+
+    statuses = bloom.BloomStatusCollection(
+        columnar_status.ColumnarStatusCollection())
+    main.load_status_updates('status_updates.csv', statuses)
+    assert [status and status.user_id for status in main.search_statuses_many(
+        ['nope', 'ted_moop'], statuses)] == [None, 'ted']
+
+
+# async api tests
+
+
+def test_async_api_operations(collection, status_collection):
+    '''test the coroutines return what the main.py functions return'''
+    async def scenario():
+        assert await async_api.load_users('accounts.csv', collection) is True
+        assert await async_api.add_user('Big****123', 'x', 'My', 'Secret',
+                                        collection) is True
+        assert await async_api.add_user('dave03', 'x', 'y', 'z',
+                                        collection) is False
+        assert await async_api.update_user('dave03', 'd@x', 'Dave', 'Yuen',
+                                           collection) is True
+        assert (await async_api.search_user('dave03', collection)).email \
+            == 'd@x'
+        assert await async_api.search_users_many(
+            iter(['nobody']), collection) == [None]
+        assert (await async_api.search_user_by_email(
+            'D@X', collection)).user_id == 'dave03'
+        assert await async_api.search_user_by_email('nobody@x',
+                                                    collection) is None
+        assert await async_api.add_status('dave03', 'd_1', 'hi',
+                                          status_collection) is True
+        assert await async_api.update_status('d_1', 'dave03', 'hey',
+                                             status_collection) is True
+        assert [status.status_text for status in
+                await async_api.search_statuses_by_user(
+                    'dave03', status_collection)] == ['hey']
+        assert await async_api.delete_user_cascade(
+            'dave03', collection, status_collection) is True
+        assert await async_api.search_status('d_1', status_collection) is None
+        assert await async_api.delete_user('dave03', collection) is False
+
+    asyncio.run(scenario())
+
+
+def test_async_api_serializes_concurrent_adds(sqlite_file):
+    '''test concurrent coroutines on a threaded backend keep every change'''
+    collection = main.init_user_collection('sqlite', sqlite_file)
+
+    async def scenario():
+        return await asyncio.gather(*(
+            async_api.add_user(f'user{number % 50}', f'e{number % 50}',
+                               'n', 'l', collection)
+            for number in range(200)))
+
+    results = asyncio.run(scenario())
+
+    assert results.count(True) == 50
+    assert len(collection.database) == 50
+
+
+def test_async_api_load_backpressure(status_collection):
+    '''test a bulk load is merged in batches while other calls get through'''
+    report = main.LoadReport()
+    served = []
+
+    async def scenario():
+        load = asyncio.ensure_future(async_api.load_status_updates(
+            'status_updates.csv', status_collection, report))
+        while not load.done():
+            await async_api.search_status('ted_moop', status_collection)
+            served.append(len(status_collection.database))
+            await asyncio.sleep(0)
+        return await load
+
+    with patch('async_api.LOAD_BATCH_ROWS', 2), \
+            patch('async_api.LOAD_QUEUE_BATCHES', 1):
+        loaded = asyncio.run(scenario())
+
+    assert loaded is True
+    assert report.inserted == len(status_collection.database) == 5
+    assert report.bytes_read == os.path.getsize('status_updates.csv')
+    assert any(0 < size < report.inserted for size in served)
+
+
+def test_async_api_load_cancel_stops_reader(temp_file, status_collection):
+    '''test a cancelled load stops the reader instead of parsing the rest'''
+    with open(temp_file, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(main.STATUS_HEADER)
+        writer.writerows((f's{n}', 'u', 'text') for n in range(20_000))
+    report = main.LoadReport()
+
+    async def scenario():
+        load = asyncio.ensure_future(async_api.load_status_updates(
+            temp_file, status_collection, report))
+        while not status_collection.database:
+            await asyncio.sleep(0)
+        load.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await load
+
+    with patch('async_api.LOAD_BATCH_ROWS', 10), \
+            patch('async_api.LOAD_QUEUE_BATCHES', 1):
+        asyncio.run(scenario())
+
+    assert report.bytes_read < os.path.getsize(temp_file) // 10
+
+
+def test_async_api_load_errors(collection):
+    '''test a bad load returns False or raises like main.load_users'''
+    async def scenario():
+        assert await async_api.load_users('missing_fields_status.csv',
+                                          collection) is False
+        with pytest.raises(FileNotFoundError):
+            await async_api.load_users('no_such_file.csv', collection)
+
+    asyncio.run(scenario())
+
+
+def test_async_api_save(temp_file, collection, database):
+    '''test the async save writes the same file as main.save_users'''
+    collection.database = database
+
+    assert asyncio.run(async_api.save_users(temp_file, collection)) is True
+    with open(temp_file, 'r') as file:
+        saved = file.read()
+    main.save_users(temp_file, collection)
+    with open(temp_file, 'r') as file:
+        expected = file.read()
+
+    clean_temp_file()
+
+    assert saved == expected
+
+
+def test_async_api_save_yields_while_copying(temp_file, status_collection):
+    '''test the copy for a save lets other coroutines run between slices'''
+    status_collection.merge_rows((f's{number}', 'u', 't')
+                                 for number in range(100))
+    ticks = []
+
+    async def save_and_tick():
+        save = asyncio.ensure_future(async_api.save_status_updates(
+            temp_file, status_collection))
+        while not save.done():
+            ticks.append(len(ticks))
+            await asyncio.sleep(0)
+        return await save
+
+    copied_at = []
+    save_rows = main.save_rows
+
+    def record_save_rows(*args):
+        # how often the other coroutine ran before the copy was done
+        copied_at.append(len(ticks))
+        return save_rows(*args)
+
+    with patch('async_api.SAVE_COPY_ROWS', 10), \
+            patch('main.save_rows', record_save_rows):
+        assert asyncio.run(save_and_tick()) is True
+    saved = main.init_status_collection()
+    main.load_status_updates(temp_file, saved)
+
+    clean_temp_file()
+
+    assert copied_at[0] >= 10
+    assert list(saved.database) == list(status_collection.database)
+
+
+# concurrent collection tests
+
+
+def run_threads(target, count=8):
+    '''runs target(number) on count threads, switching between them often'''
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        threads = [threading.Thread(target=target, args=(number,))
+                   for number in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(interval)
+
+
+def test_concurrent_user_collection_same_id():
+    '''test concurrent adds and deletes of one user_id never both succeed'''
+    collection = main.init_user_collection('concurrent')
+    added = []
+    deleted = []
+
+    def worker(number):
+        for _ in range(500):
+            added.append(collection.add_user('same', f'e{number}', 'n', 'l'))
+            deleted.append(collection.delete_user('same'))
+
+    run_threads(worker)
+
+    assert added.count(True) - deleted.count(True) == \
+        len(collection.database)
+    assert added.count(True) > 0
+
+
+def test_concurrent_user_collection_same_email():
+    '''test concurrent adds of one email under different ids: one wins'''
+    collection = main.init_user_collection('concurrent')
+    winners = []
+
+    def worker(number):
+        for round_ in range(200):
+            if collection.add_user(f'u{number}_{round_}', f'E{round_}@x',
+                                   'n', 'l'):
+                winners.append(round_)
+            collection.modify_user(f'u{number}_{round_}',
+                                   f'e{round_ + 1}@X', 'n', 'l')
+
+    run_threads(worker)
+
+    assert len(collection.database) == len(winners)
+    assert sorted(collection.email_index) == sorted(
+        users.email_key(user.email) for user in collection.database.values())
+
+
+def test_concurrent_user_collection_modify():
+    '''test a modify replaces the record instead of changing it in place'''
+    collection = concurrent_collections.ConcurrentUserCollection(stripes=4)
+    main.load_users('accounts.csv', collection)
+    before = main.search_user('dave03', collection)
+
+    assert main.update_user('dave03', 'd@x', 'Dave', 'Yuen',
+                            collection) is True
+    assert main.update_user('nobody', 'd@x', 'Dave', 'Yuen',
+                            collection) is False
+    assert before.email == 'david.yuen@gmail.com'
+    assert main.search_user('dave03', collection).email == 'd@x'
+
+
+def test_concurrent_status_collection_same_id():
+    '''test racing adds, moves and deletes keep user_index consistent'''
+    collection = main.init_status_collection('concurrent')
+    counts = []
+
+    def worker(number):
+        for round_ in range(300):
+            collection.add_status('same', f'user{number % 3}', 'text')
+            collection.modify_status('same', f'user{round_ % 3}', 'moved')
+            collection.add_status(f's{number}_{round_}', 'user0', 'text')
+            collection.delete_status('same')
+            if round_ % 50 == 0:
+                counts.append(collection.delete_statuses_by_user('user0'))
+            collection.search_statuses_by_user('user0')
+
+    run_threads(worker)
+
+    indexed = {status_id: user_id
+               for user_id, status_ids in collection.user_index.items()
+               for status_id in status_ids}
+    assert indexed == {status_id: status.user_id
+                       for status_id, status in collection.database.items()}
+    assert [status.status_id for status in
+            collection.search_statuses_by_user('user0')] == \
+        list(collection.user_index.get('user0', ()))
+    assert sum(counts) > 0
+
+
+# sharded collection tests
+
+
+@pytest.fixture
+def shard_pool():
+    '''return a pool of 3 shard processes, closed afterwards'''
+    with sharded.ShardPool(3) as pool:
+        yield pool
+
+
+def test_sentinels_pickle_as_shared_instances():
+    '''test the MISSING_* sentinels survive a trip between processes'''
+    assert pickle.loads(pickle.dumps(users.MISSING_USER)) is \
+        users.MISSING_USER
+    assert pickle.loads(pickle.dumps(user_status.MISSING_STATUS)) is \
+        user_status.MISSING_STATUS
+
+
+def test_sharded_user_collection(shard_pool, temp_file):
+    '''test users are routed to their shards through main.py'''
+    collection = shard_pool.users
+
+    assert main.load_users('accounts.csv', collection) is True
+    assert main.add_user('dave03', 'x', 'y', 'z', collection) is False
+    assert main.update_user('dave03', 'd@x', 'Dave', 'Yuen',
+                            collection) is True
+    assert main.search_user('dave03', collection).email == 'd@x'
+    assert collection.search_user('nobody') is users.MISSING_USER
+    assert [user and user.user_id for user in main.search_users_many(
+        ['Cool_kid187', 'nobody', 'evmiles97'], collection)] == \
+        ['Cool_kid187', None, 'evmiles97']
+    assert main.delete_user('Cool_kid187', collection) is True
+    assert main.delete_user('Cool_kid187', collection) is False
+    assert main.save_users(temp_file, collection) is True
+    loaded = users.UserCollection()
+    main.load_users(temp_file, loaded)
+
+    clean_temp_file()
+
+    assert sorted(loaded.database) == ['dave03', 'evmiles97']
+
+
+def test_sharded_user_emails(shard_pool):
+    '''test emails stay unique across shards'''
+    collection = shard_pool.users
+    main.load_users('accounts.csv', collection)
+    user_ids = [f'user{number}' for number in range(6)]
+
+    assert {collection.pool.shard_of(user_id) for user_id in user_ids} == \
+        {0, 1, 2}
+    assert [main.add_user(user_id, 'EVE.miles@uw.edu', 'n', 'l', collection)
+            for user_id in user_ids] == [False] * 6
+    with patch('sharded.SHARD_BATCH_ROWS', 2):
+        assert collection.merge_rows(
+            [(user_id, 'same@x', 'n', 'l') for user_id in user_ids] +
+            [('dave03', 'new@x', 'n', 'l')]) == (1, 6)
+    assert main.update_user('dave03', 'same@X', 'D', 'Y', collection) is False
+    assert main.update_user('dave03', 'David.Yuen@gmail.com', 'D', 'Y',
+                            collection) is True
+    assert main.search_user_by_email('SAME@x', collection).user_id == 'user0'
+    assert main.search_user_by_email('new@x', collection) is None
+
+
+def test_sharded_status_collection(shard_pool):
+    '''test statuses stay unique and move when their user changes shard'''
+    collection = shard_pool.statuses
+    user_ids = [f'user{number}' for number in range(10)]
+    other = next(user_id for user_id in user_ids
+                 if sharded.shard_of(user_id, 3) !=
+                 sharded.shard_of('ted', 3))
+
+    with patch('sharded.SHARD_BATCH_ROWS', 2):
+        assert main.load_status_updates('status_updates.csv',
+                                        collection) is True
+        assert collection.merge_rows([('x', 'ted', 't'), ('x', other, 't'),
+                                      ('ted_moop', other, 't')]) == (1, 2)
+    assert main.add_status(other, 'ted_moop', 'taken', collection) is False
+    assert main.search_status('ted_moop', collection).user_id == 'ted'
+    assert main.update_status('ted_moop', other, 'moved',
+                              collection) is True
+    assert main.search_status('ted_moop', collection).user_id == other
+    assert main.search_statuses_by_user('ted', collection)[0].status_id == 'x'
+    assert main.update_status('nope', other, 'x', collection) is False
+    assert [status.status_id for status in
+            main.search_statuses_by_user('evmiles97', collection)] == \
+        ['evmiles97_00001', 'evmiles97_00002', 'ted_00002']
+    assert main.delete_status('x', collection) is True
+    assert main.delete_status('x', collection) is False
+    assert collection.delete_statuses_by_user('evmiles97') == 3
+    assert len(collection.database) == 2
+
+
+def test_sharded_cascade(shard_pool):
+    '''test a cascading delete reaches the user's shard'''
+    main.load_users('accounts.csv', shard_pool.users)
+    main.load_status_updates('status_updates.csv', shard_pool.statuses)
+
+    assert main.delete_user_cascade('evmiles97', shard_pool.users,
+                                    shard_pool.statuses) is True
+    assert main.search_statuses_by_user('evmiles97',
+                                        shard_pool.statuses) == []
+
+
+def test_sharded_worker_error(shard_pool):
+    '''test a failing shard leaves no reply behind for later calls'''
+    collection = shard_pool.users
+    rows = [(f'u{number}', f'u{number}@x', 'n', 'l') for number in range(20)]
+
+    with pytest.raises(TypeError):
+        main.bulk_add_users([('bad', 'bad@x', 'n')] + rows, collection)
+    with pytest.raises(TypeError):
+        shard_pool.call_all('users', 'add_user', 'bad')
+    # the bad row stopped its shard's merge; the other shards merged
+    merged = [row[0] for row in rows
+              if shard_pool.shard_of(row[0]) != shard_pool.shard_of('bad')]
+    assert [user and user.user_id for user in main.search_users_many(
+        [row[0] for row in rows], collection)] == \
+        [row[0] if row[0] in merged else None for row in rows]
+    assert main.search_user(merged[0], collection).user_id == merged[0]
+    assert main.add_user(merged[0], 'x@x', 'n', 'l', collection) is False
+    assert collection.merge_rows([('v1', 'v1@x', 'n', 'l')]) == (1, 0)
+    assert len(collection.database) == len(merged) + 1
+    assert main.search_status('ted_00002', shard_pool.statuses) is None
+
+
+# full-text search tests
+
+
+def test_text_index_queries():
+    '''test AND, OR, prefix and ranked queries and index upkeep'''
+    index = text_index.TextIndex()
+    index.add('s3', 'Sunny in Seattle, sunny all day')
+    index.add('s1', 'Rain in Seattle')
+    index.add('s2', 'Sunburn at the beach')
+
+    assert text_index.tokenize('Café, CAFÉ!') == ['café', 'café']
+    assert index.search('seattle SUNNY') == ['s3']
+    assert index.search('seattle sunny', match_all=False) == ['s1', 's3']
+    assert index.search('sun*') == ['s2', 's3']
+    assert index.search('sun* seattle', ranked=True) == ['s3']
+    assert index.search('sunny rain', match_all=False, ranked=True) == \
+        ['s3', 's1']
+    assert index.search('!!') == []
+
+    index.remove('s2', 'Sunburn at the beach')
+    assert index.search('sun*') == ['s3']
+    index.add('s2', 'Sunburn again')
+    assert index.search('sunb*', ranked=True) == ['s2']
+    assert index.search('sunb* sunb*', ranked=True) == ['s2']
+    assert index.search('sun*', match_all=False, ranked=True) == ['s3', 's2']
+
+
+def test_text_index_matches_scan():
+    '''test the index and a linear scan agree on every query'''
+    texts = {f's{number:03}': ' '.join(f'w{(number * step) % 17}'
+                                       for step in range(1, number % 6 + 2))
+             for number in range(200)}
+    index = text_index.TextIndex()
+    for status_id, text in texts.items():
+        index.add(status_id, text)
+
+    for query in ('w1', 'w1 w2', 'w1*', 'w1* w3', 'w16 w0', 'nope'):
+        for match_all in (True, False):
+            for ranked in (True, False):
+                assert index.search(query, match_all, ranked) == \
+                    text_index.scan(texts.items(), query, match_all, ranked)
+
+
+def test_search_statuses_by_text():
+    '''test the collection keeps its text index current'''
+    collection = main.init_status_collection(text_search=True)
+    main.load_status_updates('status_updates.csv', collection)
+
+    def found(query, **options):
+        return [status.status_id for status in
+                main.search_statuses_by_text(query, collection, **options)]
+
+    assert found('weather hike') == ['evmiles97_00002', 'ted_00002',
+                                     'ted_moop']
+    assert found('sunny compil*', match_all=False) == ['dave03_00001',
+                                                       'evmiles97_00001']
+    assert main.update_status('ted_moop', 'ted', 'Rainy hike', collection)
+    assert main.delete_status('ted_00002', collection)
+    assert found('weather') == ['evmiles97_00002']
+    assert found('rain*') == ['ted_moop']
+    assert collection.delete_statuses_by_user('evmiles97') == 2
+    assert found('perfect code', match_all=False) == []
+
+    collection.database = {}
+    assert found('rain*') == []
+    assert collection.text_index.postings == {}
+
+
+def test_search_statuses_by_text_scan(sqlite_file, shard_pool):
+    '''test backends without an index give the same answers by scanning'''
+    indexed = main.init_status_collection(text_search=True)
+    main.load_status_updates('status_updates.csv', indexed)
+    expected = [status.status_id for status in
+                main.search_statuses_by_text('perfect w*', indexed,
+                                             ranked=True)]
+
+    for collection in (main.init_status_collection(),
+                       main.init_status_collection('concurrent'),
+                       main.init_status_collection('concurrent',
+                                                   text_search=True),
+                       main.init_status_collection('columnar'),
+                       main.init_status_collection('sqlite', sqlite_file),
+                       shard_pool.statuses):
+        main.load_status_updates('status_updates.csv', collection)
+        assert [status.status_id for status in main.search_statuses_by_text(
+            'perfect w*', collection, ranked=True)] == expected
+    assert [status.status_id for status in asyncio.run(
+        async_api.search_statuses_by_text('perfect w*', collection,
+                                          match_all=False))] == \
+        sorted(expected)
+
+
+def test_sharded_search_statuses_by_text():
+    '''test sharded text searches merge every shard's matches in order'''
+    scanned = main.init_status_collection()
+    main.load_status_updates('status_updates.csv', scanned)
+    with sharded.ShardPool(3, text_search=True) as pool:
+        main.load_status_updates('status_updates.csv', pool.statuses)
+        assert len({pool.shard_of(status.user_id) for status in
+                    pool.statuses.database.values()}) > 1
+        for query in ('weather hike', 'sunny compil*', 'w* h*', 'nope'):
+            for match_all in (True, False):
+                for ranked in (True, False):
+                    expected = main.search_statuses_by_text(
+                        query, scanned, match_all, ranked)
+                    assert [status.status_id for status in
+                            main.search_statuses_by_text(
+                                query, pool.statuses, match_all, ranked)] \
+                        == [status.status_id for status in expected]
+
+
+# prefix search tests
+
+
+def test_prefix_index_search():
+    '''test case, ordering, limit, one result per user and index upkeep'''
+    index = prefix_index.PrefixIndex()
+    index.add('u1', 'Anna', 'Annis')
+    index.add('u2', 'Bob', 'ann')
+    index.add('u3', ' ANN ', 'Smith')
+    index.add('u4', '', '')
+
+    assert index.search('an') == ['u2', 'u3', 'u1']
+    assert index.search('AN', limit=2) == ['u2', 'u3']
+    assert index.search('annis') == ['u1']
+    assert index.search('x') == []
+    assert index.search('') == ['u2', 'u3', 'u1']
+
+    index.remove('u2', 'Bob', 'ann')
+    assert index.search('an') == ['u3', 'u1']
+    index.add('u2', 'Bob', 'ann')
+    assert index.search('an') == ['u2', 'u3', 'u1']
+    index.remove('u1', 'Anna', 'Annis')
+    index.add('u1', 'Zoe', 'Annis')
+    assert index.search('ann') == ['u2', 'u3', 'u1']
+    assert index.search('z') == ['u1']
+
+
+def test_prefix_index_matches_scan(monkeypatch):
+    '''test the index and a scan agree while entries merge and die'''
+    monkeypatch.setattr(prefix_index, 'PENDING_MINIMUM', 8)
+    monkeypatch.setattr(prefix_index, 'PENDING_FACTOR', 1)
+    names = ['al', 'Alma', 'alb', 'Bea', 'be', 'Carl', 'ca', 'c']
+    collection = users.UserCollection(prefix_search=True)
+    collection.merge_rows((f'u{number:03}', f'u{number}@e',
+                           names[number % 8], names[number * 3 % 8])
+                          for number in range(100))
+    for number in range(0, 100, 3):
+        collection.modify_user(f'u{number:03}', f'u{number}@e',
+                               names[number * 5 % 8], 'Dee')
+    for number in range(0, 100, 7):
+        collection.delete_user(f'u{number:03}')
+    for number in range(100, 130):
+        collection.add_user(f'u{number:03}', f'u{number}@e',
+                            names[number % 8], 'Al')
+
+    for prefix in ('a', 'AL', 'alb', 'b', 'c', 'ca', 'd', 'x', ''):
+        for limit in (1, 5, 50):
+            assert collection.search_users_by_prefix(prefix, limit) == \
+                prefix_index.scan(collection.database.values(), prefix,
+                                  limit)
+
+
+def test_search_users_by_prefix():
+    '''test the collection keeps its prefix index current'''
+    collection = main.init_user_collection(prefix_search=True)
+    main.load_users('accounts.csv', collection)
+
+    def found(prefix, **options):
+        return [user.user_id for user in
+                main.search_users_by_prefix(prefix, collection, **options)]
+
+    assert found('da') == ['dave03']
+    assert found('e') == ['evmiles97']
+    assert found('m') == ['evmiles97']
+    assert found('') == ['Cool_kid187', 'dave03', 'evmiles97']
+    assert found('', limit=1) == ['Cool_kid187']
+    assert main.update_user('dave03', 'david.yuen@gmail.com', 'Dave', 'Moon',
+                            collection)
+    assert found('m') == ['evmiles97', 'dave03']
+    assert found('y') == []
+    assert main.delete_user('evmiles97', collection)
+    assert found('m') == ['dave03']
+    collection.database = {'x': users.Users('x', '', 'Mo', 'Mo')}
+    assert found('m') == ['x']
+
+
+def test_search_users_by_prefix_backends(sqlite_file, shard_pool):
+    '''test every backend gives the same matches'''
+    rows = [(f'u{number}', f'u{number}@e', name, last_name)
+            for number, (name, last_name) in enumerate(
+                [('Ann', 'Smith'), ('anna', 'Annis'), ('Bob', 'Ann'),
+                 ('', ''), ('Zed', 'ANNEX'), ('Anne', 'Anne')])]
+    expected = {('an', 10): ['u0', 'u2', 'u1', 'u5', 'u4'],
+                ('an', 2): ['u0', 'u2'],
+                ('annex', 10): ['u4'],
+                ('q', 10): []}
+
+    for collection in (main.init_user_collection(),
+                       main.init_user_collection(prefix_search=True),
+                       main.init_user_collection('concurrent'),
+                       main.init_user_collection('concurrent',
+                                                 prefix_search=True),
+                       main.init_user_collection('sqlite', sqlite_file),
+                       shard_pool.users):
+        collection.merge_rows(rows)
+        for (prefix, limit), user_ids in expected.items():
+            assert [user.user_id for user in main.search_users_by_prefix(
+                prefix, collection, limit)] == user_ids
+    assert [user.user_id for user in asyncio.run(
+        async_api.search_users_by_prefix('ann', collection, 1))] == ['u0']
+
+
 if __name__ == '__main__':
     pytest.main(['-v'])
@@ -0,0 +1,161 @@
+'''
+Inverted index over status_text for full-text search
+
+Texts are split into lowercase \\w+ words (terms). TextIndex keeps, for
+every term, the status_ids whose text contains it and how many times
+(the postings), plus a sorted list of the terms, so a prefix query is
+a bisect into that list. New terms wait in a set and are merged into
+the list by the next prefix query; terms whose postings are gone stay
+in the list until they are half of it. UserStatusCollection updates
+its TextIndex on every add, modify and delete. Indexing costs time
+and memory on every add, so it is opt-in; scan() answers the same
+queries by reading every text, for collections without an index.
+
+A query is a string of terms; a term ending in * matches every term
+that starts with it. With match_all, a status must match every query
+term (AND), otherwise any of them (OR).
+'''
+import bisect
+import contextlib
+import heapq
+import re
+
+TOKEN = re.compile(r'\w+')
+QUERY_TERM = re.compile(r'(\w+)(\*?)')
+
+
+def tokenize(text):
+    '''
+    Returns the lowercase words of text
+    '''
+    return TOKEN.findall(text.lower())
+
+
+class TextIndex():
+    '''
+    term -> {status_id: occurrences} postings and the sorted
+    vocabulary. Changes and searches are made under lock (a
+    no-op unless a thread-safe collection sets a real one)
+    '''
+
+    def __init__(self):
+        self.postings = {}
+        self.terms = []
+        self.new_terms = set()
+        self.lock = contextlib.nullcontext()
+
+    def clear(self):
+        '''
+        Empties the index
+        '''
+        with self.lock:
+            self.postings = {}
+            self.terms = []
+            self.new_terms = set()
+
+    def add(self, status_id, text):
+        '''
+        Indexes the words of text under status_id
+        '''
+        counts = {}
+        for term in tokenize(text):
+            counts[term] = counts.get(term, 0) + 1
+        with self.lock:
+            for term, count in counts.items():
+                posting = self.postings.get(term)
+                if posting is None:
+                    posting = self.postings[term] = {}
+                    self.new_terms.add(term)
+                posting[status_id] = count
+
+    def remove(self, status_id, text):
+        '''
+        Removes status_id, indexed with text, from the index
+        '''
+        with self.lock:
+            for term in set(tokenize(text)):
+                posting = self.postings[term]
+                del posting[status_id]
+                if not posting:
+                    del self.postings[term]
+                    self.new_terms.discard(term)
+
+    def _matches(self, term, prefix):
+        '''status_id -> occurrences of term (or of every term it prefixes)'''
+        if not prefix:
+            return self.postings.get(term, {})
+        terms = self._sorted_terms()
+        matches = {}
+        position = bisect.bisect_left(terms, term)
+        while position < len(terms) and terms[position].startswith(term):
+            for status_id, count in self.postings.get(terms[position],
+                                                      {}).items():
+                matches[status_id] = matches.get(status_id, 0) + count
+            position += 1
+        return matches
+
+    def _sorted_terms(self):
+        '''the sorted term list, after merging in the new terms'''
+        if self.new_terms:
+            # a term removed and added again may already be listed
+            self.terms = list(dict.fromkeys(heapq.merge(
+                self.terms, sorted(self.new_terms))))
+            self.new_terms = set()
+        if len(self.terms) > 2 * len(self.postings):
+            # drop terms that are no longer in any status
+            self.terms = [term for term in self.terms
+                          if term in self.postings]
+        return self.terms
+
+    def search(self, query, match_all=True, ranked=False):
+        '''
+        Returns the status_ids matching query, in status_id order,
+        or with ranked, most occurrences of the query terms first
+        '''
+        with self.lock:
+            parts = [self._matches(term, bool(star))
+                     for term, star in QUERY_TERM.findall(query.lower())]
+            if not parts:
+                return []
+            if match_all:
+                # walk the shortest posting, probe the others
+                parts.sort(key=len)
+                scores = {status_id: sum(part[status_id] for part in parts)
+                          for status_id in parts[0]
+                          if all(status_id in part for part in parts[1:])}
+            else:
+                scores = {}
+                for part in parts:
+                    for status_id, count in part.items():
+                        scores[status_id] = scores.get(status_id, 0) + count
+        return ordered(scores, ranked)
+
+
+def ordered(scores, ranked):
+    '''
+    status_ids of scores in status_id order, or with ranked,
+    highest score first
+    '''
+    if ranked:
+        return sorted(scores, key=lambda status_id: (-scores[status_id],
+                                                     status_id))
+    return sorted(scores)
+
+
+def scan(items, query, match_all=True, ranked=False):
+    '''
+    TextIndex.search over (status_id, status_text) pairs without
+    an index: every text is tokenized and compared
+    '''
+    query_terms = QUERY_TERM.findall(query.lower())
+    if not query_terms:
+        return []
+    scores = {}
+    for status_id, text in items:
+        tokens = tokenize(text)
+        counts = [sum(token.startswith(term) if star else token == term
+                      for token in tokens)
+                  for term, star in query_terms]
+        if all(counts) if match_all else any(counts):
+            scores[status_id] = sum(counts)
+    return ordered(scores, ranked)
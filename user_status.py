@@ -1,9 +1,14 @@
 '''This module conatins the classes UserStatus and UserStatusCollection'''
 # pylint: disable=R0903
+from interning import intern_id
+from merging import add_each
+import text_index
 
 
 class UserStatus():
-    '''This class store information related to a user status update.'''
+    '''This class store information related to a user status update.
+    Slots instead of a per-instance __dict__ keep each record small.'''
+    __slots__ = ('status_id', 'user_id', 'status_text')
 
     def __init__(self, status_id, user_id, status_text):
         '''creates a UserStatus'''
@@ -12,42 +17,168 @@ class UserStatus():
         self.status_text = status_text
 
 
+class MissingStatus(UserStatus):
+    '''This read-only UserStatus is returned by search_status when the
+    status_id is not found (one shared instance).'''
+    __slots__ = ()
+    status_id = None
+    user_id = None
+    status_text = None
+
+    def __init__(self):  # pylint: disable=W0231
+        '''creates the sentinel, which has no fields of its own'''
+
+    def __setattr__(self, name, value):
+        raise AttributeError('MISSING_STATUS is read-only')
+
+    def __reduce__(self):
+        '''unpickles as the shared instance'''
+        return 'MISSING_STATUS'
+
+
+MISSING_STATUS = MissingStatus()
+
+
 class UserStatusCollection():
     '''This class contains a database of UserStatus objects, and
-    various functions to manipulate those UserStatus objects.'''
+    various functions to manipulate those UserStatus objects.
+
+    user_index maps each user_id to the status_ids of that user, in the
+    order they were added (a dict used as an ordered set). With
+    text_search, text_index is a TextIndex of the words of every
+    status_text; otherwise it is None and text searches scan.'''
 
-    def __init__(self):
+    def __init__(self, text_search=False):
+        self.user_index = {}
+        self.text_index = text_index.TextIndex() if text_search else None
         self.database = {}
 
+    @property
+    def database(self):
+        '''The status_id -> UserStatus dict.'''
+        return self._database
+
+    @database.setter
+    def database(self, database):
+        '''This replaces the database and rebuilds user_index and
+        text_index from it.'''
+        self._database = database
+        self.user_index = {}
+        for status_id, status in database.items():
+            self._index_add(status_id, status.user_id)
+        if self.text_index is not None:
+            self.text_index.clear()
+            for status_id, status in database.items():
+                self.text_index.add(status_id, status.status_text)
+
+    def _index_add(self, status_id, user_id):
+        '''This records status_id under user_id in user_index.'''
+        self.user_index.setdefault(user_id, {})[status_id] = None
+
+    def _index_remove(self, status_id, user_id):
+        '''This removes status_id from user_id in user_index.'''
+        status_ids = self.user_index[user_id]
+        del status_ids[status_id]
+        if not status_ids:
+            del self.user_index[user_id]
+
+    def _reindex(self, status, user_id, status_text):
+        '''This moves status to user_id in user_index and to status_text
+        in text_index, before the status itself is changed.'''
+        if status.user_id != user_id:
+            # The status moves to the end of the new user's timeline
+            self._index_remove(status.status_id, status.user_id)
+            self._index_add(status.status_id, user_id)
+        if self.text_index is not None:
+            self.text_index.remove(status.status_id, status.status_text)
+            self.text_index.add(status.status_id, status_text)
+
     def add_status(self, status_id, user_id, status_text):
         '''This adds a status to the database.'''
-        if status_id in self.database:
+        if status_id in self._database:
             # Rejects new status if status_id already exists
             return False
+        # only user_id repeats across statuses, so only it is interned
+        user_id = intern_id(user_id)
         new_status = UserStatus(status_id, user_id, status_text)
-        self.database[status_id] = new_status
+        self._database[status_id] = new_status
+        self._index_add(status_id, user_id)
+        if self.text_index is not None:
+            self.text_index.add(status_id, status_text)
         return True
 
+    def merge_rows(self, rows):
+        '''This adds many statuses at once from an iterable of
+        (status_id, user_id, status_text) rows, skipping status_ids that
+        already exist in the database or earlier in rows.
+        Returns a tuple (inserted, skipped).'''
+        return add_each(self.add_status, rows)
+
     def modify_status(self, status_id, user_id, status_text):
         '''This changes the stored content in a status.'''
-        if status_id not in self.database:
+        if status_id not in self._database:
             # Rejects update is the status_id does not exist
             return False
-        self.database[status_id].user_id = user_id
-        self.database[status_id].status_text = status_text
+        status = self._database[status_id]
+        user_id = intern_id(user_id)
+        self._reindex(status, user_id, status_text)
+        status.user_id = user_id
+        status.status_text = status_text
         return True
 
     def delete_status(self, status_id):
         '''This deletes a status.'''
-        if status_id not in self.database:
+        if status_id not in self._database:
             # Fails if status does not exist
             return False
-        del self.database[status_id]
+        status = self._database.pop(status_id)
+        self._index_remove(status_id, status.user_id)
+        if self.text_index is not None:
+            self.text_index.remove(status_id, status.status_text)
         return True
 
+    def delete_statuses_by_user(self, user_id):
+        '''This deletes every status of user_id, in time proportional to
+        the number of statuses that user has. Returns how many were
+        deleted.'''
+        status_ids = self.user_index.pop(user_id, {})
+        for status_id in status_ids:
+            status = self._database.pop(status_id)
+            if self.text_index is not None:
+                self.text_index.remove(status_id, status.status_text)
+        return len(status_ids)
+
     def search_status(self, status_id):
         '''The returns a status.'''
-        if status_id not in self.database:
-            # Fails if the status does not exist
-            return UserStatus(None, None, None)
-        return self.database[status_id]
+        # Fails with the shared MISSING_STATUS if the status does not exist
+        return self._database.get(status_id, MISSING_STATUS)
+
+    def get_status(self, status_id):
+        '''This returns a status, or None (without allocating anything)
+        if it does not exist.'''
+        return self._database.get(status_id)
+
+    def search_statuses_many(self, status_ids):
+        '''This returns the statuses of status_ids in the same order, with
+        None for each status that does not exist.'''
+        get = self._database.get
+        return [get(status_id) for status_id in status_ids]
+
+    def search_statuses_by_text(self, query, match_all=True, ranked=False):
+        '''This returns the statuses whose text matches query (see
+        text_index), in status_id order or, with ranked, best first.
+        Without text_search every status is scanned.'''
+        if self.text_index is None:
+            status_ids = text_index.scan(
+                ((status_id, status.status_text)
+                 for status_id, status in self._database.items()),
+                query, match_all, ranked)
+        else:
+            status_ids = self.text_index.search(query, match_all, ranked)
+        return [self._database[status_id] for status_id in status_ids]
+
+    def search_statuses_by_user(self, user_id):
+        '''This returns the statuses of user_id, oldest first, in time
+        proportional to the number of statuses that user has.'''
+        status_ids = self.user_index.get(user_id, ())
+        return [self._database[status_id] for status_id in status_ids]
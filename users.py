@@ -3,12 +3,18 @@ Classes for user information for the
 social network project
 '''
 # pylint: disable=R0903
+from interning import intern_id
+from merging import add_each
+import prefix_index
 
 
 class Users():
     '''
     Contains user information
+    (slots instead of a per-instance __dict__
+    keep each record small)
     '''
+    __slots__ = ('user_id', 'email', 'user_name', 'user_last_name')
 
     def __init__(self, user_id, email, user_name, user_last_name):
         self.user_id = user_id
@@ -17,49 +23,216 @@ class Users():
         self.user_last_name = user_last_name
 
 
+class MissingUser(Users):
+    '''
+    Read-only Users returned by search_user when
+    the user_id is not found (one shared instance)
+    '''
+    __slots__ = ()
+    user_id = None
+    email = None
+    user_name = None
+    user_last_name = None
+
+    def __init__(self):  # pylint: disable=W0231
+        pass
+
+    def __setattr__(self, name, value):
+        raise AttributeError('MISSING_USER is read-only')
+
+    def __reduce__(self):
+        # unpickles as the shared instance
+        return 'MISSING_USER'
+
+
+MISSING_USER = MissingUser()
+
+
+def email_key(email):
+    '''
+    Returns the form of email that is indexed and compared
+    (case-folded, surrounding spaces removed); '' means
+    the user has no email, as does anything but a str
+    (None, or a NULL from SQLite)
+    '''
+    if not isinstance(email, str):
+        return ''
+    return email.strip().casefold()
+
+
 class UserCollection():
     '''
     Contains a collection of Users objects
+    (email_index maps each email_key to its user_id,
+    so no two users share an email; with prefix_search,
+    prefix_index is a PrefixIndex of every user's names,
+    otherwise it is None and prefix searches scan)
     '''
 
-    def __init__(self):
+    def __init__(self, prefix_search=False):
+        self.email_index = {}
+        self.prefix_index = (prefix_index.PrefixIndex() if prefix_search
+                             else None)
         self.database = {}
 
+    @property
+    def database(self):
+        '''
+        The user_id -> Users dict
+        '''
+        return self._database
+
+    @database.setter
+    def database(self, database):
+        '''
+        Replaces the database and rebuilds email_index
+        (if emails repeat, the first user keeps it)
+        and prefix_index
+        '''
+        self._database = database
+        self.email_index = {}
+        for user_id, user in database.items():
+            key = email_key(user.email)
+            if key:
+                self.email_index.setdefault(key, user_id)
+        if self.prefix_index is not None:
+            self.prefix_index.clear()
+            with self.prefix_index.deferring():
+                for user_id, user in database.items():
+                    self.prefix_index.add(user_id, user.user_name,
+                                          user.user_last_name)
+
+    def email_taken(self, email, user_id=None):
+        '''
+        True if a user other than user_id has email
+        '''
+        owner = self.email_index.get(email_key(email))
+        return owner is not None and owner != user_id
+
     def add_user(self, user_id, email, user_name, user_last_name):
         '''
         Adds a new user to the collection
         '''
-        if user_id in self.database:
-            # Rejects new status if status_id already exists
+        if user_id in self._database or self.email_taken(email):
+            # Rejects new user if user_id or email already exists
             return False
+        user_id = intern_id(user_id)
         new_user = Users(user_id, email, user_name, user_last_name)
-        self.database[user_id] = new_user
+        self._database[user_id] = new_user
+        key = email_key(email)
+        if key:
+            self.email_index[key] = user_id
+        if self.prefix_index is not None:
+            self.prefix_index.add(user_id, user_name, user_last_name)
         return True
 
+    def merge_rows(self, rows):
+        '''
+        Adds many users at once from an iterable of
+        (user_id, email, user_name, user_last_name) rows.
+        A user_id or email that already exists, in the
+        collection or earlier in rows, is skipped.
+        Returns a tuple (inserted, skipped)
+        '''
+        # add_user checks the dicts, which already hold
+        # every row inserted earlier in this batch
+        if self.prefix_index is None:
+            return add_each(self.add_user, rows)
+        # the new names are sorted into prefix_index once, at the end
+        with self.prefix_index.deferring():
+            return add_each(self.add_user, rows)
+
     def modify_user(self, user_id, email, user_name, user_last_name):
         '''
-        Modifies an existing user
+        Modifies an existing user (fails if another
+        user has the new email)
         '''
-        if user_id not in self.database:
+        user = self._database.get(user_id)
+        if user is None or self.email_taken(email, user_id):
             return False
-        self.database[user_id].email = email
-        self.database[user_id].user_name = user_name
-        self.database[user_id].user_last_name = user_last_name
+        self._reindex_email(user_id, user.email, email)
+        self._reindex_names(user, user_name, user_last_name)
+        user.email = email
+        user.user_name = user_name
+        user.user_last_name = user_last_name
         return True
 
+    def _reindex_email(self, user_id, old_email, new_email):
+        '''moves user_id from old_email to new_email in email_index'''
+        old_key = email_key(old_email)
+        if self.email_index.get(old_key) == user_id:
+            del self.email_index[old_key]
+        new_key = email_key(new_email)
+        if new_key:
+            self.email_index[new_key] = user_id
+
+    def _reindex_names(self, user, user_name, user_last_name):
+        '''moves user from its current names to these in prefix_index'''
+        if self.prefix_index is not None:
+            self.prefix_index.remove(user.user_id, user.user_name,
+                                     user.user_last_name)
+            self.prefix_index.add(user.user_id, user_name, user_last_name)
+
     def delete_user(self, user_id):
         '''
         Deletes an existing user
         '''
-        if user_id not in self.database:
+        user = self._database.pop(user_id, None)
+        if user is None:
             return False
-        del self.database[user_id]
+        key = email_key(user.email)
+        if self.email_index.get(key) == user_id:
+            del self.email_index[key]
+        if self.prefix_index is not None:
+            self.prefix_index.remove(user.user_id, user.user_name,
+                                     user.user_last_name)
         return True
 
     def search_user(self, user_id):
         '''
         Searches for user data
         '''
-        if user_id not in self.database:
-            return Users(None, None, None, None)
-        return self.database[user_id]
+        return self._database.get(user_id, MISSING_USER)
+
+    def get_user(self, user_id):
+        '''
+        Returns the user, or None if it does not exist
+        (nothing is allocated on a miss)
+        '''
+        return self._database.get(user_id)
+
+    def search_user_by_email(self, email):
+        '''
+        Returns the user with email (any case),
+        or MISSING_USER if there is none
+        '''
+        user = self.get_user_by_email(email)
+        return MISSING_USER if user is None else user
+
+    def get_user_by_email(self, email):
+        '''
+        Returns the user with email (any case),
+        or None if there is none
+        '''
+        user_id = self.email_index.get(email_key(email))
+        return None if user_id is None else self._database[user_id]
+
+    def search_users_many(self, user_ids):
+        '''
+        Returns the users of user_ids in the same order,
+        with None for each user that does not exist
+        '''
+        get = self._database.get
+        return [get(user_id) for user_id in user_ids]
+
+    def search_users_by_prefix(self, prefix, limit=10):
+        '''
+        Returns up to limit users whose user_name or
+        user_last_name starts with prefix (any case),
+        ordered by that name, then user_id. Without
+        prefix_search every user is compared
+        '''
+        if self.prefix_index is None:
+            return prefix_index.scan(self._database.values(), prefix, limit)
+        return [self._database[user_id] for user_id
+                in self.prefix_index.search(prefix, limit)]